@@ -0,0 +1,269 @@
+""" Micro-benchmarks of the hot paths of the parser
+
+The benchmarks run on data/samples/file1, on larger documents made of
+several copies of it and on synthetic documents. Each benchmark is timed
+repeatedly, the results are printed and written as JSON, and can be compared
+with an earlier result file. Run it as a module from the repository root:
+
+    python3 -m benchmarks.run -o results.json
+    python3 -m benchmarks.run -o new.json --compare results.json
+"""
+import io
+import json
+import logging
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+from stagedp.eval.metrics import Metrics
+from stagedp.features.extraction import ActionFeatureGenerator, RelationFeatureGenerator
+from stagedp.models.parser import RstParser
+from stagedp.models.state import ParsingState, create_edu_nodes
+from stagedp.models.tree import RstTree
+from stagedp.utils.brown import load_brown_clusters
+from stagedp.utils.document import Doc
+from benchmarks.synthetic import generate_document
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(ROOT, 'data', 'samples', 'file1')
+
+
+def concat_documents(merge_text, dis_text, copies, paragraph_size=5):
+    """ A document made of copies of one document, the copies are the
+        children of a multinuclear List relation under the root
+
+    The sample has a single paragraph, so a new paragraph is started every
+    paragraph_size sentences, which gives relations at all levels.
+
+    :return: the *.merge and the *.dis text of the new document
+    """
+    lines = [line.split('\t') for line in merge_text.splitlines() if line.strip()]
+    n_sents = max(int(items[0]) for items in lines) + 1
+    n_edus = max(int(items[-2]) for items in lines)
+    merge_lines = []
+    for copy in range(copies):
+        for items in lines:
+            items = list(items)
+            sent_i = int(items[0]) + copy * n_sents
+            items[0] = str(sent_i)
+            items[-2] = str(int(items[-2]) + copy * n_edus)
+            items[-1] = str(sent_i // paragraph_size + 1)
+            merge_lines.append('\t'.join(items))
+    if copies == 1:
+        return '\n'.join(merge_lines) + '\n', dis_text
+    dis_copies = []
+    for copy in range(copies):
+        offset = copy * n_edus
+        text = re.sub(r'\((\s*)leaf (\d+)\)', lambda m: f'({m.group(1)}leaf {int(m.group(2)) + offset})', dis_text)
+        text = re.sub(r'\((\s*)span (\d+) (\d+)\)',
+                      lambda m: f'({m.group(1)}span {int(m.group(2)) + offset} {int(m.group(3)) + offset})', text)
+        text = re.sub(r'^\s*\(\s*Root (\(span \d+ \d+\))', r'( Nucleus \1 (rel2par List)', text.strip())
+        dis_copies.append(text)
+    dis_text = '( Root (span 1 {})\n{}\n)\n'.format(copies * n_edus, '\n'.join(dis_copies))
+    return '\n'.join(merge_lines) + '\n', dis_text
+
+
+def parse_sizes(sizes):
+    """ Numbers of a comma separated option, empty for an empty option
+    """
+    return [int(size) for size in sizes.split(',') if size.strip()]
+
+
+def oracle_states(rst_tree):
+    """ Stack, queue and action history before each action of the gold
+        tree, with the actions
+    """
+    states, action_hist = [], []
+    sr_parser = ParsingState([], rst_tree.get_edu_node())
+    for node in rst_tree.postorder():
+        if (node.lnode is None) and (node.rnode is None):
+            action = ('Shift', None)
+        else:
+            action = ('Reduce', node.form)
+        stack, queue = sr_parser.get_status()
+        states.append((list(stack), list(queue), list(action_hist)))
+        sr_parser.operate(action)
+        action_hist.append(action)
+    return states, action_hist
+
+
+def measure(func, setup=None, repeat=5, min_time=0.2):
+    """ Time func, with setup the arguments of func are made anew before
+        each call, otherwise func is called as often as fits into min_time
+        per repetition
+
+    :return: seconds per call of every repetition and the number of calls
+             per repetition
+    """
+    number = 1
+    if setup is None:
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            if time.perf_counter() - start >= min_time:
+                break
+            number *= 2
+    times = []
+    for _ in range(repeat):
+        if setup is None:
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            times.append((time.perf_counter() - start) / number)
+        else:
+            args = setup()
+            start = time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter() - start)
+    return times, number
+
+
+def document_benchmarks(name, merge_text, dis_text, rst_parser, bcvocab):
+    """ Benchmarks on one document, yields the name of the benchmark, the
+        function to time and the setup of its arguments
+    """
+    merge_lines = merge_text.splitlines(keepends=True)
+    doc = Doc.from_file(merge_lines)
+    gold_rst = RstTree(RstTree.build_tree(dis_text, binarize=True), doc)
+    pred_rst = rst_parser.sr_parse(doc, bcvocab)
+    gold_nodes = gold_rst.postorder()
+    states, actions = oracle_states(gold_rst)
+    action_feats = [ActionFeatureGenerator(stack, queue, action_hist, doc, bcvocab).gen_features()
+                    for stack, queue, action_hist in states]
+
+    def action_features(states):
+        for stack, queue, action_hist in states:
+            ActionFeatureGenerator(stack, queue, action_hist, doc, bcvocab).gen_features()
+
+    def clear_relation_cache():
+        for node in gold_nodes:
+            node.feature_cache.clear()
+        return ()
+
+    def relation_features():
+        for node in gold_nodes:
+            if (node.lnode is not None) and (node.rnode is not None):
+                RelationFeatureGenerator(node, gold_rst, node.level, bcvocab).gen_features()
+
+    def fresh_states():
+        states, _ = oracle_states(RstTree(RstTree.build_tree(dis_text, binarize=True), doc))
+        return states,
+
+    def fresh_tree():
+        tree = RstTree.build_tree(dis_text, binarize=True)
+        RstTree.down_prop(tree)
+        return tree, doc
+
+    def operate(sr_parser):
+        for action in actions:
+            sr_parser.operate(action)
+
+    yield f'{name}/Doc.from_file', lambda: Doc.from_file(merge_lines), None
+    yield f'{name}/RstTree.build_tree', lambda: RstTree.build_tree(dis_text), None
+    yield f'{name}/RstTree.binarize_tree', RstTree.binarize_tree, lambda: (RstTree.build_tree(dis_text),)
+    yield f'{name}/RstTree.back_prop', RstTree.back_prop, fresh_tree
+    yield f'{name}/ActionFeatureGenerator.gen_features', action_features, fresh_states
+    yield f'{name}/RelationFeatureGenerator.gen_features', relation_features, clear_relation_cache
+    yield f'{name}/ActionClassifier.predict_probs', \
+        lambda: [rst_parser.action_clf.predict_probs(feats) for feats in action_feats], None
+    yield f'{name}/ParsingState.operate', operate, lambda: (ParsingState([], create_edu_nodes(doc)),)
+    yield f'{name}/RstParser.sr_parse', lambda: rst_parser.sr_parse(doc, bcvocab), None
+    yield f'{name}/RstTree.bracketing', pred_rst.bracketing, None
+    yield f'{name}/Metrics.eval', lambda: Metrics().eval(gold_rst, pred_rst), None
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import numpy
+    import scipy
+    import sklearn
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'numpy': numpy.__version__, 'scipy': scipy.__version__, 'sklearn': sklearn.__version__,
+            'cpu_count': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+
+def compare(results, baseline, max_slowdown):
+    """ Print the ratio of the median times to the baseline results, returns
+        the names of the benchmarks that became slower than max_slowdown
+    """
+    base = {result['name']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        if result['name'] not in base:
+            continue
+        ratio = result['median'] / base[result['name']]['median']
+        print(f'{result["name"]:60}\t{ratio:6.2f}x')
+        if ratio > max_slowdown:
+            regressions.append(result['name'])
+    return regressions
+
+
+@click.command()
+@click.option('-o', '--output', default=None, type=str, help='write the results as JSON into this file')
+@click.option('--model_dir', default=None, help='model to parse with, a model is trained on the sample otherwise')
+@click.option('--brown_clusters', default=os.path.join(ROOT, 'data', 'resources', 'bc3200.pickle.gz'),
+              help='brown cluster file or cluster store directory')
+@click.option('--copies', default='1,8', help='comma separated sizes of the documents in copies of the sample')
+@click.option('--synthetic', default='', help='comma separated numbers of EDUs of synthetic documents')
+@click.option('--repeat', default=5, type=int, help='number of timed repetitions of each benchmark')
+@click.option('--filter', 'pattern', default=None, help='only run benchmarks whose name matches this regex')
+@click.option('--compare', 'baseline', default=None, type=str, help='JSON results to compare with')
+@click.option('--max_slowdown', default=1.2, type=float, help='ratio to the compared median counted as regression')
+def main(output, model_dir, brown_clusters, copies, synthetic, repeat, pattern, baseline, max_slowdown):
+    logging.basicConfig(level=logging.INFO)
+    sys.setrecursionlimit(10000)
+    bcvocab = load_brown_clusters(brown_clusters)
+    with open(SAMPLE + '.merge') as fin:
+        merge_text = fin.read()
+    with open(SAMPLE + '.dis') as fin:
+        dis_text = fin.read()
+    if model_dir:
+        rst_parser = RstParser.load(model_dir).build_index()
+    else:
+        # two copies of the sample, so there are relations between paragraphs
+        logging.info('Train a model on two copies of the sample document ...')
+        train_merge, train_dis = concat_documents(merge_text, dis_text, 2)
+        rst_tree = RstTree(RstTree.build_tree(train_dis, binarize=True), Doc.from_file(io.StringIO(train_merge)))
+        rst_parser = RstParser.from_data([rst_tree], bcvocab)
+        rst_parser.train([rst_tree], bcvocab)
+    documents = [(f'file1x{n_copies}',) + concat_documents(merge_text, dis_text, n_copies)
+                 for n_copies in parse_sizes(copies)]
+    documents += [(f'synthetic{n_edus}',) + generate_document(n_edus) for n_edus in parse_sizes(synthetic)]
+    results = []
+    for doc_name, doc_merge, doc_dis in documents:
+        n_edus = len(Doc.from_file(doc_merge.splitlines()).edu_dict)
+        for name, func, setup in document_benchmarks(doc_name, doc_merge, doc_dis, rst_parser, bcvocab):
+            if pattern and not re.search(pattern, name):
+                continue
+            times, number = measure(func, setup, repeat)
+            result = {'name': name, 'n_edus': n_edus, 'repeat': repeat, 'number': number,
+                      'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times),
+                      'stdev': statistics.stdev(times) if len(times) > 1 else 0.0}
+            results.append(result)
+            print(f'{name:60}\t{n_edus:6d} EDUs\tmedian {1000 * result["median"]:10.3f} ms\t'
+                  f'min {1000 * result["min"]:10.3f} ms')
+    if output:
+        with open(output, 'w') as fout:
+            json.dump({'environment': environment(), 'results': results}, fout, indent=1)
+    if baseline:
+        with open(baseline) as fin:
+            regressions = compare(results, json.load(fin), max_slowdown)
+        if regressions:
+            print('Slower than {:.2f}x the baseline: {}'.format(max_slowdown, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
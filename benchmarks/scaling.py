@@ -0,0 +1,110 @@
+""" Scaling report of parsing and training sample generation
+
+Synthetic documents of increasing size are parsed with sr_parse and turned
+into training samples. The times are fitted with a power law t = a * n^b
+over the number of EDUs n and compared with linear, n log n and quadratic
+growth:
+
+    python3 -m benchmarks.scaling --sizes 100,300,1000,3000,10000 -o scaling.json
+"""
+import io
+import json
+import logging
+import statistics
+import sys
+
+import click
+import numpy
+
+from benchmarks.run import environment, measure, parse_sizes
+from benchmarks.synthetic import ROOT, generate_document, load_vocabulary
+from stagedp.models.parser import RstParser
+from stagedp.models.samples import generate_samples
+from stagedp.models.tree import RstTree
+from stagedp.utils.brown import load_brown_clusters
+from stagedp.utils.document import Doc
+
+# Candidate growth functions of the complexity fit
+GROWTH = (('n', lambda n: n), ('n log n', lambda n: n * numpy.log(n)), ('n^2', lambda n: n ** 2))
+
+
+def fit_complexity(sizes, times):
+    """ Exponent b of the least squares fit of log t = log a + b log n, and
+        the candidate growth function with the smallest relative error
+        when scaled to the times
+    """
+    sizes, times = numpy.asarray(sizes, dtype=float), numpy.asarray(times, dtype=float)
+    exponent = float(numpy.polyfit(numpy.log(sizes), numpy.log(times), 1)[0]) if len(sizes) > 1 else None
+    errors = {}
+    for name, growth in GROWTH:
+        values = growth(sizes)
+        # least squares scale of the relative error (times - c * values) / times
+        scale = numpy.sum(values / times) / numpy.sum((values / times) ** 2)
+        errors[name] = float(numpy.sqrt(numpy.mean((1 - scale * values / times) ** 2)))
+    return exponent, min(errors, key=errors.get), errors
+
+
+def train_parser(bcvocab, vocabulary, n_docs=3, n_edus=200):
+    """ Train a parser on small synthetic documents
+    """
+    rst_trees = []
+    for seed in range(n_docs):
+        merge_text, dis_text = generate_document(n_edus, seed=1000 + seed, vocabulary=vocabulary)
+        rst_trees.append(RstTree(RstTree.build_tree(dis_text, binarize=True), Doc.from_file(io.StringIO(merge_text))))
+    rst_parser = RstParser.from_data(rst_trees, bcvocab)
+    rst_parser.train(rst_trees, bcvocab)
+    return rst_parser
+
+
+@click.command()
+@click.option('-o', '--output', default=None, type=str, help='write the results as JSON into this file')
+@click.option('--sizes', default='100,300,1000,3000', help='comma separated numbers of EDUs of the documents')
+@click.option('--model_dir', default=None, help='model to parse with, a model is trained on synthetic documents otherwise')
+@click.option('--brown_clusters', default=ROOT + '/data/resources/bc3200.pickle.gz',
+              help='brown cluster file or cluster store directory')
+@click.option('--repeat', default=3, type=int, help='number of timed repetitions at each size')
+@click.option('--seed', default=0, type=int, help='seed of the synthetic documents')
+def main(output, sizes, model_dir, brown_clusters, repeat, seed):
+    logging.basicConfig(level=logging.INFO)
+    sys.setrecursionlimit(100000)
+    bcvocab = load_brown_clusters(brown_clusters)
+    vocabulary = load_vocabulary()
+    if model_dir:
+        rst_parser = RstParser.load(model_dir).build_index()
+    else:
+        logging.info('Train a model on synthetic documents ...')
+        rst_parser = train_parser(bcvocab, vocabulary)
+    sizes = parse_sizes(sizes)
+    timings = {'sr_parse': [], 'generate_samples': []}
+    for n_edus in sizes:
+        merge_text, dis_text = generate_document(n_edus, seed=seed, vocabulary=vocabulary)
+        doc = Doc.from_file(io.StringIO(merge_text))
+
+        def gold_tree():
+            return RstTree(RstTree.build_tree(dis_text, binarize=True), doc),
+
+        def samples(rst_tree):
+            for _ in generate_samples(rst_tree, bcvocab):
+                pass
+
+        for name, func, setup in (('sr_parse', lambda: rst_parser.sr_parse(doc, bcvocab), lambda: ()),
+                                  ('generate_samples', samples, gold_tree)):
+            times, _ = measure(func, setup, repeat)
+            timings[name].append(statistics.median(times))
+            print(f'{name:20}\t{n_edus:6d} EDUs\t{len(doc):7d} tokens\tmedian {statistics.median(times):9.3f} s\t'
+                  f'{1000 * statistics.median(times) / n_edus:7.3f} ms per EDU')
+    results = {}
+    for name, times in timings.items():
+        exponent, best, errors = fit_complexity(sizes, times)
+        results[name] = {'sizes': sizes, 'median': times, 'exponent': exponent, 'best_fit': best,
+                         'relative_errors': errors}
+        exponent = f'{exponent:.2f}' if exponent is not None else '-'
+        print(f'{name:20}\tt ~ n^{exponent}\tbest fit {best}\t' +
+              '\t'.join(f'{growth} {error:.3f}' for growth, error in errors.items()))
+    if output:
+        with open(output, 'w') as fout:
+            json.dump({'environment': environment(), 'results': results}, fout, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+""" Generator of synthetic *.merge and *.dis document pairs of any size
+
+The words are drawn from a sample document, every sentence gets a random
+projective dependency tree and the discourse tree is a random binary tree
+whose spans respect the sentence and paragraph borders, like most trees of
+the RST-DT, with relations typical for their level:
+
+    python3 -m benchmarks.synthetic OUT_DIR --n_edus 1000 --n_docs 3
+"""
+import os
+import random
+
+import click
+
+from stagedp.utils.document import Doc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_MERGE = os.path.join(ROOT, 'data', 'samples', 'file1.merge')
+
+# Share of the relation forms of binary nodes
+FORMS = (('NS', 0.6), ('SN', 0.15), ('NN', 0.25))
+# Relations by level of the node (within a sentence, between sentences,
+# between paragraphs) and by form
+LEVEL_RELATIONS = (
+    {'NS': ('elaboration-object-attribute-e', 'purpose', 'condition', 'means', 'circumstance'),
+     'SN': ('attribution', 'condition', 'circumstance', 'concession'),
+     'NN': ('Same-Unit', 'List', 'Sequence')},
+    {'NS': ('elaboration-additional', 'evidence', 'explanation-argumentative', 'example', 'consequence-s'),
+     'SN': ('background', 'concession', 'cause'),
+     'NN': ('List', 'Contrast', 'Sequence')},
+    {'NS': ('elaboration-additional', 'background', 'evaluation-s', 'summary-s'),
+     'SN': ('background', 'antithesis'),
+     'NN': ('List', 'Topic-Shift', 'TextualOrganization')},
+)
+# Dependency labels by the first letters of the POS tag
+DEPENDENCY_LABELS = {'NN': ('nsubj', 'obj', 'nmod', 'compound', 'conj'), 'JJ': ('amod',), 'DT': ('det',),
+                     'IN': ('case', 'mark'), 'RB': ('advmod',), 'VB': ('ccomp', 'xcomp', 'advcl', 'conj', 'aux'),
+                     'CC': ('cc',), 'PR': ('nsubj', 'obj', 'nmod:poss'), 'CD': ('nummod',), 'TO': ('mark',),
+                     'MD': ('aux',)}
+
+
+def load_vocabulary(fmerge=SAMPLE_MERGE):
+    """ (word, lemma, POS tag) of every word token of a *.merge file,
+        punctuation and brackets are left out
+    """
+    with open(fmerge) as fin:
+        doc = Doc.from_file(fin)
+    return [(word, lemma, pos) for word, lemma, pos in zip(doc.word.tolist(), doc.lemma.tolist(), doc.pos.tolist())
+            if word.isalnum() or ('-' in word and word.replace('-', '').isalnum())]
+
+
+def partition(n_items, n_parts, rng):
+    """ Random sizes of n_parts non-empty consecutive parts of n_items items
+    """
+    cuts = sorted(rng.sample(range(1, n_items), n_parts - 1))
+    return [stop - start for start, stop in zip([0] + cuts, cuts + [n_items])]
+
+
+def dependency_heads(n_tokens, rng):
+    """ Heads (1-based, 0 for the root) of a random projective dependency
+        tree over n_tokens tokens
+    """
+    heads = [0] * n_tokens
+    spans = [(0, n_tokens - 1, -1)]
+    while spans:
+        start, end, parent = spans.pop()
+        if start > end:
+            continue
+        head = rng.randint(start, end)
+        heads[head] = parent + 1
+        spans.append((start, head - 1, head))
+        spans.append((head + 1, end, head))
+    return heads
+
+
+def dependency_label(pos, head, rng):
+    if head == 0:
+        return 'root'
+    if not pos[0].isalpha():
+        return 'punct'
+    return rng.choice(DEPENDENCY_LABELS.get(pos[:2], ('dep',)))
+
+
+def random_binary_tree(children, level, rng):
+    """ Combine the subtrees children into one random binary tree by random
+        shift and reduce steps, the new nodes get relations of level
+
+    A node is a list [first EDU, last EDU, left child, right child, form,
+    relation], a leaf is the number of its EDU.
+    """
+    stack, idx = [], 0
+    while idx < len(children) or len(stack) > 1:
+        if len(stack) >= 2 and (idx == len(children) or rng.random() < 0.5):
+            rnode, lnode = stack.pop(), stack.pop()
+            form = rng.choices([form for form, _ in FORMS], [weight for _, weight in FORMS])[0]
+            relation = rng.choice(LEVEL_RELATIONS[level][form])
+            stack.append([span_of(lnode)[0], span_of(rnode)[1], lnode, rnode, form, relation])
+        else:
+            stack.append(children[idx])
+            idx += 1
+    return stack[0]
+
+
+def span_of(node):
+    return (node, node) if isinstance(node, int) else (node[0], node[1])
+
+
+def dis_text(tree, edu_texts):
+    """ *.dis text of a binary tree of random_binary_tree
+    """
+    lines = []
+    # (node, nuclearity, relation to the parent, depth), strings close a span
+    todo = [(tree, 'Root', None, 0)]
+    while todo:
+        item = todo.pop()
+        if isinstance(item, str):
+            lines.append(item)
+            continue
+        node, prop, relation, depth = item
+        indent = '  ' * depth
+        rel2par = f' (rel2par {relation})' if relation else ''
+        if isinstance(node, int):
+            lines.append(f'{indent}( {prop} (leaf {node}){rel2par} (text _!{edu_texts[node - 1]}_!) )')
+            continue
+        first, last, lnode, rnode, form, node_relation = node
+        lines.append(f'{indent}( {prop} (span {first} {last}){rel2par}')
+        if form == 'NS':
+            children = [(lnode, 'Nucleus', 'span'), (rnode, 'Satellite', node_relation)]
+        elif form == 'SN':
+            children = [(lnode, 'Satellite', node_relation), (rnode, 'Nucleus', 'span')]
+        else:
+            children = [(lnode, 'Nucleus', node_relation), (rnode, 'Nucleus', node_relation)]
+        todo.append(f'{indent})')
+        for child, child_prop, child_relation in reversed(children):
+            todo.append((child, child_prop, child_relation, depth + 1))
+    return '\n'.join(lines) + '\n'
+
+
+def generate_document(n_edus, n_sentences=None, n_paragraphs=None, seed=0, vocabulary=None):
+    """ Synthesize a document with a gold discourse tree
+
+    :type n_edus: int
+    :param n_edus: number of EDUs, at least 2
+
+    :type n_sentences: int
+    :param n_sentences: number of sentences, about 2.5 EDUs per sentence
+                        by default as in the RST-DT
+
+    :type n_paragraphs: int
+    :param n_paragraphs: number of paragraphs, about 3 sentences per
+                         paragraph by default
+
+    :type vocabulary: list
+    :param vocabulary: (word, lemma, POS tag) triples to draw the words
+                       from, the words of the sample document by default
+
+    :return: the *.merge and the *.dis text of the document
+    """
+    if n_sentences is None:
+        n_sentences = max(1, round(n_edus / 2.5))
+    if n_paragraphs is None:
+        n_paragraphs = max(1, round(n_sentences / 3))
+    if not 2 <= n_edus or not 1 <= n_sentences <= n_edus or not 1 <= n_paragraphs <= n_sentences:
+        raise ValueError('A document needs at least 2 EDUs, 1 <= sentences <= EDUs and 1 <= paragraphs <= sentences')
+    rng = random.Random(seed)
+    vocabulary = vocabulary or load_vocabulary()
+    sentence_edus = partition(n_edus, n_sentences, rng)
+    merge_lines, edu_texts, paragraph_trees = [], [], []
+    sent_i, edu_i = 0, 0
+    for par_i, par_sentences in enumerate(partition(n_sentences, n_paragraphs, rng), 1):
+        sentence_trees = []
+        for _ in range(par_sentences):
+            tokens, edus = [], []
+            for edu_pos in range(sentence_edus[sent_i]):
+                edu_i += 1
+                edu_tokens = [rng.choice(vocabulary) for _ in range(rng.randint(3, 15))]
+                if edu_pos == sentence_edus[sent_i] - 1:
+                    edu_tokens.append(('.', '.', '.'))
+                elif rng.random() < 0.3:
+                    edu_tokens.append((',', ',', ','))
+                edu_texts.append(' '.join(word for word, _, _ in edu_tokens))
+                tokens += [(word, lemma, pos, edu_i) for word, lemma, pos in edu_tokens]
+                edus.append(edu_i)
+            heads = dependency_heads(len(tokens), rng)
+            for tok_i, ((word, lemma, pos, tok_edu), head) in enumerate(zip(tokens, heads), 1):
+                merge_lines.append('\t'.join(map(str, [sent_i, tok_i, word, lemma, pos, pos,
+                                                       dependency_label(pos, head, rng), head, '_', '_',
+                                                       tok_edu, par_i])))
+            sentence_trees.append(random_binary_tree(edus, 0, rng))
+            sent_i += 1
+        paragraph_trees.append(random_binary_tree(sentence_trees, 1, rng))
+    tree = random_binary_tree(paragraph_trees, 2, rng)
+    return '\n'.join(merge_lines) + '\n', dis_text(tree, edu_texts)
+
+
+@click.command()
+@click.argument('output_dir', type=str)
+@click.option('--n_edus', default=1000, type=int, help='number of EDUs per document')
+@click.option('--n_sentences', default=None, type=int, help='number of sentences per document')
+@click.option('--n_paragraphs', default=None, type=int, help='number of paragraphs per document')
+@click.option('--n_docs', default=1, type=int, help='number of documents')
+@click.option('--seed', default=0, type=int, help='seed of the first document, the others use the following seeds')
+def main(output_dir, n_edus, n_sentences, n_paragraphs, n_docs, seed):
+    os.makedirs(output_dir, exist_ok=True)
+    vocabulary = load_vocabulary()
+    for doc_i in range(n_docs):
+        merge_text, dis = generate_document(n_edus, n_sentences, n_paragraphs, seed + doc_i, vocabulary)
+        fname = os.path.join(output_dir, f'synthetic{n_edus}_{seed + doc_i}')
+        with open(fname + '.merge', 'w') as fout:
+            fout.write(merge_text)
+        with open(fname + '.dis', 'w') as fout:
+            fout.write(dis)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,14 @@
 ## Date: 01-27-2015
 ## Time-stamp: <yangfeng 01/30/2015 22:16:26>
 
-from cPickle import dump
 import gzip
+import sys
+from pickle import dump
+
 
 def reader(fname):
     bcvocab = {}
-    with open(fname, 'r') as fin:
+    with open(fname, 'r', encoding='utf-8') as fin:
         for line in fin:
             items = line.strip().split('\t')
             bcvocab[items[1]] = items[0]
@@ -16,11 +18,29 @@ def reader(fname):
 
 
 def savevocab(vocab, fname):
-    with gzip.open(fname, 'w') as fout:
+    with gzip.open(fname, 'wb') as fout:
         dump(vocab, fout)
     print('Done')
 
 
+def savestore(fname, store_dir):
+    """ Convert the cluster text file or the pickled vocab into a
+        memory-mapped cluster store
+    """
+    from stagedp.utils.brown import BrownClusters
+    if fname.endswith('.pickle.gz'):
+        store = BrownClusters.from_pickle(fname)
+    else:
+        store = BrownClusters.from_text(fname)
+    store.save(store_dir)
+    print('Done')
+
+
 if __name__ == '__main__':
-    vocab = reader("./bc-3200.txt")
-    savevocab(vocab, "./bc3200.pickle.gz")
+    if len(sys.argv) == 3:
+        # PYTHONPATH=. python data/resources/bcreader.py data/resources/bc3200.pickle.gz data/resources/bc3200
+        # from the repository root, stagedp has to be importable
+        savestore(sys.argv[1], sys.argv[2])
+    else:
+        vocab = reader("./bc-3200.txt")
+        savevocab(vocab, "./bc3200.pickle.gz")
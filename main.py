@@ -1,32 +1,61 @@
-import gzip
 import logging
-import pickle
 
 import click
 
 from stagedp.eval.evaluation import Evaluator
+from stagedp.eval.metrics import Metrics
+from stagedp.features.store import FeatureStore
 from stagedp.models.parser import RstParser
-from stagedp.models.tree import RstTree
+from stagedp.models.samples import TrainingSamples
+from stagedp.models.streaming import StreamingTrainer
+from stagedp.models.tree import RstTree, TREE_CACHE_VERSION
+from stagedp.utils.brown import load_brown_clusters
+from stagedp.utils.cache import TreeCache
 
 
 @click.command()
 @click.option('--train_dir', default='', help='train data directory')
 @click.option('--test_dir', default='', help='test data directory')
 @click.option('--model_dir', help='model directory')
-@click.option('--brown_clusters', default="../data/resources/bc3200.pickle.gz", help='brown cluster file')
-def main(train_dir, test_dir, model_dir, brown_clusters):
+@click.option('--brown_clusters', default="../data/resources/bc3200.pickle.gz", help='brown cluster file or cluster store directory')
+@click.option('--workers', default=1, type=int, help='number of processes for feature extraction and parsing')
+@click.option('--fit_workers', default=1, type=int,
+              help='number of models fitted at the same time, the cores are shared between them')
+@click.option('--beam_size', default=1, type=int, help='beam size for decoding, 1 for greedy decoding')
+@click.option('--native_model', is_flag=True, help='save the model as .npy files with a JSON manifest')
+@click.option('--feature_store', default=None, help='directory to keep vectorized training samples in')
+@click.option('--tree_cache', default=None, help='directory to keep the parsed training trees in')
+@click.option('--streaming', is_flag=True, help='train with feature hashing and partial_fit in bounded memory')
+@click.option('--n_features', default=1 << 18, type=int, help='width of the hashed feature space for --streaming')
+@click.option('--epochs', default=5, type=int, help='number of passes over the corpus for --streaming')
+@click.option('--batch_size', default=1000, type=int, help='number of samples per update for --streaming')
+@click.option('--metrics_file', default=None, help='save the evaluation counts of --test_dir into this JSON file')
+@click.option('--merge_metrics', multiple=True, help='report the merged evaluation counts of these JSON files')
+def main(train_dir, test_dir, model_dir, brown_clusters, workers, fit_workers, beam_size, native_model, feature_store,
+         tree_cache, streaming, n_features, epochs, batch_size, metrics_file, merge_metrics):
     logging.basicConfig(level=logging.INFO)
-    with gzip.open(brown_clusters) as fin:
-        logging.info('Load Brown clusters for creating features ...')
-        brown_clusters = pickle.load(fin)
-    if train_dir:
-        rst_train = RstTree.read_rst_trees(data_dir=train_dir)
+    if merge_metrics:
+        Metrics.reduce(Metrics.load(fname) for fname in merge_metrics).report()
+        return
+    logging.info('Load Brown clusters for creating features ...')
+    brown_clusters = load_brown_clusters(brown_clusters)
+    tree_cache = TreeCache(tree_cache, TREE_CACHE_VERSION) if tree_cache else None
+    if train_dir and streaming:
+        trainer = StreamingTrainer(RstTree.rst_files(train_dir), brown_clusters, n_features, epochs, batch_size,
+                                   tree_cache=tree_cache)
+        rst_parser = trainer.train()
+        rst_parser.save(model_dir=model_dir, native=native_model)
+    elif train_dir:
+        rst_train = RstTree.read_rst_trees(data_dir=train_dir, workers=workers, cache=tree_cache)
+        samples = TrainingSamples(rst_train, brown_clusters, FeatureStore(feature_store) if feature_store else None,
+                                   workers)
         rst_parser = RstParser.from_data(rst_train, brown_clusters)
-        rst_parser.train(rst_train, brown_clusters)
-        rst_parser.save(model_dir=model_dir)
+        rst_parser.train(rst_train, brown_clusters, samples, workers=fit_workers)
+        rst_parser.save(model_dir=model_dir, native=native_model)
     if test_dir:
         evaluator = Evaluator(model_dir=model_dir)
-        evaluator.eval_parser(path=test_dir, bcvocab=brown_clusters)
+        evaluator.eval_parser(path=test_dir, bcvocab=brown_clusters, workers=workers, beam_size=beam_size,
+                               metrics_file=metrics_file)
 
 
 if __name__ == '__main__':
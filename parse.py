@@ -1,37 +1,40 @@
-import gzip
 import io
 import logging
-import pickle
 
 import click
 from nltk import Tree
 
 from stagedp.models.parser import RstParser
-from stagedp.utils.annotation import load_parser, merge_edus_into_parses, merge_as_text
+from stagedp.utils.annotation import annotate_documents, annotator_config, load_parser, merge_as_text
+from stagedp.utils.brown import load_brown_clusters
+from stagedp.utils.cache import AnnotationCache
 from stagedp.utils.document import Doc
 
 
 @click.command()
-@click.argument('edu_file', type=str)
+@click.argument('edu_files', nargs=-1, required=True, type=str)
 @click.argument('model_path', type=str)
 @click.option('-o', '--output', default='-', type=click.File('w'))
-@click.option('--brown_clusters', default="../data/resources/bc3200.pickle.gz", help='brown cluster file')
-def main(edu_file, model_path, output, brown_clusters):
+@click.option('--brown_clusters', default="../data/resources/bc3200.pickle.gz", help='brown cluster file or cluster store directory')
+@click.option('--workers', default=1, type=int, help='number of parsing processes')
+@click.option('--beam_size', default=1, type=int, help='beam size for decoding, 1 for greedy decoding')
+@click.option('--cache', default=None, type=str, help='annotation cache file')
+@click.option('--cache_size', default=1024, type=int, help='maximum size of the annotation cache in MB')
+def main(edu_files, model_path, output, brown_clusters, workers, beam_size, cache, cache_size):
     logging.basicConfig(level=logging.INFO)
-    rst_parser = RstParser.load(model_path)
-    with gzip.open(brown_clusters) as fin:
-        logging.info('Load Brown clusters for creating features ...')
-        brown_clusters = pickle.load(fin)
+    rst_parser = RstParser.load(model_path).build_index()
+    logging.info('Load Brown clusters for creating features ...')
+    brown_clusters = load_brown_clusters(brown_clusters)
     parser = load_parser()
-    edus = [edu.strip() for edu in open(edu_file)]
-    text = ' '.join(edus).replace('<P>', '')
-    parses = parser(text)
-    parses = merge_as_text(merge_edus_into_parses(edus, parses))
-    doc = Doc.from_file(io.StringIO(parses))
-    pred_rst = rst_parser.sr_parse(doc, brown_clusters)
-    tree_str = pred_rst.get_parse()
-    pprint_tree_str = Tree.fromstring(tree_str).pformat(margin=180)
-    output.write(pprint_tree_str + "\n")
+    if cache:
+        cache = AnnotationCache(cache, annotator_config(), cache_size << 20)
+    edus_list = [[edu.strip() for edu in open(edu_file) if edu.strip()] for edu_file in edu_files]
+    docs = [Doc.from_file(io.StringIO(merge_as_text(parses)))
+            for parses in annotate_documents(parser, edus_list, cache=cache)]
+    for pred_rst in rst_parser.parse_many(docs, brown_clusters, workers=workers, beam_size=beam_size):
+        tree_str = pred_rst.get_parse()
+        pprint_tree_str = Tree.fromstring(tree_str).pformat(margin=180)
+        output.write(pprint_tree_str + "\n")
 
 
 if __name__ == '__main__':
@@ -1,13 +1,131 @@
 import glob
+import logging
 import os
 import re
+import tempfile
+import time
+from collections import defaultdict
+from multiprocessing import Pool
 
 import click
 import nltk
 from tqdm import tqdm
 
-from stagedp.utils.annotation import load_parser, merge_edus_into_parses
-from stagedp.utils.other import rel2class
+from stagedp.utils.annotation import load_parser, annotate_documents, annotator_config, download_models, \
+    split_sentences
+from stagedp.utils.cache import AnnotationCache
+from stagedp.utils.other import default_mode, rel2class
+
+
+def read_dis(dis_file):
+    """ Read a *.dis file, simplify its relation labels and extract the EDUs
+    """
+    dis_text = open(dis_file, 'r').read()
+    dis_tree = nltk.tree.Tree.fromstring(
+        re.sub(r'\s+', ' ', dis_text).replace('//TT_ERR', '').strip(),
+        leaf_pattern=r"\_!.+?\_!|[^ ()]+")
+    # convert (simplify) relation labels
+    for tt in dis_tree.subtrees(filter=lambda t: t.label() == 'rel2par'):
+        label = tt.pop()
+        tt.insert(0, rel2class.get(label.lower(), label.upper()))
+    edus = [edu[2:-2].strip() for edu in dis_tree.leaves() if edu.startswith('_!')]
+    return dis_tree, edus
+
+
+def write_atomic(fname, text):
+    """ Write into a temporary file next to fname and rename it, so fname
+        is either missing or complete
+    """
+    directory, basename = os.path.split(fname)
+    fd, tmp_name = tempfile.mkstemp(dir=directory or '.', prefix=f'.{basename}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(text)
+        os.chmod(tmp_name, default_mode())
+        os.replace(tmp_name, fname)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+
+def write_outputs(dest, dis_tree, parses):
+    # the .dis file is written last as it marks the document as done
+    write_atomic(f"{dest}.conll", ''.join(sent.serialize() for sent in parses))
+    write_atomic(f"{dest}.dis", dis_tree.pformat(margin=150).replace('<P>', ''))
+
+
+def document_batches(documents, batch_size, cross_document):
+    """ Group documents for annotation, a group holds either one document or,
+        across documents, as many documents as fit into batch_size sentences
+    """
+    if not cross_document:
+        for document in documents:
+            yield [document]
+        return
+    batch, n_sentences = [], 0
+    for document in documents:
+        doc_sentences = len(split_sentences(document[2]))
+        if batch and batch_size and n_sentences + doc_sentences > batch_size:
+            yield batch
+            batch, n_sentences = [], 0
+        batch.append(document)
+        n_sentences += doc_sentences
+    if batch:
+        yield batch
+
+
+# Annotation pipeline, cache and batch size of a worker process, set once by init_worker
+_worker_parser = None
+_worker_cache = None
+_worker_batch_size = 0
+
+
+def init_worker(batch_size, cache_settings=None, n_threads=None, download=True):
+    """ Load the pipeline and open the annotation cache of this process, the
+        cache is given by the arguments of AnnotationCache, since a SQLite
+        connection must not be shared with forked processes
+    """
+    global _worker_parser, _worker_cache, _worker_batch_size
+    if n_threads:
+        # share the cores between the workers instead of each using all of them
+        try:
+            import torch
+            torch.set_num_threads(n_threads)
+        except ImportError:
+            pass
+    _worker_parser = load_parser(download=download)
+    _worker_cache = AnnotationCache(*cache_settings) if cache_settings else None
+    _worker_batch_size = batch_size
+
+
+def process_batch(batch):
+    """ Annotate a group of documents and write their outputs, returns the
+        process id, the number of documents and sentences, the time spent and
+        the number of cache hits
+    """
+    start = time.time()
+    hits = _worker_cache.hits if _worker_cache is not None else 0
+    annotations = annotate_documents(_worker_parser, [edus for _, _, edus in batch], _worker_batch_size, _worker_cache)
+    for (dest, dis_tree, _), parses in zip(batch, annotations):
+        write_outputs(dest, dis_tree, parses)
+    if _worker_cache is not None:
+        hits = _worker_cache.hits - hits
+    return os.getpid(), len(batch), sum(len(parses) for parses in annotations), time.time() - start, hits
+
+
+def report_throughput(stats):
+    workers = defaultdict(lambda: [0, 0, 0.0, 0])
+    for pid, n_docs, n_sents, seconds, hits in stats:
+        worker = workers[pid]
+        worker[0] += n_docs
+        worker[1] += n_sents
+        worker[2] += seconds
+        worker[3] += hits
+    for worker_i, (pid, (n_docs, n_sents, seconds, hits)) in enumerate(sorted(workers.items())):
+        logging.info('Worker {} (pid {}): {} documents, {} sentences ({} cached) in {:.1f}s, '
+                     '{:.2f} documents/s, {:.1f} sentences/s'.format(worker_i, pid, n_docs, n_sents, hits, seconds,
+                                                                    n_docs / max(seconds, 1e-9),
+                                                                    n_sents / max(seconds, 1e-9)))
 
 
 @click.command()
@@ -15,45 +133,45 @@ from stagedp.utils.other import rel2class
 @click.argument('target-path', type=str)
 @click.option('-r', '--replace-exist', is_flag=True)
 @click.option('-d', '--delete-target', is_flag=True)
-def main(source_path: str, target_path: str, replace_exist: bool, delete_target: bool):
+@click.option('-b', '--batch-size', default=256, type=int, help='maximum number of sentences per annotation call')
+@click.option('-c', '--cross-document', is_flag=True, help='annotate sentences of several documents together')
+@click.option('--cache', default=None, type=str, help='annotation cache file')
+@click.option('--cache-size', default=1024, type=int, help='maximum size of the annotation cache in MB')
+@click.option('-w', '--workers', default=1, type=int, help='number of annotation processes')
+def main(source_path: str, target_path: str, replace_exist: bool, delete_target: bool, batch_size: int,
+         cross_document: bool, cache: str, cache_size: int, workers: int):
+    logging.basicConfig(level=logging.INFO)
     if delete_target:
         for fn in os.listdir(target_path):
             os.remove(os.path.join(target_path, fn))
     os.makedirs(target_path, exist_ok=True)
-    parser = load_parser()
+    cache_settings = (cache, annotator_config(), cache_size << 20) if cache else None
     dis_files = glob.glob(f'{source_path}/*.dis')
-    for dis_file in tqdm(dis_files):
+    documents = []
+    for dis_file in dis_files:
         dest = os.path.join(target_path, os.path.basename(f"{dis_file[:-len('.dis')]}"))
         if not replace_exist and os.path.exists(f"{dest}.dis"):
             continue
-        dis_text = open(dis_file, 'r').read()
-        dis_tree = nltk.tree.Tree.fromstring(
-            re.sub(r'\s+', ' ', dis_text).replace('//TT_ERR', '').strip(),
-            leaf_pattern=r"\_!.+?\_!|[^ ()]+")
-        # convert (simplify) relation labels
-        for tt in dis_tree.subtrees(filter=lambda t: t.label() == 'rel2par'):
-            label = tt.pop()
-            tt.insert(0, rel2class.get(label.lower(), label.upper()))
-        edus = [edu[2:-2].strip() for edu in dis_tree.leaves() if edu.startswith('_!')]
-        sentences = []
-        edus_tmp = []
-        for edu in edus:
-            edu = edu.replace('<P>', '')
-            edus_tmp.append(edu)
-            if edu[-1] in ".!?":
-                sentences.append(' '.join(edus_tmp))
-                edus_tmp = []
-        if edus_tmp:
-            sentences.append(' '.join(edus_tmp))
-        parses = [parser(sent).sentences[0] for sent in sentences]
-        # text = ' '.join(edus).replace('<P>', '')
-        # parses = parser(parsed_sents, is_sent=True)
-        parses = merge_edus_into_parses(edus, parses)
-        with open(f"{dest}.dis", 'w') as fh:
-            fh.write(dis_tree.pformat(margin=150).replace('<P>', ''))
-        with open(f"{dest}.conll", 'w') as fh:
-            for sent in parses:
-                fh.write(sent.serialize())
+        dis_tree, edus = read_dis(dis_file)
+        documents.append((dest, dis_tree, edus))
+    batches = document_batches(documents, batch_size, cross_document)
+    stats = []
+    with tqdm(total=len(documents)) as progress:
+        if workers > 1:
+            # models are fetched once before the workers load them
+            download_models()
+            n_threads = max(1, (os.cpu_count() or 1) // workers)
+            with Pool(workers, initializer=init_worker,
+                      initargs=(batch_size, cache_settings, n_threads, False)) as pool:
+                for stat in pool.imap_unordered(process_batch, batches):
+                    stats.append(stat)
+                    progress.update(stat[1])
+        else:
+            init_worker(batch_size, cache_settings)
+            for batch in batches:
+                stats.append(process_batch(batch))
+                progress.update(len(batch))
+    report_throughput(stats)
 
 
 if __name__ == '__main__':
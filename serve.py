@@ -0,0 +1,253 @@
+import io
+import json
+import logging
+import os
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+from conllu import parse as parse_conll
+
+from stagedp.models.parser import RstParser
+from stagedp.utils.annotation import annotate_documents, annotator_config, load_parser, merge_as_text
+from stagedp.utils.batching import MicroBatcher
+from stagedp.utils.brown import load_brown_clusters
+from stagedp.utils.cache import AnnotationCache
+from stagedp.utils.document import Doc
+
+OUTPUT_FORMATS = ('dis', 'bracket', 'json')
+INPUT_FIELDS = ('edus', 'merge', 'conll')
+
+
+class ParseService:
+    """ Keeps the annotation pipeline, the parser and the Brown clusters in
+        memory and parses batches of documents
+
+    A document is given by exactly one of
+        edus: list of EDU strings, paragraph ends marked by <P>
+        merge: content of a *.merge file
+        conll: CoNLL-U annotation written by preprocess.py
+    """
+
+    def __init__(self, rst_parser, bcvocab, annotator=None, beam_size=1, cache=None, workers=1):
+        self.rst_parser = rst_parser
+        self.bcvocab = bcvocab
+        self.annotator = annotator
+        self.cache = cache
+        self.beam_size = beam_size
+        # worker processes parsing the documents of a batch in parallel
+        self.pool = rst_parser.worker_pool(bcvocab, workers, beam_size) if workers > 1 else None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    @staticmethod
+    def check_request(request):
+        """ Raise ValueError for malformed document requests
+        """
+        if not isinstance(request, dict):
+            raise ValueError('A document has to be a JSON object')
+        fields = [field for field in INPUT_FIELDS if field in request]
+        if len(fields) != 1:
+            raise ValueError('A document needs exactly one of the fields {}'.format(', '.join(INPUT_FIELDS)))
+        if 'edus' in request and (not isinstance(request['edus'], list) or not request['edus'] or not all(
+                isinstance(edu, str) and edu.replace('<P>', '').strip() for edu in request['edus'])):
+            raise ValueError('edus has to be a non-empty list of non-empty strings')
+        if request.get('format', 'dis') not in OUTPUT_FORMATS:
+            raise ValueError('format has to be one of {}'.format(', '.join(OUTPUT_FORMATS)))
+
+    def annotate(self, edu_lists):
+        """ Annotate the EDU lists with one pipeline call, if that fails each
+            EDU list is annotated on its own, so the error of one document
+            does not fail the other documents of the batch
+
+        :return: *.merge text or an exception per EDU list
+        """
+        try:
+            return [merge_as_text(sentences)
+                    for sentences in annotate_documents(self.annotator, edu_lists, cache=self.cache)]
+        except Exception as e:
+            if len(edu_lists) == 1:
+                logging.exception('Annotation failed')
+                return [e]
+            logging.exception('Annotation of the batch failed, annotate the documents one by one')
+        docs = []
+        for edus in edu_lists:
+            try:
+                docs.append(merge_as_text(annotate_documents(self.annotator, [edus], cache=self.cache)[0]))
+            except Exception as e:
+                logging.exception('Annotation failed')
+                docs.append(e)
+        return docs
+
+    def start_parse(self, doc):
+        """ Start parsing the *.merge text doc, in a worker process if the
+            service has a pool, returns a function that waits for the tree
+        """
+        doc = Doc.from_file(io.StringIO(doc))
+        if self.pool is None:
+            pred_rst = self.rst_parser.sr_parse(doc, self.bcvocab, self.beam_size)
+            return lambda: pred_rst
+        return self.rst_parser.parse_async(self.pool, doc).get
+
+    def parse_batch(self, requests):
+        """ Annotate all EDU lists of the batch with one pipeline call and
+            parse the documents, in parallel with a pool of workers, returns a
+            result or an exception per request
+        """
+        docs = [None] * len(requests)
+        edu_requests = [idx for idx, request in enumerate(requests) if 'edus' in request]
+        if edu_requests:
+            if self.annotator is None:
+                for idx in edu_requests:
+                    docs[idx] = ValueError('The service runs without annotator, send merge or conll documents')
+            else:
+                for idx, doc in zip(edu_requests, self.annotate([requests[idx]['edus'] for idx in edu_requests])):
+                    docs[idx] = doc
+        for idx, request in enumerate(requests):
+            if 'merge' in request:
+                docs[idx] = request['merge']
+            elif 'conll' in request:
+                try:
+                    docs[idx] = merge_as_text(parse_conll(request['conll']))
+                except Exception as e:
+                    docs[idx] = e
+        # all documents are handed to the workers before waiting for the first tree
+        for idx, doc in enumerate(docs):
+            if isinstance(doc, Exception):
+                continue
+            try:
+                docs[idx] = self.start_parse(doc)
+            except Exception as e:
+                logging.exception('Parsing failed')
+                docs[idx] = e
+        results = []
+        for request, doc in zip(requests, docs):
+            if isinstance(doc, Exception):
+                results.append(doc)
+                continue
+            try:
+                results.append(self.format_tree(doc(), request.get('format', 'dis')))
+            except Exception as e:
+                logging.exception('Parsing failed')
+                results.append(e)
+        return results
+
+    @staticmethod
+    def format_tree(pred_rst, output_format):
+        if output_format == 'bracket':
+            return [[list(span), prop, relation] for span, prop, relation in pred_rst.bracketing()]
+        if output_format == 'json':
+            return pred_rst.get_dict()
+        return pred_rst.get_parse()
+
+
+class ParseRequestHandler(BaseHTTPRequestHandler):
+    """ POST /parse with a document object or {"documents": [...]},
+        GET /health for the batching statistics
+    """
+    # MicroBatcher around ParseService.parse_batch
+    batcher = None
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_json(404, {'error': 'not found'})
+        self.send_json(200, {'status': 'ok',
+                             'batches': self.batcher.n_batches,
+                             'documents': self.batcher.n_items})
+
+    def do_POST(self):
+        if self.path != '/parse':
+            return self.send_json(404, {'error': 'not found'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            requests = body['documents'] if isinstance(body, dict) and 'documents' in body else [body]
+            for request in requests:
+                ParseService.check_request(request)
+        except (ValueError, TypeError) as e:
+            return self.send_json(400, {'error': str(e)})
+        futures = [self.batcher.submit(request) for request in requests]
+        results = []
+        for future in futures:
+            try:
+                results.append({'tree': future.result()})
+            except Exception as e:
+                results.append({'error': str(e)})
+        status = 200 if all('tree' in result for result in results) else 500
+        if isinstance(body, dict) and 'documents' in body:
+            self.send_json(status, {'results': results})
+        else:
+            self.send_json(status, results[0])
+
+    def send_json(self, status, data):
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.address_string(), format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+@click.command()
+@click.argument('model_path', type=str)
+@click.option('--brown_clusters', default="../data/resources/bc3200.pickle.gz",
+              help='brown cluster file or cluster store directory')
+@click.option('--host', default='127.0.0.1', help='address to listen on')
+@click.option('--port', default=8000, type=int, help='port to listen on')
+@click.option('--socket', 'socket_path', default=None, type=str, help='listen on this Unix socket instead')
+@click.option('--max_batch_size', default=16, type=int, help='maximum number of documents per batch')
+@click.option('--max_wait', default=10.0, type=float, help='maximum time in ms to wait for a batch to fill')
+@click.option('--beam_size', default=1, type=int, help='beam size for decoding, 1 for greedy decoding')
+@click.option('--workers', default=1, type=int, help='number of processes parsing the documents of a batch')
+@click.option('--annotate/--no-annotate', default=True, help='load the stanza pipeline to accept EDU lists')
+@click.option('--cache', default=None, type=str, help='annotation cache file')
+@click.option('--cache_size', default=1024, type=int, help='maximum size of the annotation cache in MB')
+def main(model_path, brown_clusters, host, port, socket_path, max_batch_size, max_wait, beam_size, workers, annotate,
+         cache, cache_size):
+    logging.basicConfig(level=logging.INFO)
+    rst_parser = RstParser.load(model_path).build_index()
+    logging.info('Load Brown clusters for creating features ...')
+    brown_clusters = load_brown_clusters(brown_clusters)
+    annotator = None
+    if annotate:
+        annotator = load_parser()
+        if cache:
+            cache = AnnotationCache(cache, annotator_config(), cache_size << 20)
+    # the workers are forked before the server threads are started
+    service = ParseService(rst_parser, brown_clusters, annotator, beam_size, cache if annotate else None, workers)
+    ParseRequestHandler.batcher = MicroBatcher(service.parse_batch, max_batch_size, max_wait / 1000)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, ParseRequestHandler)
+        logging.info('Serving on unix socket {}'.format(socket_path))
+    else:
+        server = ThreadingHTTPServer((host, port), ParseRequestHandler)
+        logging.info('Serving on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ParseRequestHandler.batcher.close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
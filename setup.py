@@ -8,5 +8,5 @@ setup(
     author_email="rene.knaebel@uni-potsdam.de",
     license="MIT",
     url="https://github.com/rknaebel/stagedp",
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'tests']),
     keywords="nlp discourse analysis rst parser")
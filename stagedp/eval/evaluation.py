@@ -1,5 +1,7 @@
+import logging
 import os
 import sys
+import time
 
 from nltk import Tree
 
@@ -12,7 +14,7 @@ from stagedp.utils.document import Doc
 class Evaluator:
     def __init__(self, model_dir):
         sys.stderr.write('Load parsing models ...\n')
-        self.parser = RstParser.load(model_dir)
+        self.parser = RstParser.load(model_dir).build_index()
 
     def parse(self, doc):
         """ Parse one document using the given parsing models"""
@@ -26,23 +28,36 @@ class Evaluator:
             for item in brackets:
                 fout.write(str(item) + '\n')
 
-    def eval_parser(self, path, bcvocab=None):
-        """ Test the parsing performance"""
+    def eval_parser(self, path, bcvocab=None, workers=1, beam_size=1, metrics_file=None):
+        """ Test the parsing performance, the metrics are returned and, with
+            metrics_file, saved for merging with the metrics of other shards
+
+        Each document is scored and its brackets are written as soon as it is
+        parsed, the gold tree is built over the document of the prediction.
+        """
         met = Metrics()
-        for fmerge, pred_rst in self.parse_docs(path, bcvocab):
-            pred_brackets = pred_rst.bracketing()
-            fbrackets = fmerge.replace('.merge', '.brackets')
+        start = time.perf_counter()
+        n_docs, n_steps = 0, 0
+        for fmerge, pred_rst in self.parse_docs(path, bcvocab, workers, beam_size):
             # Write brackets into file
-            Evaluator.writebrackets(fbrackets, pred_brackets)
-            fdis = fmerge.replace('.merge', '.dis')
-            gold_rst = RstTree.from_file(fdis, fmerge)
+            Evaluator.writebrackets(fmerge.replace('.merge', '.brackets'), pred_rst.bracketing())
+            gold_rst = RstTree.from_dis(fmerge.replace('.merge', '.dis'), pred_rst.doc)
             met.eval(gold_rst, pred_rst)
+            n_docs += 1
+            # A document with n EDUs takes 2n - 1 transitions
+            n_steps += 2 * len(pred_rst.doc.edu_dict) - 1
+        elapsed = time.perf_counter() - start
+        logging.info('Parsed and evaluated {} documents with beam size {} in {:.2f}s, {:.3f} ms per transition'.format(
+            n_docs, beam_size, elapsed, 1000 * elapsed / max(n_steps, 1)))
+        if metrics_file:
+            met.save(metrics_file)
         met.report()
+        return met
 
-    def draw_parse_results(self, path, bcvocab=None):
+    def draw_parse_results(self, path, bcvocab=None, workers=1, beam_size=1):
         from nltk.draw.tree import TreeWidget
         from nltk.draw.util import CanvasFrame
-        for fmerge, pred_rst in self.parse_docs(path, bcvocab):
+        for fmerge, pred_rst in self.parse_docs(path, bcvocab, workers, beam_size):
             fname = fmerge.replace(".merge", ".ps")
             tree_str = pred_rst.get_parse()
             if not fname.endswith(".ps"):
@@ -62,10 +77,20 @@ class Evaluator:
             with open(fmerge.replace(".merge", ".parse"), 'w') as fout:
                 fout.write(pprint_tree_str)
 
-    def parse_docs(self, path, bcvocab=None):
-        preds = []
+    def parse_docs(self, path, bcvocab=None, workers=1, beam_size=1):
+        """ Parse the *.merge files of path, yields (fmerge, RstTree) pairs
+            in order as the documents are parsed
+
+        The documents are read from disk only when they are handed to the
+        parser, so only the documents in flight are kept in memory, with
+        workers > 1 at most the max_pending documents of parse_many.
+        """
         doclist = [os.path.join(path, fname) for fname in os.listdir(path) if fname.endswith('.merge')]
-        for fmerge in doclist:
-            doc = Doc.from_file(open(fmerge))
-            preds.append((fmerge, self.parser.sr_parse(doc, bcvocab)))
-        return preds
+
+        def read_docs():
+            for fmerge in doclist:
+                with open(fmerge) as fin:
+                    doc = Doc.from_file(fin)
+                yield doc
+
+        yield from zip(doclist, self.parser.parse_many(read_docs(), bcvocab, workers=workers, beam_size=beam_size))
@@ -1,22 +1,106 @@
+import json
+
 import numpy
 
+# Columns of the bracket arrays
+START, END, NUCLEARITY, RELATION, LEVEL = range(5)
+NUCLEARITY_IDS = {'Nucleus': 0, 'Satellite': 1}
+# Node levels of RstTree.back_prop
+LEVELS = ('sentence', 'paragraph', 'document')
+
+
+def f1_score(hit_num, pred_num, gold_num):
+    """ Precision, recall and F1 score of hit_num correct out of pred_num
+        predicted and gold_num gold items
+    """
+    precision = hit_num / pred_num if pred_num > 0 else 0
+    recall = hit_num / gold_num if gold_num > 0 else 0
+    if precision + recall == 0:
+        return precision, recall, 0
+    return precision, recall, 2 * precision * recall / (precision + recall)
+
 
 class Performance:
+    """ Hits of one evaluation level, percision and recall are the sums of
+        the per-document values
+    """
+
     def __init__(self):
-        self.percision = []
-        self.recall = []
+        self.percision = 0.0
+        self.recall = 0.0
         self.hit_num = 0
+        self.hit_num_each_level = numpy.zeros(len(LEVELS), dtype=numpy.int64)
+
+    def merge(self, other):
+        self.percision += other.percision
+        self.recall += other.recall
+        self.hit_num += other.hit_num
+        self.hit_num_each_level += other.hit_num_each_level
+        return self
+
+    def to_dict(self):
+        return {'percision': self.percision, 'recall': self.recall, 'hit_num': self.hit_num,
+                'hit_num_each_level': self.hit_num_each_level.tolist()}
+
+    @staticmethod
+    def from_dict(data):
+        perf = Performance()
+        perf.percision, perf.recall, perf.hit_num = data['percision'], data['recall'], data['hit_num']
+        perf.hit_num_each_level = numpy.array(data['hit_num_each_level'], dtype=numpy.int64)
+        return perf
 
 
 class Metrics:
+    """ Counts of the evaluation, accumulated over documents
+
+    Metrics of separate shards of a test set are combined with merge, which
+    is associative, into the counts of the whole set. The counts are
+    serialized to JSON with save and read again with load, so shards can be
+    scored by different processes or machines. All counts are merged
+    exactly, only the sums of the per-document precision and recall may
+    differ in the last digits depending on the order of the shards.
+    """
+    PARTS = ('span_perf', 'nuc_perf', 'rela_perf')
+    COUNTS = ('gold_num_each_level', 'pred_num_each_level',
+              'hit_num_each_relation', 'pred_num_each_relation', 'gold_num_each_relation')
+
     def __init__(self):
         self.span_perf = Performance()
         self.nuc_perf = Performance()
         self.rela_perf = Performance()
         self.span_num = 0
-        self.hit_num_each_relation = {}
-        self.pred_num_each_relation = {}
-        self.gold_num_each_relation = {}
+        self.pred_num = 0
+        # number of documents in the per-document averages
+        self.doc_num = 0
+        self.gold_num_each_level = numpy.zeros(len(LEVELS), dtype=numpy.int64)
+        self.pred_num_each_level = numpy.zeros(len(LEVELS), dtype=numpy.int64)
+        # Relations in order of their first occurrence, the bracket arrays
+        # and the per-relation counts are indexed by their position
+        self.relations = []
+        self.relation_ids = {}
+        self.hit_num_each_relation = numpy.zeros(0, dtype=numpy.int64)
+        self.pred_num_each_relation = numpy.zeros(0, dtype=numpy.int64)
+        self.gold_num_each_relation = numpy.zeros(0, dtype=numpy.int64)
+
+    def relation_id(self, relation):
+        if relation not in self.relation_ids:
+            self.relation_ids[relation] = len(self.relations)
+            self.relations.append(relation)
+        return self.relation_ids[relation]
+
+    def encode(self, rst_tree):
+        """ Brackets of a binary RST tree as an integer array with the columns
+            START, END, NUCLEARITY, RELATION and LEVEL, one row per node
+            except the root, like RstTree.bracketing
+
+        :type rst_tree: RstTree
+        :param rst_tree: binary RST tree
+        """
+        nodes = rst_tree.postorder()
+        nodes.pop()  # Remove the root node
+        rows = [(node.edu_span[0], node.edu_span[1], NUCLEARITY_IDS.get(node.prop, len(NUCLEARITY_IDS)),
+                 self.relation_id(node.relation), node.level) for node in nodes]
+        return numpy.array(rows, dtype=numpy.int64).reshape(-1, 5)
 
     def eval(self, goldtree, predtree):
         """ Evaluation performance on one pair of RST trees
@@ -27,78 +111,128 @@ class Metrics:
         :type predtree: RSTTree class
         :param predtree: RST tree from the parsing algorithm
         """
-        goldbrackets = goldtree.bracketing()
-        predbrackets = predtree.bracketing()
+        self.eval_brackets(self.encode(goldtree), self.encode(predtree))
+
+    def eval_brackets(self, goldbrackets, predbrackets):
+        """ Evaluation performance on the encoded brackets of one document
+
+        Each span occurs at most once in a tree, so the hits of the span,
+        nuclearity and relation levels are the gold brackets whose key, the
+        span combined with the respective label, is among the predicted keys.
+        The level of a span only depends on the document, hits are counted at
+        the level of their gold bracket.
+
+        :type goldbrackets: numpy.ndarray
+        :param goldbrackets: encoded brackets of the gold RST tree
+
+        :type predbrackets: numpy.ndarray
+        :param predbrackets: encoded brackets of the predicted RST tree
+        """
+        n_relations = len(self.relations)
+        self.hit_num_each_relation = self._resize(self.hit_num_each_relation, n_relations)
+        self.pred_num_each_relation = self._resize(self.pred_num_each_relation, n_relations)
+        self.gold_num_each_relation = self._resize(self.gold_num_each_relation, n_relations)
         self.span_num += len(goldbrackets)
-        self._eval(goldbrackets, predbrackets, idx=1)
-        self._eval(goldbrackets, predbrackets, idx=2)
-        self._eval(goldbrackets, predbrackets, idx=3)
+        self.pred_num += len(predbrackets)
+        if len(goldbrackets) and len(predbrackets):
+            self.doc_num += 1
+        self.gold_num_each_level += numpy.bincount(goldbrackets[:, LEVEL], minlength=len(LEVELS))
+        self.pred_num_each_level += numpy.bincount(predbrackets[:, LEVEL], minlength=len(LEVELS))
+        self.gold_num_each_relation += numpy.bincount(goldbrackets[:, RELATION], minlength=n_relations)
+        self.pred_num_each_relation += numpy.bincount(predbrackets[:, RELATION], minlength=n_relations)
+        # a unique integer per span
+        n_edus = max(goldbrackets[:, END].max(initial=0), predbrackets[:, END].max(initial=0)) + 1
+        goldspan = goldbrackets[:, START] * n_edus + goldbrackets[:, END]
+        predspan = predbrackets[:, START] * n_edus + predbrackets[:, END]
+        n_nuclearity = len(NUCLEARITY_IDS) + 1
+        for perf, goldkeys, predkeys in (
+                (self.span_perf, goldspan, predspan),
+                (self.nuc_perf, goldspan * n_nuclearity + goldbrackets[:, NUCLEARITY],
+                 predspan * n_nuclearity + predbrackets[:, NUCLEARITY]),
+                (self.rela_perf, goldspan * n_relations + goldbrackets[:, RELATION],
+                 predspan * n_relations + predbrackets[:, RELATION])):
+            hits = numpy.isin(goldkeys, predkeys, assume_unique=True)
+            hit_num = int(hits.sum())
+            perf.hit_num += hit_num
+            perf.hit_num_each_level += numpy.bincount(goldbrackets[hits, LEVEL], minlength=len(LEVELS))
+            if len(goldbrackets) and len(predbrackets):
+                perf.percision += hit_num / len(goldbrackets)
+                perf.recall += hit_num / len(predbrackets)
+            if perf is self.rela_perf:
+                self.hit_num_each_relation += numpy.bincount(goldbrackets[hits, RELATION], minlength=n_relations)
 
-    def _eval(self, goldbrackets, predbrackets, idx):
-        """ Evaluation on each discourse span
+    @staticmethod
+    def _resize(counts, size):
+        if len(counts) >= size:
+            return counts
+        return numpy.concatenate([counts, numpy.zeros(size - len(counts), dtype=counts.dtype)])
+
+    def merge(self, other):
+        """ Add the counts of other, the relations of other are mapped to
+            the relation ids of this instance
+
+        :type other: Metrics
+        :param other: metrics of another shard
         """
-        # goldspan = [item[:idx] for item in goldbrackets]
-        # predspan = [item[:idx] for item in predbrackets]
-        if idx == 1 or idx == 2:
-            goldspan = [item[:idx] for item in goldbrackets]
-            predspan = [item[:idx] for item in predbrackets]
-        elif idx == 3:
-            goldspan = [(item[0], item[2]) for item in goldbrackets]
-            predspan = [(item[0], item[2]) for item in predbrackets]
-        else:
-            raise ValueError('Undefined idx for evaluation')
-        hitspan = [span for span in goldspan if span in predspan]
-        p, r = 0.0, 0.0
-        for span in hitspan:
-            if span in goldspan:
-                p += 1.0
-            if span in predspan:
-                r += 1.0
-        if idx == 1:
-            self.span_perf.hit_num += p
-        elif idx == 2:
-            self.nuc_perf.hit_num += p
-        elif idx == 3:
-            self.rela_perf.hit_num += p
-        p /= len(goldspan)
-        r /= len(predspan)
-        if idx == 1:
-            self.span_perf.percision.append(p)
-            self.span_perf.recall.append(r)
-        elif idx == 2:
-            self.nuc_perf.percision.append(p)
-            self.nuc_perf.recall.append(r)
-        elif idx == 3:
-            self.rela_perf.percision.append(p)
-            self.rela_perf.recall.append(r)
-        if idx == 3:
-            for span in hitspan:
-                relation = span[-1]
-                if relation in self.hit_num_each_relation:
-                    self.hit_num_each_relation[relation] += 1
-                else:
-                    self.hit_num_each_relation[relation] = 1
-            for span in goldspan:
-                relation = span[-1]
-                if relation in self.gold_num_each_relation:
-                    self.gold_num_each_relation[relation] += 1
-                else:
-                    self.gold_num_each_relation[relation] = 1
-            for span in predspan:
-                relation = span[-1]
-                if relation in self.pred_num_each_relation:
-                    self.pred_num_each_relation[relation] += 1
-                else:
-                    self.pred_num_each_relation[relation] = 1
+        rel_ids = numpy.array([self.relation_id(relation) for relation in other.relations], dtype=numpy.int64)
+        for name in Metrics.COUNTS:
+            counts = getattr(other, name)
+            if name.endswith('_relation'):
+                merged = self._resize(getattr(self, name), len(self.relations))
+                merged[rel_ids] += counts
+            else:
+                merged = getattr(self, name) + counts
+            setattr(self, name, merged)
+        for name in Metrics.PARTS:
+            getattr(self, name).merge(getattr(other, name))
+        self.span_num += other.span_num
+        self.pred_num += other.pred_num
+        self.doc_num += other.doc_num
+        return self
+
+    @staticmethod
+    def reduce(metrics):
+        """ Merge the metrics of many shards into new metrics
+        """
+        merged = Metrics()
+        for met in metrics:
+            merged.merge(met)
+        return merged
+
+    def to_dict(self):
+        data = {'relations': self.relations, 'span_num': self.span_num, 'pred_num': self.pred_num,
+                'doc_num': self.doc_num}
+        data.update((name, getattr(self, name).to_dict()) for name in Metrics.PARTS)
+        data.update((name, getattr(self, name).tolist()) for name in Metrics.COUNTS)
+        return data
+
+    @staticmethod
+    def from_dict(data):
+        met = Metrics()
+        for relation in data['relations']:
+            met.relation_id(relation)
+        met.span_num, met.pred_num, met.doc_num = data['span_num'], data['pred_num'], data['doc_num']
+        for name in Metrics.PARTS:
+            setattr(met, name, Performance.from_dict(data[name]))
+        for name in Metrics.COUNTS:
+            setattr(met, name, numpy.array(data[name], dtype=numpy.int64))
+        return met
+
+    def save(self, fname):
+        with open(fname, 'w') as fout:
+            json.dump(self.to_dict(), fout)
+
+    @staticmethod
+    def load(fname):
+        with open(fname) as fin:
+            return Metrics.from_dict(json.load(fin))
 
     def report_part(self, part, part_label):
-        p = numpy.array(part.percision).mean()
-        # r = numpy.array(part.recall).mean()
-        # f1 = (2 * p * r) / (p + r)
+        p = part.percision / self.doc_num if self.doc_num else 0.0
         print(f'Average precision on {part_label} level is {p:.4f}')
-        # print('Recall on span level is {0:.4f}'.format(r))
-        # print('F1 score on span level is {0:.4f}'.format(f1))
         print(f'Global precision on {part_label} level is {part.hit_num / self.span_num:.4f}')
+        precision, recall, f1 = f1_score(part.hit_num, self.pred_num, self.span_num)
+        print(f'Micro precision, recall and F1 on {part_label} level are {precision:.4f}, {recall:.4f}, {f1:.4f}')
 
     def report(self):
         """ Compute the F1 score for different eval levels
@@ -107,18 +241,23 @@ class Metrics:
         self.report_part(self.span_perf, "span")
         self.report_part(self.nuc_perf, "nuclearity")
         self.report_part(self.rela_perf, "relation")
-        # sorted_relations = sorted(self.gold_num_each_relation.keys(), key=lambda x: self.gold_num_each_relation[x])
-        sorted_relations = sorted(self.gold_num_each_relation.keys())
         print("= " * 55)
-        for relation in sorted_relations:
-            hit_num = self.hit_num_each_relation[relation] if relation in self.hit_num_each_relation else 0
-            gold_num = self.gold_num_each_relation[relation]
-            pred_num = self.pred_num_each_relation[relation] if relation in self.pred_num_each_relation else 0
-            precision = hit_num / pred_num if pred_num > 0 else 0
-            recall = hit_num / gold_num
-            if precision + recall == 0:
-                f1 = 0
-            else:
-                f1 = 2 * precision * recall / (precision + recall)
+        for level, level_label in enumerate(LEVELS):
+            gold_num = self.gold_num_each_level[level]
+            pred_num = self.pred_num_each_level[level]
+            scores = [f1_score(perf.hit_num_each_level[level], pred_num, gold_num)[2]
+                      for perf in (self.span_perf, self.nuc_perf, self.rela_perf)]
+            print(f'Level\t{level_label:20}\tgold_num\t{gold_num:4d}\t'
+                  f'span_f1\t{scores[0]:05.4f}\tnuclearity_f1\t{scores[1]:05.4f}\trelation_f1\t{scores[2]:05.4f}')
+        print("= " * 55)
+        f1_scores = []
+        for relation in sorted(rel for rel, gold_num in zip(self.relations, self.gold_num_each_relation) if gold_num):
+            rel_id = self.relation_ids[relation]
+            gold_num = self.gold_num_each_relation[rel_id]
+            precision, recall, f1 = f1_score(self.hit_num_each_relation[rel_id],
+                                             self.pred_num_each_relation[rel_id], gold_num)
+            f1_scores.append(f1)
             print(f'Relation\t{relation:20}\tgold_num\t{gold_num:4d}\t'
                   f'precision\t{precision:05.4f}\trecall\t{recall:05.4f}\tf1\t{f1:05.4f}')
+        if f1_scores:
+            print(f'Macro-averaged F1 over relations is {numpy.mean(f1_scores):.4f}')
@@ -1,5 +1,7 @@
 from itertools import chain
 
+from stagedp.utils.brown import BrownClusters
+
 
 class ActionFeatureGenerator:
     def __init__(self, stack, queue, action_hist, doc, bcvocab, nprefix=11):
@@ -108,26 +110,26 @@ class ActionFeatureGenerator:
         # Span 1 and 2
         if self.top1span is not None and self.top2span is not None:
             text1, text2 = self.top1span.text, self.top2span.text
-            if self.doc.token_dict[text1[0]].sidx == self.doc.token_dict[text2[-1]].sidx:
+            if self.doc.sidx[text1[0]] == self.doc.sidx[text2[-1]]:
                 yield 'Top12-Stack-SentContinue'
-            if self.doc.token_dict[text1[0]].pidx == self.doc.token_dict[text2[-1]].pidx:
+            if self.doc.pidx[text1[0]] == self.doc.pidx[text2[-1]]:
                 yield 'Top12-Stack-ParaContinue'
         # Span 1 and top span
         # First word from span 1, last word from span 3
         if self.top1span is not None and self.firstspan is not None:
             text1, text3 = self.top1span.text, self.firstspan.text
-            if self.doc.token_dict[text1[-1]].sidx == self.doc.token_dict[text3[0]].sidx:
+            if self.doc.sidx[text1[-1]] == self.doc.sidx[text3[0]]:
                 yield 'Stack-Queue-SentContinue'
-            if self.doc.token_dict[text1[-1]].pidx == self.doc.token_dict[text3[0]].pidx:
+            if self.doc.pidx[text1[-1]] == self.doc.pidx[text3[0]]:
                 yield 'Stack-Queue-ParaContinue'
         # Last word from span 1, first word from span 2
         top12_stack_same_sent, top12_stack_same_para = False, False
         if self.top1span is not None and self.top2span is not None:
             text1, text2 = self.top1span.text, self.top2span.text
-            if self.doc.token_dict[text1[-1]].sidx == self.doc.token_dict[text2[0]].sidx:
+            if self.doc.sidx[text1[-1]] == self.doc.sidx[text2[0]]:
                 top12_stack_same_sent = True
                 yield 'Top12-Stack-SameSent'
-            if self.doc.token_dict[text1[-1]].pidx == self.doc.token_dict[text2[0]].pidx:
+            if self.doc.pidx[text1[-1]] == self.doc.pidx[text2[0]]:
                 top12_stack_same_para = True
                 yield 'Top12-Stack-SamePara'
         # Span 1 and top span
@@ -135,10 +137,10 @@ class ActionFeatureGenerator:
         stack_queue_same_sent, stack_queue_same_para = False, False
         if self.top1span is not None and self.firstspan is not None:
             text1, text3 = self.top1span.text, self.firstspan.text
-            if self.doc.token_dict[text1[0]].sidx == self.doc.token_dict[text3[-1]].sidx:
+            if self.doc.sidx[text1[0]] == self.doc.sidx[text3[-1]]:
                 stack_queue_same_sent = True
                 yield 'Stack-Queue-SameSent'
-            if self.doc.token_dict[text1[0]].pidx == self.doc.token_dict[text3[-1]].pidx:
+            if self.doc.pidx[text1[0]] == self.doc.pidx[text3[-1]]:
                 stack_queue_same_para = True
                 yield 'Stack-Queue-SamePara'
         if top12_stack_same_sent and stack_queue_same_sent:
@@ -148,52 +150,49 @@ class ActionFeatureGenerator:
         # ---------------------------------------
         # whether span is the start or end of sentence, paragraph or document
         if self.top1span is not None:
-            text = self.top1span.text
-            if text[0] - 1 < 0 or self.doc.token_dict[text[0] - 1].sidx != self.doc.token_dict[text[0]].sidx:
+            sent_start, sent_end, para_start, para_end, doc_start, doc_end = cached_span_feature(
+                self.top1span, 'boundaries', get_boundaries, self.top1span.tok_span, self.doc)
+            if sent_start:
                 yield 'Top1-Sent-start'
-            if text[-1] + 1 >= len(self.doc.token_dict) or self.doc.token_dict[text[-1] + 1].sidx != \
-                    self.doc.token_dict[text[-1]].sidx:
+            if sent_end:
                 yield 'Top1-Sent-end'
-            if text[0] - 1 < 0 or self.doc.token_dict[text[0] - 1].pidx != self.doc.token_dict[text[0]].pidx:
+            if para_start:
                 yield 'Top1-Para-start'
-            if text[-1] + 1 >= len(self.doc.token_dict) or self.doc.token_dict[text[-1] + 1].pidx != \
-                    self.doc.token_dict[text[-1]].pidx:
+            if para_end:
                 yield 'Top1-Para-end'
-            if text[0] - 1 < 0:
+            if doc_start:
                 yield 'Top1-Doc-start'
-            if text[-1] + 1 >= len(self.doc.token_dict):
+            if doc_end:
                 yield 'Top1-Doc-end'
         if self.top2span is not None:
-            text = self.top2span.text
-            if text[0] - 1 < 0 or self.doc.token_dict[text[0] - 1].sidx != self.doc.token_dict[text[0]].sidx:
+            sent_start, sent_end, para_start, para_end, doc_start, doc_end = cached_span_feature(
+                self.top2span, 'boundaries', get_boundaries, self.top2span.tok_span, self.doc)
+            if sent_start:
                 yield 'Top2-Sent-start'
-            if text[-1] + 1 >= len(self.doc.token_dict) or self.doc.token_dict[text[-1] + 1].sidx != \
-                    self.doc.token_dict[text[-1]].sidx:
+            if sent_end:
                 yield 'Top2-Sent-end'
-            if text[0] - 1 < 0 or self.doc.token_dict[text[0] - 1].pidx != self.doc.token_dict[text[0]].pidx:
+            if para_start:
                 yield 'Top2-Para-start'
-            if text[-1] + 1 >= len(self.doc.token_dict) or self.doc.token_dict[text[-1] + 1].pidx != \
-                    self.doc.token_dict[text[-1]].pidx:
+            if para_end:
                 yield 'Top2-Para-end'
-            if text[0] - 1 < 0:
+            if doc_start:
                 yield 'Top2-Doc-start'
-            if text[-1] + 1 >= len(self.doc.token_dict):
+            if doc_end:
                 yield 'Top2-Doc-end'
         if self.firstspan is not None:
-            text = self.firstspan.text
-            if text[0] - 1 < 0 or self.doc.token_dict[text[0] - 1].sidx != self.doc.token_dict[text[0]].sidx:
+            sent_start, sent_end, para_start, para_end, doc_start, doc_end = cached_span_feature(
+                self.firstspan, 'boundaries', get_boundaries, self.firstspan.tok_span, self.doc)
+            if sent_start:
                 yield 'Queue-Sent-start'
-            if text[-1] + 1 >= len(self.doc.token_dict) or self.doc.token_dict[text[-1] + 1].sidx != \
-                    self.doc.token_dict[text[-1]].sidx:
+            if sent_end:
                 yield 'Queue-Sent-end'
-            if text[0] - 1 < 0 or self.doc.token_dict[text[0] - 1].pidx != self.doc.token_dict[text[0]].pidx:
+            if para_start:
                 yield 'Queue', 'Para-start'
-            if text[-1] + 1 >= len(self.doc.token_dict) or self.doc.token_dict[text[-1] + 1].pidx != \
-                    self.doc.token_dict[text[-1]].pidx:
+            if para_end:
                 yield 'Queue-Para-end'
-            if text[0] - 1 < 0:
+            if doc_start:
                 yield 'Queue-Doc-start'
-            if text[-1] + 1 >= len(self.doc.token_dict):
+            if doc_end:
                 yield 'Queue-Doc-end'
 
     def syntactic_featues(self):
@@ -201,65 +200,43 @@ class ActionFeatureGenerator:
         stack_queue_same_sent = False
         if self.top1span is not None and self.top2span is not None:
             text1, text2 = self.top1span.text, self.top2span.text
-            if self.doc.token_dict[text1[-1]].sidx == self.doc.token_dict[text2[0]].sidx:
+            if self.doc.sidx[text1[-1]] == self.doc.sidx[text2[0]]:
                 top12_stack_same_sent = True
         if self.top1span is not None and self.firstspan is not None:
             text1, text3 = self.top1span.text, self.firstspan.text
-            if self.doc.token_dict[text1[0]].sidx == self.doc.token_dict[text3[-1]].sidx:
+            if self.doc.sidx[text1[0]] == self.doc.sidx[text3[-1]]:
                 stack_queue_same_sent = True
         # syntactic dependency features
         if top12_stack_same_sent:
-            text1, text2 = self.top1span.text, self.top2span.text
-            text1_tidx = [self.doc.token_dict[token].tidx for token in text1]
-            text1_heads = [self.doc.token_dict[token].hidx for token in text1]
-            text1_deps = [self.doc.token_dict[token].dep_label for token in text1]
-            text2_tidx = [self.doc.token_dict[token].tidx for token in text2]
-            text2_heads = [self.doc.token_dict[token].hidx for token in text2]
-            text2_deps = [self.doc.token_dict[token].dep_label for token in text2]
-            right_dep, left_dep = False, False
-            for idx, head in enumerate(text1_heads):
-                if head in text2_tidx:
-                    right_dep = True
-                    yield 'Top12-Stack-Right-Dep'
-                    yield 'Top12-Stack-Dep-Relation', text1_deps[idx]
-                    yield 'Top12-Stack-Right-Dep-Relation', text1_deps[idx]
-                    yield 'Top12-Stack-Right-Dep-Head', self.doc.token_dict[head - 1].lemma
-                    break
-            if not right_dep:
-                for idx, head in enumerate(text2_heads):
-                    if head in text1_tidx:
-                        left_dep = True
-                        yield 'Top12-Stack-Left-Dep'
-                        yield 'Top12-Stack-Dep-Relation', text2_deps[idx]
-                        yield 'Top12-Stack-Left-Dep-Relation', text2_deps[idx]
-                        yield 'Top12-Stack-Left-Dep-Head', self.doc.token_dict[head - 1].lemma
-                        break
-            if not right_dep and not left_dep:
-                yield 'Top12-Stack-No-Dep'
+            span1, span2 = self.top1span.tok_span, self.top2span.tok_span
+            dep = get_dep_attachment(span1, span2, self.doc)
+            if dep is not None:
+                yield 'Top12-Stack-Right-Dep'
+                yield 'Top12-Stack-Dep-Relation', self.doc.dep_label[dep]
+                yield 'Top12-Stack-Right-Dep-Relation', self.doc.dep_label[dep]
+                yield 'Top12-Stack-Right-Dep-Head', self.doc.lemma[self.doc.hidx[dep] - 1]
+            else:
+                dep = get_dep_attachment(span2, span1, self.doc)
+                if dep is not None:
+                    yield 'Top12-Stack-Left-Dep'
+                    yield 'Top12-Stack-Dep-Relation', self.doc.dep_label[dep]
+                    yield 'Top12-Stack-Left-Dep-Relation', self.doc.dep_label[dep]
+                    yield 'Top12-Stack-Left-Dep-Head', self.doc.lemma[self.doc.hidx[dep] - 1]
+                else:
+                    yield 'Top12-Stack-No-Dep'
         if stack_queue_same_sent:
-            text1, text2 = self.top1span.text, self.firstspan.text
-            text1_tidx = [self.doc.token_dict[token].tidx for token in text1]
-            text1_heads = [self.doc.token_dict[token].hidx for token in text1]
-            text1_deps = [self.doc.token_dict[token].dep_label for token in text1]
-            text2_tidx = [self.doc.token_dict[token].tidx for token in text2]
-            text2_heads = [self.doc.token_dict[token].hidx for token in text2]
-            text2_deps = [self.doc.token_dict[token].dep_label for token in text2]
-            right_dep, left_dep = False, False
-            for idx, head in enumerate(text1_heads):
-                if head in text2_tidx:
-                    right_dep = True
-                    yield 'Stack-Queue-Right-Dep'
-                    yield 'Stack-Queue-Dep-Relation', text1_deps[idx]
-                    break
-            if not right_dep:
-                for idx, head in enumerate(text2_heads):
-                    if head in text1_tidx:
-                        left_dep = True
-                        yield 'Stack-Queue-Left-Dep'
-                        yield 'Stack-Queue-Dep-Relation', text2_deps[idx]
-                        break
-            if not right_dep and not left_dep:
-                yield 'Stack-Queue-No-Dep'
+            span1, span2 = self.top1span.tok_span, self.firstspan.tok_span
+            dep = get_dep_attachment(span1, span2, self.doc)
+            if dep is not None:
+                yield 'Stack-Queue-Right-Dep'
+                yield 'Stack-Queue-Dep-Relation', self.doc.dep_label[dep]
+            else:
+                dep = get_dep_attachment(span2, span1, self.doc)
+                if dep is not None:
+                    yield 'Stack-Queue-Left-Dep'
+                    yield 'Stack-Queue-Dep-Relation', self.doc.dep_label[dep]
+                else:
+                    yield 'Stack-Queue-No-Dep'
 
     def structural_features(self):
         # subtree form
@@ -272,7 +249,8 @@ class ActionFeatureGenerator:
             yield 'Top12-Stack-Form', f"{self.top1span.form},{self.top2span.form}"
         # distance
         if self.top1span is not None:
-            dist_to_begin, dist_to_end = get_dist_to_begin_end(self.top1span, self.doc)
+            dist_to_begin, dist_to_end = cached_span_feature(
+                self.top1span, ('dist', self.top1span.level), get_dist_to_begin_end, self.top1span, self.doc)
             if self.top1span.level == 0:
                 yield 'Top1-Stack-Dist-To-Sent-Begin', dist_to_begin
                 yield 'Top1-Stack-Dist-To-Sent-End', dist_to_end
@@ -283,7 +261,8 @@ class ActionFeatureGenerator:
                 yield 'Top1-Stack-Dist-To-Doc-Begin', dist_to_begin
                 yield 'Top1-Stack-Dist-To-Doc-End', dist_to_end
         if self.top2span is not None:
-            dist_to_begin, dist_to_end = get_dist_to_begin_end(self.top2span, self.doc)
+            dist_to_begin, dist_to_end = cached_span_feature(
+                self.top2span, ('dist', self.top2span.level), get_dist_to_begin_end, self.top2span, self.doc)
             if self.top2span.level == 0:
                 yield 'Top2-Stack-Dist-To-Sent-Begin', dist_to_begin
                 yield 'Top2-Stack-Dist-To-Sent-End', dist_to_end
@@ -294,7 +273,8 @@ class ActionFeatureGenerator:
                 yield 'Top2-Stack-Dist-To-Doc-Begin', dist_to_begin
                 yield 'Top2-Stack-Dist-To-Doc-End', dist_to_end
         if self.firstspan is not None:
-            dist_to_begin, dist_to_end = get_dist_to_begin_end(self.firstspan, self.doc)
+            dist_to_begin, dist_to_end = cached_span_feature(
+                self.firstspan, ('dist', self.firstspan.level), get_dist_to_begin_end, self.firstspan, self.doc)
             if self.firstspan.level == 0:
                 yield 'First-Queue-Dist-To-Sent-Begin', dist_to_begin
                 yield 'First-Queue-Dist-To-Sent-End', dist_to_end
@@ -324,11 +304,11 @@ class ActionFeatureGenerator:
         # Sentence length
         if self.top1span is not None:
             text1 = self.top1span.text
-            sentlen1 = self.doc.token_dict[text1[-1]].sidx - self.doc.token_dict[text1[0]].sidx + 1
+            sentlen1 = self.doc.sidx[text1[-1]] - self.doc.sidx[text1[0]] + 1
             yield 'Top1-Stack-nSents', categorize_length(sentlen1)
         if self.top2span is not None:
             text2 = self.top2span.text
-            sentlen2 = self.doc.token_dict[text2[-1]].sidx - self.doc.token_dict[text2[0]].sidx + 1
+            sentlen2 = self.doc.sidx[text2[-1]] - self.doc.sidx[text2[0]] + 1
             yield 'Top2-Stack-nSents', categorize_length(sentlen2)
         if (self.top1span is not None) and (self.top2span is not None):
             if sentlen1 > sentlen2:
@@ -342,11 +322,11 @@ class ActionFeatureGenerator:
                 # paragraph length
                 # if self.top1span is not None:
                 #     text1 = self.top1span.text
-                #     paralen1 = self.doc.token_dict[text1[-1]].pidx - self.doc.token_dict[text1[0]].pidx + 1
+                #     paralen1 = self.doc.pidx[text1[-1]] - self.doc.pidx[text1[0]] + 1
                 #     yield ('Top1-Stack', 'nParas', paralen1)
                 # if self.top2span is not None:
                 #     text2 = self.top2span.text
-                #     paralen2 = self.doc.token_dict[text2[-1]].pidx - self.doc.token_dict[text2[0]].pidx + 1
+                #     paralen2 = self.doc.pidx[text2[-1]] - self.doc.pidx[text2[0]] + 1
                 #     yield ('Top2-Stack', 'nParas', paralen2)
                 # if (self.top1span is not None) and (self.top2span is not None):
                 #     if paralen1 > paralen2:
@@ -363,35 +343,35 @@ class ActionFeatureGenerator:
             span = self.top1span
             # yield ('Top1-Stack-nTokens', len(span.text))
             # yield ('Top1-Stack-Word1_Suffix', get_suffix(self.doc.token_dict[span.text[0]].word))
-            grams = get_grams(span.text, self.doc.token_dict)
+            grams = cached_span_feature(span, 'grams', get_grams, span.text, self.doc)
             for gram in grams:
                 yield 'Top1-Stack-nGram', gram
         if self.top2span is not None:
             span = self.top2span
             # yield ('Top2-Stack-Word1_Suffix', get_suffix(self.doc.token_dict[span.text[0]].word))
             # yield ('Top2-Stack-nTokens', len(span.text))
-            grams = get_grams(span.text, self.doc.token_dict)
+            grams = cached_span_feature(span, 'grams', get_grams, span.text, self.doc)
             for gram in grams:
                 yield 'Top2-Stack-nGram', gram
         if self.firstspan is not None:
             span = self.firstspan
             # yield ('First-Queue-Word1_Suffix', get_suffix(self.doc.token_dict[span.text[0]].word))
             # yield ('First-Queue-nTokens', len(span.text))
-            grams = get_grams(span.text, self.doc.token_dict)
+            grams = cached_span_feature(span, 'grams', get_grams, span.text, self.doc)
             for gram in grams:
                 yield 'First-Queue-nGram', gram
         if self.top1span is not None and self.top2span is not None:
             span1 = self.top1span
             span2 = self.top2span
             # yield ('Top12-Stack-nTokens', len(span1.text)+len(span2.text))
-            grams = get_conjunctive_grams(span2.text, span1.text, self.doc.token_dict)
+            grams = get_conjunctive_grams(span2.text, span1.text, self.doc)
             for gram in grams:
                 yield 'Top12-Stack-nGram', gram
         if self.top1span is not None and self.firstspan is not None:
             span1 = self.top1span
             span2 = self.firstspan
             # yield ('Stack-Queue-nTokens', len(span1.text)+len(span2.text))
-            grams = get_conjunctive_grams(span1.text, span2.text, self.doc.token_dict)
+            grams = get_conjunctive_grams(span1.text, span2.text, self.doc)
             for gram in grams:
                 yield 'Stack-Queue-nGram', gram
 
@@ -401,20 +381,15 @@ class ActionFeatureGenerator:
         for span_name, span in [('Top1', self.top1span), ('Top2', self.top2span), ('Queue', self.firstspan)]:
             if span is None:
                 continue
-            text = self.doc.edu_dict[span.nuc_edu]
             # for gidx in text:
             #     token = self.doc.token_dict[gidx]
             #     # yield (span_name, 'Nuc-word', token.lemma)
             #     yield (span_name, 'Nuc-pos', token.pos)
-            text_tidx = [self.doc.token_dict[token].tidx for token in text]
-            text_heads = [self.doc.token_dict[token].hidx for token in text]
-            text_deps = [self.doc.token_dict[token].dep_label for token in text]
-            for idx, head in enumerate(text_heads):
-                if head not in text_tidx:
-                    head_token = self.doc.token_dict[text_tidx[idx] - 1]
-                    yield f'{span_name}-Nuc-EDU-head-word', head_token.lemma
-                    yield f'{span_name}-Nuc-EDU-head-pos', head_token.pos
-                    yield f'{span_name}-Nuc-EDU-head-dep', text_deps[idx]
+            edu_heads = cached_span_feature(span, 'nucleus', get_edu_heads, span.nuc_edu, self.doc)
+            for lemma, pos, dep in edu_heads:
+                yield f'{span_name}-Nuc-EDU-head-word', lemma
+                yield f'{span_name}-Nuc-EDU-head-pos', pos
+                yield f'{span_name}-Nuc-EDU-head-dep', dep
                     # if self.top1span is not None and self.top2span is not None:
                     #     yield ('Top12-Stack-Nuc-Edu-Dist', self.top1span.nuc_edu - self.top2span.nuc_edu)
                     # if self.top1span is not None and self.firstspan is not None:
@@ -424,21 +399,22 @@ class ActionFeatureGenerator:
         """ Feature extract from brown clusters
             Features are only extracted from Nucleus EDU !!!!
         """
-        token_dict = self.doc.token_dict
-        edu_dict = self.doc.edu_dict
         if self.top1span is not None:
             eduidx = self.top1span.nuc_edu
-            bcfeatures = get_bc(eduidx, edu_dict, token_dict, self.bcvocab, self.nprefix)
+            bcfeatures = cached_span_feature(self.top1span, ('bc', self.nprefix), get_bc,
+                                             eduidx, self.doc, self.bcvocab, self.nprefix)
             for feat in bcfeatures:
                 yield 'BC-Top1Span', feat
         if self.top2span is not None:
             eduidx = self.top2span.nuc_edu
-            bcfeatures = get_bc(eduidx, edu_dict, token_dict, self.bcvocab, self.nprefix)
+            bcfeatures = cached_span_feature(self.top2span, ('bc', self.nprefix), get_bc,
+                                             eduidx, self.doc, self.bcvocab, self.nprefix)
             for feat in bcfeatures:
                 yield 'BC-Top2Span', feat
         if self.firstspan is not None:
             eduidx = self.firstspan.nuc_edu
-            bcfeatures = get_bc(eduidx, edu_dict, token_dict, self.bcvocab, self.nprefix)
+            bcfeatures = cached_span_feature(self.firstspan, ('bc', self.nprefix), get_bc,
+                                             eduidx, self.doc, self.bcvocab, self.nprefix)
             for feat in bcfeatures:
                 yield 'BC-FirstSpan', feat
 
@@ -478,41 +454,31 @@ class RelationFeatureGenerator:
 
     def lexical_features(self):
         left_text, right_text = self.lnode.text, self.rnode.text
-        for gram in get_grams(left_text, self.doc.token_dict):
+        for gram in cached_span_feature(self.lnode, 'grams', get_grams, left_text, self.doc):
             yield 'Lnode-nGram', gram
-        for gram in get_grams(right_text, self.doc.token_dict):
+        for gram in cached_span_feature(self.rnode, 'grams', get_grams, right_text, self.doc):
             yield 'Rnode-nGram', gram
-        for gram in get_conjunctive_grams(left_text, right_text, self.doc.token_dict):
+        for gram in get_conjunctive_grams(left_text, right_text, self.doc):
             yield 'LRnode-nGram', gram
 
     def syntactic_features(self):
-        left_text, right_text = self.lnode.text, self.rnode.text
-        left_text_tidx = [self.doc.token_dict[token].tidx for token in left_text]
-        left_text_heads = [self.doc.token_dict[token].hidx for token in left_text]
-        left_text_deps = [self.doc.token_dict[token].dep_label for token in left_text]
-        right_text_tidx = [self.doc.token_dict[token].tidx for token in right_text]
-        right_text_heads = [self.doc.token_dict[token].hidx for token in right_text]
-        right_text_deps = [self.doc.token_dict[token].dep_label for token in right_text]
-        right_dep, left_dep = False, False
-        for idx, head in enumerate(left_text_heads):
-            if head in right_text_tidx:
-                right_dep = True
-                yield 'LRnode-Right-Dep'
-                yield 'LRnode-Dep-Relation', left_text_deps[idx]
-                break
-        if not right_dep:
-            for idx, head in enumerate(right_text_heads):
-                if head in left_text_tidx:
-                    left_dep = True
-                    yield 'LRnode-Left-Dep'
-                    yield 'LRnode-Dep-Relation', right_text_deps[idx]
-                    break
-        if not right_dep and not left_dep:
-            yield 'LRnode-No-Dep'
+        left_span, right_span = self.lnode.tok_span, self.rnode.tok_span
+        dep = get_dep_attachment(left_span, right_span, self.doc)
+        if dep is not None:
+            yield 'LRnode-Right-Dep'
+            yield 'LRnode-Dep-Relation', self.doc.dep_label[dep]
+        else:
+            dep = get_dep_attachment(right_span, left_span, self.doc)
+            if dep is not None:
+                yield 'LRnode-Left-Dep'
+                yield 'LRnode-Dep-Relation', self.doc.dep_label[dep]
+            else:
+                yield 'LRnode-No-Dep'
 
     def structural_features(self):
         if self.node is not None:
-            dist_to_begin, dist_to_end = get_dist_to_begin_end(self.node, self.doc)
+            dist_to_begin, dist_to_end = cached_span_feature(
+                self.node, ('dist', self.node.level), get_dist_to_begin_end, self.node, self.doc)
             if self.node.level == 0:
                 yield 'Self-Dist-To-Sent-Begin', dist_to_begin
                 yield 'Self-Dist-To-Sent-End', dist_to_end
@@ -523,7 +489,8 @@ class RelationFeatureGenerator:
                 yield 'Self-Dist-To-Doc-Begin', dist_to_begin
                 yield 'Self-Dist-To-Doc-End', dist_to_end
         if self.lnode is not None:
-            dist_to_begin, dist_to_end = get_dist_to_begin_end(self.lnode, self.doc)
+            dist_to_begin, dist_to_end = cached_span_feature(
+                self.lnode, ('dist', self.lnode.level), get_dist_to_begin_end, self.lnode, self.doc)
             if self.lnode.level == 0:
                 yield 'Lnode-Dist-To-Sent-Begin', dist_to_begin
                 yield 'Lnode-Dist-To-Sent-End', dist_to_end
@@ -534,7 +501,8 @@ class RelationFeatureGenerator:
                 yield 'Lnode-Dist-To-Doc-Begin', dist_to_begin
                 yield 'Lnode-Dist-To-Doc-End', dist_to_end
         if self.rnode is not None:
-            dist_to_begin, dist_to_end = get_dist_to_begin_end(self.rnode, self.doc)
+            dist_to_begin, dist_to_end = cached_span_feature(
+                self.rnode, ('dist', self.rnode.level), get_dist_to_begin_end, self.rnode, self.doc)
             if self.rnode.level == 0:
                 yield 'Rnode-Dist-To-Sent-Begin', dist_to_begin
                 yield 'Rnode-Dist-To-Sent-End', dist_to_end
@@ -564,11 +532,11 @@ class RelationFeatureGenerator:
         if self.level == 1:
             if self.lnode is not None:
                 text1 = self.lnode.text
-                sentlen1 = self.doc.token_dict[text1[-1]].sidx - self.doc.token_dict[text1[0]].sidx + 1
+                sentlen1 = self.doc.sidx[text1[-1]] - self.doc.sidx[text1[0]] + 1
                 yield 'Lnode-nSents', categorize_length(sentlen1)
             if self.rnode is not None:
                 text2 = self.rnode.text
-                sentlen2 = self.doc.token_dict[text2[-1]].sidx - self.doc.token_dict[text2[0]].sidx + 1
+                sentlen2 = self.doc.sidx[text2[-1]] - self.doc.sidx[text2[0]] + 1
                 yield 'Rnode-nSents', categorize_length(sentlen2)
             if (self.lnode is not None) and (self.rnode is not None):
                 # yield ('LRnode', 'Sent-Diff', sentlen1 - sentlen2)
@@ -582,11 +550,11 @@ class RelationFeatureGenerator:
         if self.level == 2:
             if self.lnode is not None:
                 text1 = self.lnode.text
-                paralen1 = self.doc.token_dict[text1[-1]].pidx - self.doc.token_dict[text1[0]].pidx + 1
+                paralen1 = self.doc.pidx[text1[-1]] - self.doc.pidx[text1[0]] + 1
                 yield 'Lnode-nParas', categorize_length(paralen1)
             if self.rnode is not None:
                 text2 = self.rnode.text
-                paralen2 = self.doc.token_dict[text2[-1]].pidx - self.doc.token_dict[text2[0]].pidx + 1
+                paralen2 = self.doc.pidx[text2[-1]] - self.doc.pidx[text2[0]] + 1
                 yield 'Rnode-nParas', categorize_length(paralen2)
             if (self.lnode is not None) and (self.rnode is not None):
                 # yield ('LRnode', 'Para-Diff', paralen1 - paralen2)
@@ -642,143 +610,219 @@ class RelationFeatureGenerator:
         for span_name, span in [('Lnode', self.lnode), ('Rnode', self.rnode)]:
             if span is None:
                 continue
-            text = self.doc.edu_dict[span.nuc_edu]
             # for gidx in text:
             #     token = self.doc.token_dict[gidx]
             #     # yield (span_name, 'Nuc-word', token.lemma)
             #     yield (span_name, 'Nuc-pos', token.pos)
-            text_tidx = [self.doc.token_dict[token].tidx for token in text]
-            text_heads = [self.doc.token_dict[token].hidx for token in text]
-            text_deps = [self.doc.token_dict[token].dep_label for token in text]
-            for idx, head in enumerate(text_heads):
-                if head not in text_tidx:
-                    head_token = self.doc.token_dict[text_tidx[idx] - 1]
-                    yield f'{span_name}-Nuc-EDU-head-word', head_token.lemma
-                    yield f'{span_name}-Nuc-EDU-head-pos', head_token.pos
-                    yield f'{span_name}-Nuc-EDU-head-dep', text_deps[idx]
+            edu_heads = cached_span_feature(span, 'nucleus', get_edu_heads, span.nuc_edu, self.doc)
+            for lemma, pos, dep in edu_heads:
+                yield f'{span_name}-Nuc-EDU-head-word', lemma
+                yield f'{span_name}-Nuc-EDU-head-pos', pos
+                yield f'{span_name}-Nuc-EDU-head-dep', dep
 
     def bc_features(self):
         """ Feature extract from brown clusters
             Features are only extracted from Nucleus EDU !!!!
         """
-        token_dict = self.doc.token_dict
-        edu_dict = self.doc.edu_dict
         if self.lnode is not None:
             eduidx = self.lnode.nuc_edu
-            bcfeatures = get_bc(eduidx, edu_dict, token_dict, self.bcvocab, self.nprefix)
+            bcfeatures = cached_span_feature(self.lnode, ('bc', self.nprefix), get_bc,
+                                             eduidx, self.doc, self.bcvocab, self.nprefix)
             for feat in bcfeatures:
                 yield 'BC-Lnode', feat
         if self.rnode is not None:
             eduidx = self.rnode.nuc_edu
-            bcfeatures = get_bc(eduidx, edu_dict, token_dict, self.bcvocab, self.nprefix)
+            bcfeatures = cached_span_feature(self.rnode, ('bc', self.nprefix), get_bc,
+                                             eduidx, self.doc, self.bcvocab, self.nprefix)
             for feat in bcfeatures:
                 yield 'BC-Rnode', feat
 
 
-def get_grams(text, token_dict):
+def get_grams(text, doc):
     """ Generate first one, two words from the token list
 
     :type text: list of int
     :param text: indices of words with the text span
 
-    :type token_dict: dict of Token (data structure)
-    :param token_dict: all tokens in the doc, indexing by the
-                      document-level index
+    :type doc: Doc
+    :param doc: the document instance
     """
+    lemma, pos = doc.lemma_lower, doc.pos_lower
     n = len(text)
     grams = set()
     if n >= 1:
-        grams.add(f'Start-Unigram-Word-{token_dict[text[0]].lemma.lower()}')
-        grams.add(f'End-Unigram-Word-{token_dict[text[-1]].lemma.lower()}')
-        grams.add(f'Start-Unigram-Pos-{token_dict[text[0]].pos.lower()}')
-        grams.add(f'End-Unigram-Pos-{token_dict[text[-1]].pos.lower()}')
+        grams.add(f'Start-Unigram-Word-{lemma[text[0]]}')
+        grams.add(f'End-Unigram-Word-{lemma[text[-1]]}')
+        grams.add(f'Start-Unigram-Pos-{pos[text[0]]}')
+        grams.add(f'End-Unigram-Pos-{pos[text[-1]]}')
     if n >= 2:
-        grams.add(f'Start-Bigram-Word-{token_dict[text[0]].lemma.lower()}+{token_dict[text[1]].lemma.lower()}')
-        grams.add(f'Start-Bigram-Pos-{token_dict[text[0]].pos.lower()}+{token_dict[text[1]].pos.lower()}')
-        grams.add(f'End-Bigram-Word-{token_dict[text[-2]].lemma.lower()}+{token_dict[text[-1]].lemma.lower()}')
-        grams.add(f'End-Bigram-Pos-{token_dict[text[-2]].pos.lower()}+{token_dict[text[-1]].pos.lower()}')
+        grams.add(f'Start-Bigram-Word-{lemma[text[0]]}+{lemma[text[1]]}')
+        grams.add(f'Start-Bigram-Pos-{pos[text[0]]}+{pos[text[1]]}')
+        grams.add(f'End-Bigram-Word-{lemma[text[-2]]}+{lemma[text[-1]]}')
+        grams.add(f'End-Bigram-Pos-{pos[text[-2]]}+{pos[text[-1]]}')
     return grams
 
 
-def get_conjunctive_grams(text1, text2, token_dict):
+def get_conjunctive_grams(text1, text2, doc):
     """
     Generate conjunctive 2-grams for continuous spans
     :param text1:
     :param text2:
-    :param token_dict:
+    :param doc:
     :return:
     """
+    lemma, pos = doc.lemma_lower, doc.pos_lower
     n1 = len(text1)
     n2 = len(text2)
     grams = set()
     if n1 > 0 and n2 > 0:
-        grams.add(f'Conjunctive-Word-{token_dict[text1[0]].lemma.lower()}+{token_dict[text2[0]].lemma.lower()}')
-        grams.add(f'Conjunctive-Pos-{token_dict[text1[0]].pos.lower()}+{token_dict[text2[0]].pos.lower()}')
+        grams.add(f'Conjunctive-Word-{lemma[text1[0]]}+{lemma[text2[0]]}')
+        grams.add(f'Conjunctive-Pos-{pos[text1[0]]}+{pos[text2[0]]}')
     # if n1 > 1 and n2 > 0:
-    #     grams.add(token_dict[text1[-1]].lemma.lower() + ' ' + token_dict[text2[0]].lemma.lower())
+    #     grams.add(lemma[text1[-1]] + ' ' + lemma[text2[0]])
     return grams
 
 
+def cached_span_feature(span, key, func, *args):
+    """ Features of a single span do not change while it sits on the stack
+        or queue, so they are computed once and kept on the span
+
+    :type span: SpanNode
+    :param span: the span the features belong to
+
+    :param key: name of the feature group in the span cache
+
+    :param func: function computing the feature group from args
+    """
+    try:
+        return span.feature_cache[key]
+    except KeyError:
+        value = span.feature_cache[key] = func(*args)
+        return value
+
+
+def get_boundaries(tok_span, doc):
+    """ Whether the text span starts or ends a sentence, paragraph
+        or the document
+
+    :type tok_span: tuple of int
+    :param tok_span: indices of the first and last word of the text span
+
+    :type doc: Doc
+    :param doc: the document instance
+    """
+    first, last = tok_span
+    sent_start = first == doc.sent_start[first]
+    sent_end = last == doc.sent_end[last]
+    para_start = first == doc.para_start[first]
+    para_end = last == doc.para_end[last]
+    doc_start = first == 0
+    doc_end = last == len(doc) - 1
+    return sent_start, sent_end, para_start, para_end, doc_start, doc_end
+
+
+def get_edu_heads(eduidx, doc):
+    """ Lemma, POS tag and dependency label of the tokens of an EDU
+        whose syntactic head is outside of the EDU
+
+    :type eduidx: int
+    :param eduidx: index of one EDU
+
+    :type doc: Doc
+    :param doc: the document instance
+    """
+    first, last = doc.edu_spans[eduidx]
+    edu_heads = []
+    for gidx in range(first, last + 1):
+        if not first <= doc.head_gidx[gidx] <= last:
+            # The sentence-local index of the token is used as a document
+            # index, as in the original feature extraction. The quirk is kept
+            # on purpose, fixing it would change the features of trained models.
+            local_idx = doc.tidx[gidx] - 1
+            edu_heads.append((doc.lemma[local_idx], doc.pos[local_idx], doc.dep_label[gidx]))
+    return edu_heads
+
+
+def get_dep_attachment(tok_span, head_span, doc):
+    """ First token of a text span whose syntactic head lies in another
+        text span of the same sentence
+
+    :type tok_span: tuple of int
+    :param tok_span: indices of the first and last word of the dependent span
+
+    :type head_span: tuple of int
+    :param head_span: indices of the first and last word of the head span
+
+    :type doc: Doc
+    :param doc: the document instance
+
+    :return: document-level index of the token or None
+    """
+    head_first, head_last = head_span
+    heads = doc.head_gidx
+    for gidx in range(tok_span[0], tok_span[1] + 1):
+        if head_first <= heads[gidx] <= head_last:
+            return gidx
+    return None
+
+
 def get_dist_to_begin_end(node, doc):
+    """ Distance of the span to the begin and end of the sentence (in EDUs),
+        paragraph (in sentences) or document (in paragraphs)
+
+    The end of the sentence or paragraph is searched from the last token
+    on, so a span reaching into the next one ends right before its last
+    token.
+    """
     dist_to_begin = -1
     dist_to_end = -1
+    first, last = node.tok_span
     if node.level == 0:
-        sent_idx = doc.token_dict[node.text[0]].sidx
-        sent_start_tidx = node.text[0]
-        while sent_start_tidx >= 0 and doc.token_dict[sent_start_tidx].sidx == sent_idx:
-            sent_start_tidx -= 1
-        sent_start_tidx += 1
-        dist_to_begin = doc.token_dict[node.text[0]].eduidx - doc.token_dict[sent_start_tidx].eduidx
-        sent_end_tidx = node.text[-1]
-        while sent_end_tidx < len(doc.token_dict) and doc.token_dict[sent_end_tidx].sidx == sent_idx:
-            sent_end_tidx += 1
-        sent_end_tidx -= 1
-        dist_to_end = doc.token_dict[sent_end_tidx].eduidx - doc.token_dict[node.text[-1]].eduidx
+        sent_start_tidx = doc.sent_start[first]
+        dist_to_begin = doc.eduidx[first] - doc.eduidx[sent_start_tidx]
+        if doc.sidx[last] == doc.sidx[first]:
+            sent_end_tidx = doc.sent_end[last]
+        else:
+            sent_end_tidx = last - 1
+        dist_to_end = doc.eduidx[sent_end_tidx] - doc.eduidx[last]
 
     if node.level == 1 and node.lnode is not None and node.rnode is not None:
-        para_idx = doc.token_dict[node.text[0]].pidx
-        para_start_tidx = node.text[0]
-        while para_start_tidx >= 0 and doc.token_dict[para_start_tidx].pidx == para_idx:
-            para_start_tidx -= 1
-        para_start_tidx += 1
-        dist_to_begin = doc.token_dict[node.text[0]].sidx - doc.token_dict[para_start_tidx].sidx
-        para_end_tidx = node.text[-1]
-        while para_end_tidx < len(doc.token_dict) and doc.token_dict[para_end_tidx].pidx == para_idx:
-            para_end_tidx += 1
-        para_end_tidx -= 1
-        dist_to_end = doc.token_dict[para_end_tidx].sidx - doc.token_dict[node.text[-1]].sidx
+        para_start_tidx = doc.para_start[first]
+        dist_to_begin = doc.sidx[first] - doc.sidx[para_start_tidx]
+        if doc.pidx[last] == doc.pidx[first]:
+            para_end_tidx = doc.para_end[last]
+        else:
+            para_end_tidx = last - 1
+        dist_to_end = doc.sidx[para_end_tidx] - doc.sidx[last]
 
     if node.level == 2:
-        dist_to_begin = doc.token_dict[node.text[0]].pidx
-        dist_to_end = doc.token_dict[len(doc.token_dict) - 1].pidx - doc.token_dict[node.text[-1]].pidx
+        dist_to_begin = doc.pidx[first]
+        dist_to_end = doc.pidx[len(doc) - 1] - doc.pidx[last]
 
-    return dist_to_begin, dist_to_end
+    return int(dist_to_begin), int(dist_to_end)
 
 
-def get_bc(eduidx, edu_dict, token_dict, bcvocab, nprefix=5):
+def get_bc(eduidx, doc, bcvocab, nprefix=5):
     """ Get brown cluster features for tokens
 
     :type eduidx: int
     :param eduidx: index of one EDU
 
-    :type edu_dict: dict
-    :param edu_dict: All EDUs in one dict
-
-    :type token_dict: dict of Token (data structure)
-    :param token_dict: all tokens in the doc, indexing by the
-                      document-level index
+    :type doc: Doc
+    :param doc: the document instance
 
-    :type bcvocab: dict {word : braown-cluster-index}
+    :type bcvocab: BrownClusters or dict {word : braown-cluster-index}
     :param bcvocab: brown clusters
 
     :type nprefix: int
     :param nprefix: number of prefix we want to keep from
                     cluster indices
     """
-    text = edu_dict[eduidx]
+    first, last = doc.edu_spans[eduidx]
+    if isinstance(bcvocab, BrownClusters):
+        return set(bcvocab.lookup_prefixes(doc.lemma_lower[first:last + 1], nprefix))
     bc_features = set()
-    for gidx in text:
-        tok = token_dict[gidx].lemma.lower()
+    for tok in doc.lemma_lower[first:last + 1]:
         try:
             bc_idx = bcvocab[tok][:nprefix]
             bc_features.add(bc_idx)
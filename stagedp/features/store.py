@@ -0,0 +1,174 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+import numpy
+from scipy.sparse import csr_matrix, load_npz, save_npz
+
+from stagedp.utils.other import default_mode
+
+# Version of the feature extraction, part of the store keys, increase it
+# whenever the features change
+FEATURE_VERSION = 1
+
+# Vectorized samples, matrix is a CSR matrix with one row per sample, labels
+# index into classes, which are kept in order of their first occurrence, and
+# feature_names are the sorted columns of the DictVectorizer
+Samples = namedtuple('Samples', 'matrix labels classes feature_names')
+
+
+def vectorize_samples(samples):
+    """ Vectorize (feature dict, label) pairs like the DictVectorizer of the
+        training pipeline
+    """
+    from sklearn.feature_extraction import DictVectorizer
+    features, labels, class_ids = [], [], {}
+    for feats, label in samples:
+        features.append(feats)
+        labels.append(class_ids.setdefault(label, len(class_ids)))
+    if not features:
+        return Samples(csr_matrix((0, 0)), numpy.zeros(0, dtype=numpy.int64), [], [])
+    vectorizer = DictVectorizer()
+    matrix = vectorizer.fit_transform(features)
+    return Samples(matrix, numpy.array(labels, dtype=numpy.int64), list(class_ids), vectorizer.feature_names_)
+
+
+def merge_samples(shards):
+    """ Stack samples vectorized separately into the samples of
+        vectorize_samples over all shards in the given order
+
+    The columns of each shard are mapped into the sorted union of the feature
+    names, which keeps their order within each row, and the labels are mapped
+    into the union of the classes in order of their first occurrence.
+    """
+    feature_names = sorted(set().union(*(shard.feature_names for shard in shards)))
+    feature_ids = {name: idx for idx, name in enumerate(feature_names)}
+    class_ids = {}
+    data, indices, indptr, labels = [], [], [numpy.zeros(1, dtype=numpy.int64)], []
+    n_rows = 0
+    for shard in shards:
+        column_map = numpy.array([feature_ids[name] for name in shard.feature_names], dtype=numpy.int64)
+        class_map = numpy.array([class_ids.setdefault(label, len(class_ids)) for label in shard.classes],
+                                dtype=numpy.int64)
+        matrix = shard.matrix
+        data.append(matrix.data)
+        indices.append(column_map[matrix.indices])
+        indptr.append(matrix.indptr[1:].astype(numpy.int64) + indptr[-1][-1])
+        labels.append(class_map[shard.labels])
+        n_rows += matrix.shape[0]
+    matrix = csr_matrix((numpy.concatenate(data), numpy.concatenate(indices), numpy.concatenate(indptr)),
+                        shape=(n_rows, len(feature_names)))
+    return Samples(matrix, numpy.concatenate(labels), list(class_ids), feature_names)
+
+
+def corpus_fingerprint(rst_trees):
+    """ Hash of the gold trees and the annotations of their documents
+    """
+    digest = hashlib.sha256()
+    for rst_tree in rst_trees:
+        doc = rst_tree.doc
+        digest.update(rst_tree.get_parse().encode('utf-8'))
+        for column in (doc.word, doc.lemma, doc.pos, doc.dep_label):
+            digest.update('\x00'.join(column.tolist()).encode('utf-8'))
+        for column in (doc.pidx, doc.sidx, doc.tidx, doc.hidx, doc.eduidx):
+            digest.update(numpy.ascontiguousarray(column).tobytes())
+    return digest.hexdigest()
+
+
+def bcvocab_fingerprint(bcvocab):
+    """ Hash of the Brown clusters, None without clusters
+    """
+    if bcvocab is None:
+        return None
+    digest = hashlib.sha256()
+    if hasattr(bcvocab, 'words'):
+        for array in (bcvocab.words, bcvocab.clusters, bcvocab.paths):
+            digest.update(numpy.ascontiguousarray(array).tobytes())
+    else:
+        for word, path in sorted(bcvocab.items()):
+            digest.update(f'{word}\t{path}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fit_pipeline(pipeline, samples, labels):
+    """ Fit a vectorizer + model pipeline on vectorized samples, the
+        vectorizer takes over the feature vocabulary of the samples
+    """
+    vectorizer = pipeline['vectorizer']
+    vectorizer.feature_names_ = list(samples.feature_names)
+    vectorizer.vocabulary_ = {name: idx for idx, name in enumerate(samples.feature_names)}
+    pipeline['model'].fit(samples.matrix, labels)
+    return pipeline
+
+
+class FeatureStore:
+    """ On-disk store of vectorized training samples
+
+    An entry holds the samples of one corpus under one feature configuration,
+    it is addressed by a hash of the corpus fingerprint and the configuration.
+    Each sample set is a directory with the CSR matrix, the label array and
+    the feature vocabulary, written to a temporary directory first and then
+    renamed, so concurrent runs never see partial entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(fingerprint, config):
+        content = json.dumps({'corpus': fingerprint, 'features': config}, sort_keys=True)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key, name):
+        return os.path.join(self.path, key, name)
+
+    def load(self, key, name):
+        """ Samples stored under key and name, None if there are none
+        """
+        path = self.entry_path(key, name)
+        if not os.path.isfile(os.path.join(path, 'samples.json')):
+            return None
+        with open(os.path.join(path, 'samples.json')) as fin:
+            meta = json.load(fin)
+        feature_names = numpy.load(os.path.join(path, 'feature_names.npy'), allow_pickle=False)
+        samples = Samples(matrix=load_npz(os.path.join(path, 'matrix.npz')).tocsr(),
+                          labels=numpy.load(os.path.join(path, 'labels.npy'), allow_pickle=False),
+                          classes=[tuple(label) if isinstance(label, list) else label for label in meta['classes']],
+                          feature_names=[name.decode('utf-8') for name in feature_names.tolist()])
+        logging.info('Load {} samples with {} features from {}'.format(samples.matrix.shape[0],
+                                                                       samples.matrix.shape[1], path))
+        return samples
+
+    def save(self, key, name, samples):
+        path = self.entry_path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path), prefix=f'.{name}.')
+        try:
+            save_npz(os.path.join(tmp_path, 'matrix.npz'), samples.matrix, compressed=False)
+            numpy.save(os.path.join(tmp_path, 'labels.npy'), samples.labels)
+            numpy.save(os.path.join(tmp_path, 'feature_names.npy'),
+                       numpy.array([name.encode('utf-8') for name in samples.feature_names], dtype=bytes))
+            with open(os.path.join(tmp_path, 'samples.json'), 'w') as fout:
+                json.dump({'classes': samples.classes,
+                           'n_samples': samples.matrix.shape[0],
+                           'n_features': samples.matrix.shape[1]}, fout)
+            # mkdtemp creates the directory readable by the owner only
+            os.chmod(tmp_path, default_mode(0o777))
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process stored the same samples in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        logging.info('Save {} samples with {} features into {}'.format(samples.matrix.shape[0],
+                                                                       samples.matrix.shape[1], path))
+
@@ -4,13 +4,10 @@ import pickle
 from collections import Counter
 from operator import itemgetter
 
-from sklearn.feature_extraction import DictVectorizer
-from sklearn.linear_model import SGDClassifier
-from sklearn.metrics import classification_report
-from sklearn.pipeline import Pipeline
+import numpy
 
-from stagedp.features.extraction import ActionFeatureGenerator
-from stagedp.models.state import ParsingState
+from stagedp.features.store import fit_pipeline
+from stagedp.models.scorer import LinearScorer, drop_missing
 from stagedp.utils.other import reverse_dict
 
 
@@ -18,30 +15,61 @@ class ActionClassifier:
     def __init__(self, actionxid_map):
         self.actionxid_map = actionxid_map
         self.idxaction_map = reverse_dict(actionxid_map)
-        self.model = Pipeline([
+        # sklearn pipeline, created for training or restored from a pickled model
+        self.model = None
+        # Compiled inference engine of the fitted model
+        self.scorer = None
+
+    @staticmethod
+    def new_model(n_jobs=-1):
+        """ Untrained vectorizer and classifier pipeline, sklearn is only
+            imported when a model is trained, n_jobs cores fit the
+            one-vs-all classifiers
+        """
+        from sklearn.feature_extraction import DictVectorizer
+        from sklearn.linear_model import SGDClassifier
+        from sklearn.pipeline import Pipeline
+        return Pipeline([
             ('vectorizer', DictVectorizer()),
             # ('variance', VarianceThreshold(threshold=0.0001)),
-            ('model', SGDClassifier(loss='log', penalty='l2', average=32, tol=1e-7, max_iter=1000, n_jobs=-1,
+            ('model', SGDClassifier(loss='log', penalty='l2', average=32, tol=1e-7, max_iter=1000, n_jobs=n_jobs,
                                     class_weight='balanced'))
             # ('model', RandomForestClassifier(n_estimators=1000, max_depth=25, min_samples_split=5, min_samples_leaf=3,
             #                                  random_state=0, n_jobs=-1))
         ])
 
-    def train(self, rst_tree_instances, brown_clusters):
+    def train(self, samples, n_jobs=-1):
         """ Perform batch-learning on parsing models action classifier
+
+        :type samples: Samples
+        :param samples: vectorized action samples, see TrainingSamples.action
+
+        :type n_jobs: int
+        :param n_jobs: number of cores of the fit, -1 for all
         """
+        from sklearn.metrics import classification_report
         logging.info('Training classifier for action...')
-        action_fvs, action_labels = list(zip(*self.generate_train_data(rst_tree_instances, brown_clusters)))
-        self.model.fit(action_fvs, action_labels)
-        print(self.model.score(action_fvs, action_labels))
-        action_preds = self.model.predict(action_fvs)
+        action_labels = numpy.array([self.actionxid_map[action] for action in samples.classes])[samples.labels]
+        self.model = fit_pipeline(self.new_model(n_jobs), samples, action_labels)
+        print(self.model['model'].score(samples.matrix, action_labels))
+        action_preds = self.model['model'].predict(samples.matrix)
         print(classification_report(action_labels, action_preds))
+        self.scorer = LinearScorer.from_pipeline(self.model)
 
     def predict_probs(self, features):
         """ predict labels and rank the decision label with their confidence
             value, output labels and probabilities
         """
-        vals = self.model.predict_proba([features])[0]
+        vals = self.scorer.predict_proba(features)
+        return self.rank_actions(vals)
+
+    def predict_probs_batch(self, features_list):
+        """ predict_probs for a batch of feature dicts with one sparse
+            matrix product
+        """
+        return [self.rank_actions(vals) for vals in self.scorer.predict_proba_batch(features_list)]
+
+    def rank_actions(self, vals):
         action_vals = {}
         for idx in range(len(self.idxaction_map)):
             action_vals[self.idxaction_map[idx]] = vals[idx]
@@ -51,6 +79,8 @@ class ActionClassifier:
     def save(self, fname):
         """ Save models
         """
+        if self.model is None:
+            raise ValueError('Models loaded from the native format can only be saved with save_native')
         if not fname.endswith('.gz'):
             fname += '.gz'
         data = {'action_clf': self.model,
@@ -69,54 +99,83 @@ class ActionClassifier:
         actionxid_map = data['actionxid_map']
         clf = ActionClassifier(actionxid_map)
         clf.model = data['action_clf']
+        clf.scorer = LinearScorer.from_pipeline(clf.model)
         logging.info('Load action classifier from file: '
                      '{} with {} features and {} actions.'.format(fname, clf.model['model'].n_features_in_,
                                                                   len(actionxid_map)))
         return clf
 
+    def save_native(self, path):
+        """ Save the weights as .npy files into path, returns the
+            manifest entry of the classifier
+        """
+        scorer = self.scorer.save(path)
+        logging.info('Save action classifier into directory: '
+                     '{} with {} features and {} actions.'.format(path, scorer['n_features'],
+                                                                  len(self.actionxid_map)))
+        return {'scorer': scorer,
+                'actionxid_map': [[list(action), idx] for action, idx in self.actionxid_map.items()]}
+
+    @staticmethod
+    def load_native(path, manifest):
+        """ Load the weights saved by save_native, the arrays are memory-mapped
+        """
+        actionxid_map = {tuple(action): idx for action, idx in manifest['actionxid_map']}
+        clf = ActionClassifier(actionxid_map)
+        clf.scorer = LinearScorer.load(path, separator=manifest['scorer']['separator'],
+                                       hashing=manifest['scorer'].get('hashing'))
+        logging.info('Load action classifier from directory: '
+                     '{} with {} features and {} actions.'.format(path, manifest['scorer']['n_features'],
+                                                                  len(actionxid_map)))
+        return clf
+
     @staticmethod
     def from_data(rst_tree_instances, brown_clusters):
-        action_cnt = Counter(action for rst_tree in rst_tree_instances
-                             for features, action in generate_action_samples(rst_tree, brown_clusters))
+        """ Create the action map from the oracle actions of the trees,
+            which need no feature extraction
+        """
+        action_cnt = Counter(action for rst_tree in rst_tree_instances for action in action_labels(rst_tree))
+        return ActionClassifier.from_counts(action_cnt)
+
+    @staticmethod
+    def from_counts(action_cnt):
+        """ Number the actions in order of their first occurrence
+        """
         action_map = {a: i for i, a in enumerate(action_cnt)}
         logging.info('{} types of actions: {}'.format(len(action_map), action_map.keys()))
         for action, cnt in action_cnt.items():
             logging.info('{}\t{}'.format(action, cnt))
         return ActionClassifier(action_map)
 
-    def generate_train_data(self, rst_tree_instances, brown_clusters):
-        for rst_tree in rst_tree_instances:
-            for feats, action in generate_action_samples(rst_tree, brown_clusters):
-                yield feats, self.actionxid_map[action]
+    @staticmethod
+    def new_streaming_model(n_features, class_weight):
+        """ Hashing vectorizer and classifier pipeline for training with
+            partial_fit, class_weight holds the weight of every action id
+        """
+        from sklearn.feature_extraction import FeatureHasher
+        from sklearn.linear_model import SGDClassifier
+        from sklearn.pipeline import Pipeline
+        return Pipeline([
+            ('vectorizer', FeatureHasher(n_features=n_features, input_type='dict')),
+            ('model', SGDClassifier(loss='log', penalty='l2', average=32, class_weight=class_weight))
+        ])
+
+    def partial_fit(self, action_fvs, actions):
+        """ Update the streaming model with a minibatch of samples
+        """
+        model = self.model['model']
+        model.partial_fit(self.model['vectorizer'].transform(drop_missing(action_fvs)),
+                          [self.actionxid_map[action] for action in actions],
+                          classes=numpy.array(sorted(model.class_weight)))
 
 
-def generate_action_samples(rst_tree, bcvocab):
-    """ Generate action samples from an binary RST tree
-    :type bcvocab: dict
-    :param bcvocab: brown clusters of words
+def action_labels(rst_tree):
+    """ Oracle actions of a binary RST tree, derived from its structure alone
     """
-    # post_nodelist = RstTree.postorder_DFT(rst_tree.tree, [])
-    # action_list = []
-    # relation_list = []
-    action_hist = []
-    # Initialize queue and stack
-    queue = rst_tree.get_edu_node()
-    stack = []
-    # Start simulating the shift-reduce parsing
-    sr_parser = ParsingState(stack, queue)
     for node in rst_tree.postorder():
         if (node.lnode is None) and (node.rnode is None):
-            action = ('Shift', None)
+            yield 'Shift', None
         elif (node.lnode is not None) and (node.rnode is not None):
-            form = node.form
-            action = ('Reduce', form)
+            yield 'Reduce', node.form
         else:
             raise ValueError("Can not decode Shift-Reduce action")
-        stack, queue = sr_parser.get_status()
-        # Generate features
-        action_feats = ActionFeatureGenerator(stack, queue, action_hist, rst_tree.doc, bcvocab).gen_features()
-        yield action_feats, action
-        # Change status of stack/queue
-        # action and relation are necessary here to avoid change rst_trees
-        sr_parser.operate(action)
-        action_hist.append(action)
@@ -1,36 +1,106 @@
+import heapq
+import json
+import logging
+import math
 import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from operator import itemgetter
 
 from stagedp.features.extraction import ActionFeatureGenerator, RelationFeatureGenerator
 from stagedp.models.action import ActionClassifier
 from stagedp.models.relation import RelationClassifier
-from stagedp.models.state import ParsingState
+from stagedp.models.samples import TrainingSamples
+from stagedp.models.state import BeamState, ParsingState
 from stagedp.models.tree import RstTree
 
+# Version tag of the native model directory format
+NATIVE_FORMAT = 'stagedp-native-1'
+
 
 class RstParser:
     def __init__(self, action_clf, relation_clf):
         self.action_clf: ActionClassifier = action_clf
         self.relation_clf: RelationClassifier = relation_clf
 
-    def train(self, rst_train, brown_clusters):
-        self.action_clf.train(rst_train, brown_clusters)
-        self.relation_clf.train(rst_train, brown_clusters)
+    def train(self, rst_train, brown_clusters, samples=None, workers=1):
+        """ Train both classifiers
+
+        :type samples: TrainingSamples
+        :param samples: shared training samples of rst_train, e.g. backed by a
+                        FeatureStore
+
+        :type workers: int
+        :param workers: number of threads fitting the action model and the
+                        relation models at the same time, 1 fits them one
+                        after another with all cores each. The cores are
+                        shared between the threads.
+        """
+        if samples is None:
+            samples = TrainingSamples(rst_train, brown_clusters)
+        action_samples = samples.action()
+        relation_samples = [samples.relation(level) for level in [0, 1, 2]]
+        if workers <= 1:
+            self.action_clf.train(action_samples)
+            for level in [0, 1, 2]:
+                self.relation_clf.train_level(relation_samples[level], level)
+            return
+        n_jobs = max(1, (os.cpu_count() or 1) // workers)
+        tasks = [(self.action_clf.train, action_samples, n_jobs)]
+        tasks += [(self.relation_clf.train_level, relation_samples[level], level, n_jobs) for level in [0, 1, 2]]
+        # the models are independent and sklearn releases the GIL while fitting
+        with ThreadPoolExecutor(workers) as executor:
+            for future in [executor.submit(*task) for task in tasks]:
+                future.result()
 
-    def save(self, model_dir):
+    def save(self, model_dir, native=False):
         """Save models
+
+        :type native: bool
+        :param native: save the weights as .npy files with a JSON manifest
+                       instead of pickled sklearn pipelines
         """
-        self.action_clf.save(os.path.join(model_dir, 'model.action.gz'))
-        self.relation_clf.save(os.path.join(model_dir, 'model.relation.gz'))
+        if native:
+            manifest = {'format': NATIVE_FORMAT,
+                        'action': self.action_clf.save_native(os.path.join(model_dir, 'action')),
+                        'relation': self.relation_clf.save_native(os.path.join(model_dir, 'relation'))}
+            with open(os.path.join(model_dir, 'manifest.json'), 'w') as fout:
+                json.dump(manifest, fout, indent=2)
+        else:
+            self.action_clf.save(os.path.join(model_dir, 'model.action.gz'))
+            self.relation_clf.save(os.path.join(model_dir, 'model.relation.gz'))
 
     @staticmethod
     def load(model_dir):
-        """ Load models
+        """ Load models, a directory with a manifest.json holds the native
+            format and is loaded with memory-mapped weights
         """
-        action_clf = ActionClassifier.load(os.path.join(model_dir, 'model.action.gz'))
-        relation_clf = RelationClassifier.load(os.path.join(model_dir, 'model.relation.gz'))
+        manifest_file = os.path.join(model_dir, 'manifest.json')
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as fin:
+                manifest = json.load(fin)
+            if manifest.get('format') != NATIVE_FORMAT:
+                raise ValueError('Unknown model format: {}'.format(manifest.get('format')))
+            action_clf = ActionClassifier.load_native(os.path.join(model_dir, 'action'), manifest['action'])
+            relation_clf = RelationClassifier.load_native(os.path.join(model_dir, 'relation'), manifest['relation'])
+        else:
+            action_clf = ActionClassifier.load(os.path.join(model_dir, 'model.action.gz'))
+            relation_clf = RelationClassifier.load(os.path.join(model_dir, 'model.relation.gz'))
         return RstParser(action_clf, relation_clf)
 
-    def sr_parse(self, doc, bcvocab=None):
+    def build_index(self):
+        """ Build the feature dicts of memory-mapped models, which pays off
+            for processes parsing many documents
+        """
+        self.action_clf.scorer.build_index()
+        for scorer in self.relation_clf.scorers:
+            scorer.build_index()
+        return self
+
+    def sr_parse(self, doc, bcvocab=None, beam_size=1):
         """ Shift-reduce RST parsing based on models prediction
 
         :type doc: Doc
@@ -38,34 +108,181 @@ class RstParser:
 
         :type bcvocab: dict
         :param bcvocab: brown clusters
+
+        :type beam_size: int
+        :param beam_size: number of parsing states kept by beam search,
+                          1 for greedy decoding
         """
-        # use transition-based parsing to build tree structure
-        conf = ParsingState([], [])
-        conf.init(doc)
-        action_hist = []
-        while not conf.end_parsing():
-            stack, queue = conf.get_status()
-            action_feats = ActionFeatureGenerator(stack, queue, action_hist, doc, bcvocab).gen_features()
-            action_probs = self.action_clf.predict_probs(action_feats)
-            for action, cur_prob in action_probs:
-                if conf.is_action_allowed(action):
-                    conf.operate(action)
-                    action_hist.append(action)
-                    break
-        tree = conf.get_parse_tree()
+        if beam_size > 1:
+            tree = self.beam_search(doc, bcvocab, beam_size)
+        else:
+            # use transition-based parsing to build tree structure
+            conf = ParsingState([], [])
+            conf.init(doc)
+            action_hist = []
+            while not conf.end_parsing():
+                stack, queue = conf.get_status()
+                action_feats = ActionFeatureGenerator(stack, queue, action_hist, doc, bcvocab).gen_features()
+                action_probs = self.action_clf.predict_probs(action_feats)
+                for action, cur_prob in action_probs:
+                    if conf.is_action_allowed(action):
+                        conf.operate(action)
+                        action_hist.append(action)
+                        break
+            tree = conf.get_parse_tree()
         # assign the node to rst_tree
         rst_tree = RstTree(tree, doc)
-        # tag relations for the tree
+        # tag relations for the tree, the nodes of each level are labelled together
+        level_nodes, level_feats = defaultdict(list), defaultdict(list)
         for node in rst_tree.postorder():
             if (node.lnode is not None) and (node.rnode is not None):
                 fg = RelationFeatureGenerator(node, rst_tree, node.level, bcvocab)
-                relation_feats = fg.gen_features()
-                relation = self.relation_clf.predict(relation_feats, node.level)
+                level_nodes[node.level].append(node)
+                level_feats[node.level].append(fg.gen_features())
+        for level, nodes in level_nodes.items():
+            relations = self.relation_clf.predict_batch(level_feats[level], level)
+            for node, relation in zip(nodes, relations):
                 node.assign_relation(relation)
         return rst_tree
 
+    def beam_search(self, doc, bcvocab, beam_size):
+        """ Build the tree structure with beam search over parsing states,
+            the score of a state is the log probability of its actions
+
+        :type doc: Doc
+        :param doc: the document instance
+
+        :type bcvocab: dict
+        :param bcvocab: brown clusters
+
+        :type beam_size: int
+        :param beam_size: number of parsing states kept after each step
+        """
+        beam = [BeamState.init(doc)]
+        step_times = []
+        # Every complete parse takes the same number of actions,
+        # so all states of the beam finish at the same step
+        while not beam[0].end_parsing():
+            start = time.perf_counter()
+            action_feats = [ActionFeatureGenerator(state.Stack, state.Queue, state.action_hist, doc,
+                                                   bcvocab).gen_features() for state in beam]
+            candidates = []
+            for state, action_probs in zip(beam, self.action_clf.predict_probs_batch(action_feats)):
+                for action, cur_prob in action_probs:
+                    if state.is_action_allowed(action):
+                        score = state.score + (math.log(cur_prob) if cur_prob > 0 else -math.inf)
+                        candidates.append((score, state, action))
+            best = heapq.nlargest(beam_size, candidates, key=itemgetter(0))
+            beam = [state.operate(action, score) for score, state, action in best]
+            step_times.append(time.perf_counter() - start)
+        if step_times:
+            logging.debug('Beam search with beam size {}: {} steps, {:.3f} ms per step'.format(
+                beam_size, len(step_times), 1000 * sum(step_times) / len(step_times)))
+        return beam[0].get_parse_tree()
+
+    def parse_many(self, docs, bcvocab=None, workers=None, chunksize=1, ordered=True, beam_size=1,
+                   max_pending=None):
+        """ Parse many documents with a pool of worker processes
+
+        Every worker receives the parsing models and the brown clusters once
+        when it is started, documents are then sent to the workers in chunks.
+        Documents are taken from docs only while fewer than max_pending of
+        them are sent but not yielded back, so a lazy iterable is read no
+        further ahead than that.
+
+        :type docs: iterable of Doc
+        :param docs: the document instances
+
+        :type bcvocab: dict
+        :param bcvocab: brown clusters
+
+        :type workers: int
+        :param workers: number of worker processes, defaults to the number of cores
+
+        :type chunksize: int
+        :param chunksize: number of documents sent to a worker at once
+
+        :type ordered: bool
+        :param ordered: yield trees in input order, otherwise yield (index, tree)
+                        tuples as soon as they are completed
+
+        :type beam_size: int
+        :param beam_size: beam size for decoding, 1 for greedy decoding
+
+        :type max_pending: int
+        :param max_pending: maximum number of documents in the pool, two
+                            chunks per worker by default
+        """
+        if workers == 1:
+            for idx, doc in enumerate(docs):
+                rst_tree = self.sr_parse(doc, bcvocab, beam_size)
+                yield rst_tree if ordered else (idx, rst_tree)
+            return
+        if max_pending is None:
+            max_pending = 2 * (workers or os.cpu_count() or 1) * chunksize
+        # the pool takes whole chunks from docs
+        max_pending = max(max_pending, chunksize)
+        pending = threading.Semaphore(max_pending)
+        stopped = False
+
+        def bounded(items):
+            # runs in the task thread of the pool
+            for item in items:
+                pending.acquire()
+                if stopped:
+                    return
+                yield item
+
+        with self.worker_pool(bcvocab, workers, beam_size) as pool:
+            if ordered:
+                results = pool.imap(_parse_doc, bounded(docs), chunksize=chunksize)
+            else:
+                results = pool.imap_unordered(_parse_indexed_doc, bounded(enumerate(docs)), chunksize=chunksize)
+            try:
+                for result in results:
+                    pending.release()
+                    yield result
+            finally:
+                # wake up the task thread, the pool waits for it on exit
+                stopped = True
+                pending.release(max_pending)
+
+    def worker_pool(self, bcvocab=None, workers=None, beam_size=1):
+        """ Pool of worker processes which receive the parser, the brown
+            clusters and the beam size once when they are started
+        """
+        return Pool(workers, initializer=_init_worker, initargs=(self, bcvocab, beam_size))
+
+    @staticmethod
+    def parse_async(pool, doc):
+        """ Parse doc in a worker of a pool of worker_pool, returns an
+            AsyncResult of the tree
+        """
+        return pool.apply_async(_parse_doc, (doc,))
+
     @staticmethod
     def from_data(rst_train, brown_clusters):
         action_clf = ActionClassifier.from_data(rst_train, brown_clusters)
         relation_clf = RelationClassifier.from_data(rst_train, brown_clusters)
         return RstParser(action_clf, relation_clf)
+
+
+# Parser, brown clusters and beam size of a worker process, set once by _init_worker
+_worker_parser = None
+_worker_bcvocab = None
+_worker_beam_size = 1
+
+
+def _init_worker(parser, bcvocab, beam_size):
+    global _worker_parser, _worker_bcvocab, _worker_beam_size
+    # a no-op if the parent process built the feature dicts before the fork
+    _worker_parser, _worker_bcvocab, _worker_beam_size = parser.build_index(), bcvocab, beam_size
+
+
+def _parse_doc(doc):
+    return _worker_parser.sr_parse(doc, _worker_bcvocab, _worker_beam_size)
+
+
+def _parse_indexed_doc(item):
+    idx, doc = item
+    return idx, _worker_parser.sr_parse(doc, _worker_bcvocab, _worker_beam_size)
@@ -1,13 +1,13 @@
 import gzip
 import logging
+import os
 import pickle
 from collections import Counter
 
-from sklearn.feature_extraction import DictVectorizer
-from sklearn.linear_model import SGDClassifier
-from sklearn.pipeline import Pipeline
+import numpy
 
-from stagedp.features.extraction import RelationFeatureGenerator
+from stagedp.features.store import fit_pipeline
+from stagedp.models.scorer import LinearScorer, drop_missing
 from stagedp.utils.other import reverse_dict
 
 
@@ -15,44 +15,63 @@ class RelationClassifier:
     def __init__(self, relationxid_map):
         self.relationxid_map = relationxid_map
         self.idxrelation_map = reverse_dict(relationxid_map)
-        self.models = [
-            Pipeline([
-                ('vectorizer', DictVectorizer()),
-                # ('variance', VarianceThreshold(threshold=0.0001)),
-                ('model', SGDClassifier(loss='log', penalty='l2', average=32, tol=1e-7, max_iter=1000, n_jobs=-1,
-                                        class_weight='balanced'))
-            ]),
-            Pipeline([
-                ('vectorizer', DictVectorizer()),
-                # ('variance', VarianceThreshold(threshold=0.0001)),
-                ('model', SGDClassifier(loss='log', penalty='l2', average=32, tol=1e-7, max_iter=1000, n_jobs=-1,
-                                        class_weight='balanced'))
-            ]),
-            Pipeline([
-                ('vectorizer', DictVectorizer()),
-                # ('variance', VarianceThreshold(threshold=0.0001)),
-                ('model', SGDClassifier(loss='log', penalty='l2', average=32, tol=1e-7, max_iter=1000, n_jobs=-1,
-                                        class_weight='balanced'))
-            ])
-        ]
-
-    def train(self, rst_tree_instances, brown_clusters):
+        # sklearn pipelines of the three levels, created for training or restored from a pickled model
+        self.models = [None, None, None]
+        # Compiled inference engines of the fitted models
+        self.scorers = [None, None, None]
+
+    @staticmethod
+    def new_model(n_jobs=-1):
+        """ Untrained vectorizer and classifier pipeline, sklearn is only
+            imported when a model is trained, n_jobs cores fit the
+            one-vs-all classifiers
+        """
+        from sklearn.feature_extraction import DictVectorizer
+        from sklearn.linear_model import SGDClassifier
+        from sklearn.pipeline import Pipeline
+        return Pipeline([
+            ('vectorizer', DictVectorizer()),
+            # ('variance', VarianceThreshold(threshold=0.0001)),
+            ('model', SGDClassifier(loss='log', penalty='l2', average=32, tol=1e-7, max_iter=1000, n_jobs=n_jobs,
+                                    class_weight='balanced'))
+        ])
+
+    def train(self, samples):
         """ Perform batch-learning on parsing models relation classifier
+
+        :type samples: list
+        :param samples: vectorized relation samples of each level, see
+                        TrainingSamples.relation
+        """
+        for level, level_samples in enumerate(samples):
+            self.train_level(level_samples, level)
+
+    def train_level(self, samples, level, n_jobs=-1):
+        """ Fit the model of level on its vectorized samples with n_jobs
+            cores, -1 for all
         """
-        for level in [0, 1, 2]:
-            logging.info('Training classifier for relation at level {}...'.format(level))
-            relation_fvs, relation_labels = list(zip(*self.gen_train_data(rst_tree_instances,
-                                                                          brown_clusters, level)))
-            logging.info('{} relation samples at level {}.'.format(len(relation_labels), level))
-            self.models[level].fit(relation_fvs, relation_labels)
+        logging.info('Training classifier for relation at level {}...'.format(level))
+        labels = numpy.array([self.relationxid_map[relation] for relation in samples.classes])[samples.labels]
+        logging.info('{} relation samples at level {}.'.format(len(labels), level))
+        self.models[level] = fit_pipeline(self.new_model(n_jobs), samples, labels)
+        self.scorers[level] = LinearScorer.from_pipeline(self.models[level])
 
     def predict(self, features, level):
-        pred_label = self.models[level].predict([features])[0]
+        pred_label = self.scorers[level].predict(features)
         return self.idxrelation_map[pred_label]
 
+    def predict_batch(self, features_list, level):
+        """ Predict the relations of many nodes of one level with one
+            sparse matrix product
+        """
+        pred_labels = self.scorers[level].predict_batch(features_list)
+        return [self.idxrelation_map[pred_label] for pred_label in pred_labels]
+
     def save(self, fname):
         """ Save models
         """
+        if None in self.models:
+            raise ValueError('Models loaded from the native format can only be saved with save_native')
         if not fname.endswith('.gz'):
             fname += '.gz'
         data = {'models': self.models,
@@ -75,6 +94,7 @@ class RelationClassifier:
         relationxid_map = data['relationxid_map']
         clf = RelationClassifier(relationxid_map)
         clf.models = models
+        clf.scorers = [LinearScorer.from_pipeline(model) for model in models]
         logging.info('Load relation classifier from file: {} with {} features at level 0, {} features at level 1, '
                      '{} features at level 2, and {} relations.'.format(fname,
                                                                         models[0]['model'].n_features_in_,
@@ -83,33 +103,85 @@ class RelationClassifier:
                                                                         len(relationxid_map)))
         return clf
 
+    def save_native(self, path):
+        """ Save the weights of each level as .npy files below path,
+            returns the manifest entry of the classifier
+        """
+        scorers = [scorer.save(os.path.join(path, str(level))) for level, scorer in enumerate(self.scorers)]
+        logging.info('Save relation classifier into directory: {} with {} features at level 0, {} features at '
+                     'level 1, {} features at level 2, and {} relations.'.format(path,
+                                                                                scorers[0]['n_features'],
+                                                                                scorers[1]['n_features'],
+                                                                                scorers[2]['n_features'],
+                                                                                len(self.idxrelation_map)))
+        return {'scorers': scorers,
+                'relationxid_map': self.relationxid_map}
+
+    @staticmethod
+    def load_native(path, manifest):
+        """ Load the weights saved by save_native, the arrays are memory-mapped
+        """
+        clf = RelationClassifier(manifest['relationxid_map'])
+        clf.scorers = [LinearScorer.load(os.path.join(path, str(level)), separator=scorer['separator'],
+                                         hashing=scorer.get('hashing'))
+                       for level, scorer in enumerate(manifest['scorers'])]
+        logging.info('Load relation classifier from directory: {} with {} features at level 0, {} features at '
+                     'level 1, {} features at level 2, and {} relations.'.format(path,
+                                                                                manifest['scorers'][0]['n_features'],
+                                                                                manifest['scorers'][1]['n_features'],
+                                                                                manifest['scorers'][2]['n_features'],
+                                                                                len(clf.idxrelation_map)))
+        return clf
+
     @staticmethod
     def from_data(rst_tree_instances, brown_clusters):
+        """ Create the relation map from the relations of the tree nodes,
+            which need no feature extraction
+        """
         relation_cnt = Counter(relation for lvl in [0, 1, 2]
                                for rst_tree in rst_tree_instances
-                               for features, relation in generate_relation_samples(rst_tree, brown_clusters, level=lvl))
+                               for relation in relation_labels(rst_tree, lvl))
+        return RelationClassifier.from_counts(relation_cnt)
+
+    @staticmethod
+    def from_counts(relation_cnt):
+        """ Number the relations in order of their first occurrence
+        """
         relation_map = {a: i for i, a in enumerate(relation_cnt)}
         logging.info('{} types of relations: {}'.format(len(relation_map), relation_map.keys()))
         for relation, cnt in relation_cnt.items():
             logging.info('{}\t{}'.format(relation, cnt))
         return RelationClassifier(relation_map)
 
-    def gen_train_data(self, rst_tree_instances, brown_clusters, level):
-        for rst_tree in rst_tree_instances:
-            for feats, relation in generate_relation_samples(rst_tree, brown_clusters, level):
-                yield feats, self.relationxid_map[relation]
+    @staticmethod
+    def new_streaming_model(n_features, class_weight):
+        """ Hashing vectorizer and classifier pipeline for training with
+            partial_fit, class_weight holds the weight of every relation id
+            of the level
+        """
+        from sklearn.feature_extraction import FeatureHasher
+        from sklearn.linear_model import SGDClassifier
+        from sklearn.pipeline import Pipeline
+        return Pipeline([
+            ('vectorizer', FeatureHasher(n_features=n_features, input_type='dict')),
+            ('model', SGDClassifier(loss='log', penalty='l2', average=32, class_weight=class_weight))
+        ])
+
+    def partial_fit(self, relation_fvs, relations, level):
+        """ Update the streaming model of level with a minibatch of samples
+        """
+        model = self.models[level]['model']
+        model.partial_fit(self.models[level]['vectorizer'].transform(drop_missing(relation_fvs)),
+                          [self.relationxid_map[relation] for relation in relations],
+                          classes=numpy.array(sorted(model.class_weight)))
 
 
-def generate_relation_samples(rst_tree, bcvocab, level):
-    """ Generate relation samples from an binary RST tree
-    :type bcvocab: dict
-    :param bcvocab: brown clusters of words
+def relation_labels(rst_tree, level):
+    """ Relations of the nodes at level, derived from the tree structure alone
     """
     for node in rst_tree.postorder():
         if node.level == level and (node.lnode is not None) and (node.rnode is not None):
-            relation_feats = RelationFeatureGenerator(node, rst_tree, node.level, bcvocab).gen_features()
             if (node.form == 'NN') or (node.form == 'NS'):
-                relation = node.rnode.relation
+                yield node.rnode.relation
             else:
-                relation = node.lnode.relation
-            yield relation_feats, relation
+                yield node.lnode.relation
@@ -0,0 +1,137 @@
+from multiprocessing import Pool
+
+from stagedp.features.extraction import ActionFeatureGenerator, RelationFeatureGenerator
+from stagedp.features.store import FEATURE_VERSION, FeatureStore, bcvocab_fingerprint, corpus_fingerprint, \
+    merge_samples, vectorize_samples
+from stagedp.models.state import ParsingState
+
+# Names of the sample sets of the action classifier and the relation classifier levels
+SAMPLE_SETS = ('action', 'relation-0', 'relation-1', 'relation-2')
+
+
+def generate_samples(rst_tree, bcvocab):
+    """ Action and relation samples of a binary RST tree from a single replay
+        of the oracle actions, yields the sample set name, the features and
+        the label of each sample
+
+    The samples of each set come in the postorder of their tree nodes, in
+    which the oracle visits them.
+    """
+    action_hist = []
+    sr_parser = ParsingState([], rst_tree.get_edu_node())
+    for node in rst_tree.postorder():
+        if (node.lnode is None) and (node.rnode is None):
+            action = ('Shift', None)
+        elif (node.lnode is not None) and (node.rnode is not None):
+            action = ('Reduce', node.form)
+        else:
+            raise ValueError("Can not decode Shift-Reduce action")
+        stack, queue = sr_parser.get_status()
+        yield 'action', ActionFeatureGenerator(stack, queue, action_hist, rst_tree.doc, bcvocab).gen_features(), action
+        if action[0] == 'Reduce' and node.level in (0, 1, 2):
+            relation_feats = RelationFeatureGenerator(node, rst_tree, node.level, bcvocab).gen_features()
+            if (node.form == 'NN') or (node.form == 'NS'):
+                relation = node.rnode.relation
+            else:
+                relation = node.lnode.relation
+            yield f'relation-{node.level}', relation_feats, relation
+        sr_parser.operate(action)
+        action_hist.append(action)
+
+
+def extract_samples(names, rst_trees, bcvocab):
+    """ Vectorized samples of the sample sets names, all sets are filled in
+        one pass over the trees
+    """
+    buckets = {name: [] for name in names}
+    for rst_tree in rst_trees:
+        for name, feats, label in generate_samples(rst_tree, bcvocab):
+            if name in buckets:
+                buckets[name].append((feats, label))
+    return [vectorize_samples(buckets.pop(name)) for name in names]
+
+
+class TrainingSamples:
+    """ Vectorized training samples of the action and relation classifiers
+
+    Each sample set is extracted from the trees once and kept in memory. With
+    a FeatureStore, the sets are also saved on disk under the fingerprint of
+    the corpus and the feature configuration, so that later training runs on
+    the same data load the matrices instead of extracting the features again.
+
+    All missing sets are extracted together in one pass over the trees, with
+    several workers by a process pool. The trees are split into consecutive shards which are vectorized
+    separately and stacked in their original order, which gives the same
+    matrices as the extraction in a single process.
+    """
+
+    def __init__(self, rst_trees, bcvocab, store=None, workers=1):
+        self.rst_trees = rst_trees
+        self.bcvocab = bcvocab
+        self.store: FeatureStore = store
+        self.workers = workers
+        self._samples = {}
+        self._key = None
+
+    def config(self):
+        """ Settings the extracted features depend on
+        """
+        return {'version': FEATURE_VERSION,
+                'brown_clusters': bcvocab_fingerprint(self.bcvocab)}
+
+    def key(self):
+        if self._key is None:
+            self._key = FeatureStore.key(corpus_fingerprint(self.rst_trees), self.config())
+        return self._key
+
+    def get(self, name):
+        if name not in self._samples:
+            names = [other for other in SAMPLE_SETS if other not in self._samples]
+            missing = []
+            for other in names:
+                samples = self.store.load(self.key(), other) if self.store is not None else None
+                if samples is None:
+                    missing.append(other)
+                else:
+                    self._samples[other] = samples
+            for other, samples in zip(missing, self.extract(missing)):
+                if self.store is not None:
+                    self.store.save(self.key(), other, samples)
+                self._samples[other] = samples
+        return self._samples[name]
+
+    def extract(self, names):
+        """ Extract the sample sets names, with several workers by a process pool
+        """
+        if not names:
+            return []
+        if self.workers <= 1 or len(self.rst_trees) < 2:
+            return extract_samples(names, self.rst_trees, self.bcvocab)
+        n_shards = min(len(self.rst_trees), self.workers * 4)
+        bounds = [len(self.rst_trees) * idx // n_shards for idx in range(n_shards + 1)]
+        tasks = [(start, stop, names) for start, stop in zip(bounds[:-1], bounds[1:])]
+        with Pool(min(self.workers, n_shards), initializer=_init_worker,
+                  initargs=(self.rst_trees, self.bcvocab)) as pool:
+            shards = pool.map(_extract_shard, tasks, chunksize=1)
+        return [merge_samples([shard[idx] for shard in shards]) for idx in range(len(names))]
+
+    def action(self):
+        return self.get('action')
+
+    def relation(self, level):
+        return self.get(f'relation-{level}')
+
+
+# Trees and brown clusters of a worker process, set once by _init_worker
+_worker_trees = None
+_worker_bcvocab = None
+
+
+def _init_worker(rst_trees, bcvocab):
+    global _worker_trees, _worker_bcvocab
+    _worker_trees, _worker_bcvocab = rst_trees, bcvocab
+
+
+def _extract_shard(task):
+    start, stop, names = task
+    return extract_samples(names, _worker_trees[start:stop], _worker_bcvocab)
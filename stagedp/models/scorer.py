@@ -0,0 +1,214 @@
+import os
+
+import numpy
+from scipy.sparse import csr_matrix
+from scipy.special import expit
+
+
+def drop_missing(features_list):
+    """ Remove features without value, which the DictVectorizer skips but
+        the FeatureHasher rejects
+    """
+    return [{key: value for key, value in features.items() if value is not None} for features in features_list]
+
+
+class LinearScorer:
+    """ Inference engine for a fitted vectorizer + linear model pipeline
+
+    Feature keys are looked up directly in the vocabulary of the vectorizer and
+    the matching weight rows are summed up, so no sparse matrix has to be built
+    for a single sample. Rows are accumulated in ascending order like the sorted
+    sparse product of the pipeline, which keeps scores and rankings identical.
+
+    A scorer loaded from disk keeps the feature names as a sorted, memory-mapped
+    table and looks them up with binary search until build_index is called.
+    Models trained with feature hashing have no vocabulary, their rows are
+    computed by the same FeatureHasher as during training.
+    """
+
+    def __init__(self, vocabulary, weights, intercept, classes, separator='=', feature_names=None,
+                 feature_rows=None, hashing=None):
+        # feature name -> row in the weight matrix
+        self.vocabulary = vocabulary
+        # utf-8 encoded feature names in sorted order and their rows,
+        # used when there is no vocabulary dict
+        self.feature_names = feature_names
+        self.name_rows = feature_rows
+        # weight matrix of shape (n_features, n_scores)
+        self.weights = weights
+        self.intercept = intercept
+        self.classes = classes
+        self.separator = separator
+        # n_features and alternate_sign of the FeatureHasher of a hashed model
+        self.hashing = hashing
+        self._hasher = None
+
+    @staticmethod
+    def from_pipeline(pipeline):
+        """ Export the weights of a fitted pipeline
+        """
+        vectorizer, model = pipeline['vectorizer'], pipeline['model']
+        if not hasattr(vectorizer, 'vocabulary_'):
+            return LinearScorer(vocabulary=None,
+                                weights=numpy.ascontiguousarray(model.coef_.T),
+                                intercept=model.intercept_.copy(),
+                                classes=model.classes_.copy(),
+                                hashing={'n_features': vectorizer.n_features,
+                                         'alternate_sign': vectorizer.alternate_sign})
+        return LinearScorer(vocabulary=dict(vectorizer.vocabulary_),
+                            weights=numpy.ascontiguousarray(model.coef_.T),
+                            intercept=model.intercept_.copy(),
+                            classes=model.classes_.copy(),
+                            separator=vectorizer.separator)
+
+    def save(self, path):
+        """ Write the weights and the sorted feature table as .npy files,
+            returns the settings for the model manifest
+        """
+        os.makedirs(path, exist_ok=True)
+        if self.hashing is None:
+            if self.vocabulary is not None:
+                names = sorted((name.encode('utf-8'), row) for name, row in self.vocabulary.items())
+                feature_names = numpy.array([name for name, _ in names], dtype=bytes)
+                name_rows = numpy.array([row for _, row in names], dtype=numpy.int64)
+            else:
+                feature_names, name_rows = self.feature_names, self.name_rows
+            numpy.save(os.path.join(path, 'feature_names.npy'), feature_names)
+            numpy.save(os.path.join(path, 'feature_rows.npy'), name_rows)
+        numpy.save(os.path.join(path, 'weights.npy'), self.weights)
+        numpy.save(os.path.join(path, 'intercept.npy'), self.intercept)
+        numpy.save(os.path.join(path, 'classes.npy'), self.classes)
+        manifest = {'separator': self.separator,
+                    'n_features': int(self.weights.shape[0]),
+                    'n_scores': int(self.weights.shape[1])}
+        if self.hashing is not None:
+            manifest['hashing'] = self.hashing
+        return manifest
+
+    @staticmethod
+    def load(path, separator='=', mmap_mode='r', hashing=None):
+        def load_array(name):
+            return numpy.load(os.path.join(path, name), mmap_mode=mmap_mode, allow_pickle=False)
+
+        if hashing is not None:
+            return LinearScorer(vocabulary=None,
+                                weights=load_array('weights.npy'),
+                                intercept=numpy.load(os.path.join(path, 'intercept.npy'), allow_pickle=False),
+                                classes=numpy.load(os.path.join(path, 'classes.npy'), allow_pickle=False),
+                                separator=separator,
+                                hashing=hashing)
+        return LinearScorer(vocabulary=None,
+                            weights=load_array('weights.npy'),
+                            intercept=numpy.load(os.path.join(path, 'intercept.npy'), allow_pickle=False),
+                            classes=numpy.load(os.path.join(path, 'classes.npy'), allow_pickle=False),
+                            separator=separator,
+                            feature_names=load_array('feature_names.npy'),
+                            feature_rows=load_array('feature_rows.npy'))
+
+    def build_index(self):
+        """ Build the vocabulary dict from the feature table, which makes
+            lookups faster for long-running processes
+        """
+        if self.vocabulary is None and self.hashing is None:
+            self.vocabulary = dict(zip((name.decode('utf-8') for name in self.feature_names.tolist()),
+                                       self.name_rows.tolist()))
+        return self
+
+    @property
+    def hasher(self):
+        if self._hasher is None:
+            from sklearn.feature_extraction import FeatureHasher
+            self._hasher = FeatureHasher(n_features=self.hashing['n_features'], input_type='dict',
+                                         alternate_sign=self.hashing['alternate_sign'], dtype=self.weights.dtype)
+        return self._hasher
+
+    def lookup(self, keys):
+        """ Weight rows of feature names, -1 for unknown features
+        """
+        if self.vocabulary is not None:
+            get = self.vocabulary.get
+            return [get(key, -1) for key in keys]
+        if len(keys) == 0 or len(self.feature_names) == 0:
+            return [-1] * len(keys)
+        encoded = numpy.array([key.encode('utf-8') for key in keys], dtype=bytes)
+        pos = numpy.minimum(numpy.searchsorted(self.feature_names, encoded), len(self.feature_names) - 1)
+        return numpy.where(self.feature_names[pos] == encoded, self.name_rows[pos], -1).tolist()
+
+    def feature_rows(self, features):
+        """ Map a feature dict to sorted weight rows and their values the same
+            way as the DictVectorizer does
+        """
+        if self.hashing is not None:
+            row = self.hasher.transform(drop_missing([features]))
+            return row.indices.tolist(), row.data.tolist()
+        keys, key_values = [], []
+        for key, value in features.items():
+            if isinstance(value, str):
+                key = f'{key}{self.separator}{value}'
+                value = 1
+            elif value is None:
+                continue
+            keys.append(key)
+            key_values.append(value)
+        row_values = [(row, value) for row, value in zip(self.lookup(keys), key_values) if row >= 0]
+        row_values.sort()
+        rows = [row for row, _ in row_values]
+        values = [value for _, value in row_values]
+        return rows, values
+
+    def decision_function(self, features):
+        rows, values = self.feature_rows(features)
+        if rows:
+            weighted = self.weights[rows] * numpy.asarray(values, dtype=self.weights.dtype)[:, None]
+            scores = numpy.add.reduce(weighted, axis=0) + self.intercept
+        else:
+            scores = numpy.zeros(self.weights.shape[1], dtype=self.weights.dtype) + self.intercept
+        if scores.shape[0] == 1:
+            return scores[0]
+        return scores
+
+    def predict_proba(self, features):
+        """ Probability estimates of a one-vs-rest logistic regression
+        """
+        prob = expit(self.decision_function(features))
+        if prob.ndim == 0:
+            return numpy.array([1 - prob, prob])
+        return prob / prob.sum()
+
+    def predict(self, features):
+        scores = self.decision_function(features)
+        if scores.ndim == 0:
+            return self.classes[int(scores > 0)]
+        return self.classes[scores.argmax()]
+
+    def transform(self, features_list):
+        """ Stack feature dicts into a sparse matrix for batched scoring
+        """
+        if self.hashing is not None:
+            return self.hasher.transform(drop_missing(features_list))
+        indices, values, indptr = [], [], [0]
+        for features in features_list:
+            rows, row_values = self.feature_rows(features)
+            indices += rows
+            values += row_values
+            indptr.append(len(indices))
+        return csr_matrix((numpy.asarray(values, dtype=self.weights.dtype), indices, indptr),
+                          shape=(len(features_list), self.weights.shape[0]))
+
+    def decision_function_batch(self, features_list):
+        scores = self.transform(features_list) @ self.weights + self.intercept
+        if scores.shape[1] == 1:
+            return scores[:, 0]
+        return scores
+
+    def predict_proba_batch(self, features_list):
+        prob = expit(self.decision_function_batch(features_list))
+        if prob.ndim == 1:
+            return numpy.vstack([1 - prob, prob]).T
+        return prob / prob.sum(axis=1)[:, None]
+
+    def predict_batch(self, features_list):
+        scores = self.decision_function_batch(features_list)
+        if scores.ndim == 1:
+            return self.classes[(scores > 0).astype(int)]
+        return self.classes[scores.argmax(axis=1)]
@@ -21,15 +21,7 @@ class ParsingState:
         :type doc: Doc instance
         :param doc:
         """
-        if not isinstance(doc, Doc):
-            raise ValueError("doc should be an instance of Doc")
-        N = len(doc.edu_dict)
-        for idx in range(1, N + 1, 1):
-            node = SpanNode(prop=None)
-            node.text = doc.edu_dict[idx]
-            node.edu_span, node.nuc_span = (idx, idx), (idx, idx)
-            node.nuc_edu = idx
-            self.Queue.append(node)
+        self.Queue.extend(create_edu_nodes(doc))
 
     def operate(self, action_tuple):
         """ According to parsing label to modify the status of
@@ -46,37 +38,8 @@ class ParsingState:
                 raise ActionError("Reduce action error")
             rnode = self.Stack.pop()
             lnode = self.Stack.pop()
-            # Create a new node
-            # Assign a value to prop, only when it is someone's
-            # children node
-            node = SpanNode(prop=None)
-            # Children node
-            node.lnode, node.rnode = lnode, rnode
-            # Parent node of children nodes
-            node.lnode.pnode, node.rnode.pnode = node, node
-            # Node text: concatenate two word lists
-            node.text = lnode.text + rnode.text
-            # EDU span
-            node.edu_span = (lnode.edu_span[0], rnode.edu_span[1])
-            # Nuc span / Nuc EDU
-            node.form = form
-            if form == 'NN':
-                node.nuc_span = (lnode.edu_span[0], rnode.edu_span[1])
-                node.nuc_edu = lnode.nuc_edu
-                node.lnode.prop = "Nucleus"
-                node.rnode.prop = "Nucleus"
-            elif form == 'NS':
-                node.nuc_span = lnode.edu_span
-                node.nuc_edu = lnode.nuc_edu
-                node.lnode.prop = "Nucleus"
-                node.rnode.prop = "Satellite"
-            elif form == 'SN':
-                node.nuc_span = rnode.edu_span
-                node.nuc_edu = rnode.nuc_edu
-                node.lnode.prop = "Satellite"
-                node.rnode.prop = "Nucleus"
-            else:
-                raise ValueError("Unrecognized form: {}".format(form))
+            node = reduce_nodes(lnode, rnode, form)
+            link_children(node)
             self.Stack.append(node)
         else:
             raise ValueError("Unrecognized parsing action: {}".format(action))
@@ -111,3 +74,221 @@ class ParsingState:
             return self.Stack[0]
         else:
             return None
+
+
+class PersistentStack:
+    """ Immutable stack as a linked list. Push and pop return new stacks that
+        share all remaining elements with the old one, so beam states can
+        branch without copying their stacks.
+    """
+    __slots__ = ('head', 'tail', 'size')
+
+    def __init__(self, head=None, tail=None):
+        self.head = head
+        self.tail = tail
+        self.size = 0 if tail is None else tail.size + 1
+
+    def push(self, item):
+        return PersistentStack(item, self)
+
+    def pop(self):
+        """ Return the top element and the remaining stack
+        """
+        if self.size == 0:
+            raise ActionError("Pop from empty stack")
+        return self.head, self.tail
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        """ List-like indexing, -1 is the top and 0 the bottom of the stack
+        """
+        if idx >= 0:
+            idx -= self.size
+        if not -self.size <= idx < 0:
+            raise IndexError("stack index out of range")
+        stack = self
+        for _ in range(-idx - 1):
+            stack = stack.tail
+        return stack.head
+
+    def __iter__(self):
+        items = []
+        stack = self
+        while stack.size > 0:
+            items.append(stack.head)
+            stack = stack.tail
+        return reversed(items)
+
+
+class QueueView:
+    """ Read-only view on the unprocessed rest of the EDU queue
+    """
+    __slots__ = ('nodes', 'start')
+
+    def __init__(self, nodes, start=0):
+        self.nodes = nodes
+        self.start = start
+
+    def popleft(self):
+        """ Return the first element and the remaining queue
+        """
+        if self.start >= len(self.nodes):
+            raise ActionError("Pop from empty queue")
+        return self.nodes[self.start], QueueView(self.nodes, self.start + 1)
+
+    def __len__(self):
+        return len(self.nodes) - self.start
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("queue index out of range")
+        return self.nodes[self.start + idx]
+
+    def __iter__(self):
+        return iter(self.nodes[self.start:])
+
+
+class BeamState:
+    """ Parsing configuration of one beam item. Operations return new states
+        that share their stack, queue and action history with this one.
+    """
+
+    def __init__(self, stack, queue, action_hist, score=0.0):
+        self.Stack = stack
+        self.Queue = queue
+        self.action_hist = action_hist
+        self.score = score
+
+    @staticmethod
+    def init(doc):
+        return BeamState(PersistentStack(), QueueView(create_edu_nodes(doc)), PersistentStack())
+
+    def operate(self, action_tuple, score):
+        """ Apply the action and return the resulting state. The children of
+            reduced nodes are linked to their parents only by get_parse_tree,
+            since beam states share them.
+        """
+        action, form = action_tuple
+        if action == 'Shift':
+            if len(self.Queue) == 0:
+                raise ActionError("Shift action error")
+            node, queue = self.Queue.popleft()
+            stack = self.Stack.push(node)
+        elif action == 'Reduce':
+            if len(self.Stack) < 2:
+                raise ActionError("Reduce action error")
+            rnode, stack = self.Stack.pop()
+            lnode, stack = stack.pop()
+            stack = stack.push(reduce_nodes(lnode, rnode, form))
+            queue = self.Queue
+        else:
+            raise ValueError("Unrecognized parsing action: {}".format(action))
+        return BeamState(stack, queue, self.action_hist.push(action_tuple), score)
+
+    def is_action_allowed(self, action_tuple):
+        action, form = action_tuple
+        if action == 'Shift' and len(self.Queue) == 0:
+            return False
+        if action == 'Reduce' and len(self.Stack) < 2:
+            return False
+        return True
+
+    def get_status(self):
+        """ Return the status of the Queue/Stack
+        """
+        return self.Stack, self.Queue
+
+    def end_parsing(self):
+        """ Whether we should end parsing
+        """
+        if (len(self.Stack) == 1) and (len(self.Queue) == 0):
+            return True
+        elif (len(self.Stack) == 0) and (len(self.Queue) == 0):
+            raise ParseError("Illegal stack/queue status")
+        else:
+            return False
+
+    def get_parse_tree(self):
+        """ Get the entire parsing tree, with parent links and properties
+            of all nodes set
+        """
+        if (len(self.Stack) == 1) and (len(self.Queue) == 0):
+            tree = self.Stack[-1]
+            tree.pnode = None
+            nodes = [tree]
+            while nodes:
+                node = nodes.pop()
+                if node.lnode is not None and node.rnode is not None:
+                    link_children(node)
+                    nodes += [node.lnode, node.rnode]
+            return tree
+        else:
+            return None
+
+
+def create_edu_nodes(doc):
+    """ Create one leaf node for each EDU of the document
+    """
+    if not isinstance(doc, Doc):
+        raise ValueError("doc should be an instance of Doc")
+    nodes = []
+    N = len(doc.edu_dict)
+    for idx in range(1, N + 1, 1):
+        node = SpanNode(prop=None)
+        node.tok_span = doc.edu_spans[idx]
+        node.edu_span, node.nuc_span = (idx, idx), (idx, idx)
+        node.nuc_edu = idx
+        nodes.append(node)
+    return nodes
+
+
+def reduce_nodes(lnode, rnode, form):
+    """ Create the parent node of two adjacent spans, the children are not
+        modified
+    """
+    # Create a new node
+    # Assign a value to prop, only when it is someone's
+    # children node
+    node = SpanNode(prop=None)
+    # Children node
+    node.lnode, node.rnode = lnode, rnode
+    # Node text: tokens from the first of the left to the last of the right node
+    node.tok_span = (lnode.tok_span[0], rnode.tok_span[1])
+    # EDU span
+    node.edu_span = (lnode.edu_span[0], rnode.edu_span[1])
+    # Nuc span / Nuc EDU
+    node.form = form
+    if form == 'NN':
+        node.nuc_span = (lnode.edu_span[0], rnode.edu_span[1])
+        node.nuc_edu = lnode.nuc_edu
+    elif form == 'NS':
+        node.nuc_span = lnode.edu_span
+        node.nuc_edu = lnode.nuc_edu
+    elif form == 'SN':
+        node.nuc_span = rnode.edu_span
+        node.nuc_edu = rnode.nuc_edu
+    else:
+        raise ValueError("Unrecognized form: {}".format(form))
+    return node
+
+
+def link_children(node):
+    """ Set parent node and nuclearity property of the children of a node
+    """
+    # Parent node of children nodes
+    node.lnode.pnode, node.rnode.pnode = node, node
+    if node.form == 'NN':
+        node.lnode.prop = "Nucleus"
+        node.rnode.prop = "Nucleus"
+    elif node.form == 'NS':
+        node.lnode.prop = "Nucleus"
+        node.rnode.prop = "Satellite"
+    elif node.form == 'SN':
+        node.lnode.prop = "Satellite"
+        node.rnode.prop = "Nucleus"
+    else:
+        raise ValueError("Unrecognized form: {}".format(node.form))
@@ -0,0 +1,99 @@
+import logging
+import random
+from collections import Counter
+
+from stagedp.models.action import ActionClassifier, action_labels
+from stagedp.models.parser import RstParser
+from stagedp.models.relation import RelationClassifier, relation_labels
+from stagedp.models.samples import SAMPLE_SETS, generate_samples
+from stagedp.models.scorer import LinearScorer
+from stagedp.models.tree import RstTree
+
+
+def balanced_class_weight(label_cnt, label_map):
+    """ Weights of the label ids like class_weight='balanced', which
+        partial_fit does not support
+    """
+    n_samples = sum(label_cnt.values())
+    return {label_map[label]: n_samples / (len(label_cnt) * cnt) for label, cnt in label_cnt.items()}
+
+
+class StreamingTrainer:
+    """ Out-of-core training of the action and relation classifiers
+
+    The trees are read one at a time, their samples are collected into
+    minibatches of batch_size samples per classifier, hashed into n_features
+    columns and passed to partial_fit. Memory is bounded by one tree, the
+    minibatches and the fixed size weight matrices, no matter how large the
+    corpus is. The label inventories are counted in a first pass over the
+    tree structures, without extracting features.
+    """
+
+    def __init__(self, files, bcvocab, n_features=1 << 18, epochs=5, batch_size=1000, seed=0, tree_cache=None):
+        # (dis, merge) file pairs of the training corpus
+        self.files = files
+        # TreeCache of the parsed trees, which saves parsing them in every epoch
+        self.tree_cache = tree_cache
+        self.bcvocab = bcvocab
+        self.n_features = n_features
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.random = random.Random(seed)
+
+    def count_labels(self):
+        action_cnt = Counter()
+        relation_cnts = [Counter(), Counter(), Counter()]
+        for rst_tree in RstTree.iter_rst_trees(self.files, self.tree_cache):
+            action_cnt.update(action_labels(rst_tree))
+            for level in [0, 1, 2]:
+                relation_cnts[level].update(relation_labels(rst_tree, level))
+        return action_cnt, relation_cnts
+
+    def train(self):
+        """ Train a parser, returns the RstParser
+        """
+        action_cnt, relation_cnts = self.count_labels()
+        for level in [0, 1, 2]:
+            if not relation_cnts[level]:
+                raise ValueError('The training corpus has no relations at level {}, the relation classifier of '
+                                 'every level needs samples'.format(level))
+        action_clf = ActionClassifier.from_counts(action_cnt)
+        relation_clf = RelationClassifier.from_counts(sum(relation_cnts, Counter()))
+        action_clf.model = ActionClassifier.new_streaming_model(
+            self.n_features, balanced_class_weight(action_cnt, action_clf.actionxid_map))
+        for level in [0, 1, 2]:
+            relation_clf.models[level] = RelationClassifier.new_streaming_model(
+                self.n_features, balanced_class_weight(relation_cnts[level], relation_clf.relationxid_map))
+        for epoch in range(self.epochs):
+            logging.info('Streaming training epoch {}/{}...'.format(epoch + 1, self.epochs))
+            self.train_epoch(action_clf, relation_clf)
+        action_clf.scorer = LinearScorer.from_pipeline(action_clf.model)
+        relation_clf.scorers = [LinearScorer.from_pipeline(model) for model in relation_clf.models]
+        return RstParser(action_clf, relation_clf)
+
+    def train_epoch(self, action_clf, relation_clf):
+        files = list(self.files)
+        self.random.shuffle(files)
+        # minibatches of the action classifier and the relation levels
+        batches = {name: [] for name in SAMPLE_SETS}
+
+        def update(name, flush=False):
+            batch = batches[name]
+            if not batch or (len(batch) < self.batch_size and not flush):
+                return
+            self.random.shuffle(batch)
+            fvs, labels = zip(*batch)
+            if name == 'action':
+                action_clf.partial_fit(fvs, labels)
+            else:
+                relation_clf.partial_fit(fvs, labels, int(name.split('-')[1]))
+            batch.clear()
+
+        for rst_tree in RstTree.iter_rst_trees(files, self.tree_cache):
+            # one replay of the oracle gives the samples of all classifiers
+            for name, feats, label in generate_samples(rst_tree, self.bcvocab):
+                batches[name].append((feats, label))
+            for name in SAMPLE_SETS:
+                update(name)
+        for name in SAMPLE_SETS:
+            update(name, flush=True)
@@ -1,9 +1,19 @@
 import os
+import re
 import sys
+from itertools import islice
+from multiprocessing import Pool
 
 from stagedp.utils.document import Doc
 from stagedp.utils.span import SpanNode
 
+# Brackets and words of a *.dis file, line breaks belong to the words they split
+DIS_TOKEN = re.compile(r'[()]|(?:[^\s()]|\n)+')
+
+# Version of the pickled trees in a TreeCache, increase it whenever the
+# attributes of RstTree, SpanNode or Doc change
+TREE_CACHE_VERSION = 1
+
 
 class RstTree:
     def __init__(self, tree, doc):
@@ -13,30 +23,106 @@ class RstTree:
         self.down_prop(self.tree)
         self.back_prop(self.tree, self.doc)
 
+    def __getstate__(self):
+        """ Flatten the tree into a node list, so deep trees can be pickled
+            without running into the recursion limit
+        """
+        nodes = RstTree.BFTbin(self.tree)
+        index = {id(node): idx for idx, node in enumerate(nodes)}
+        node_states = []
+        for node in nodes:
+            state = dict(node.__dict__)
+            for attr in ('lnode', 'rnode', 'pnode'):
+                state[attr] = index.get(id(state[attr]))
+            state['feature_cache'] = {}
+            node_states.append(state)
+        return {'binary': self.binary, 'doc': self.doc, 'nodes': node_states}
+
+    def __setstate__(self, state):
+        nodes = [SpanNode.__new__(SpanNode) for _ in state['nodes']]
+        for node, node_state in zip(nodes, state['nodes']):
+            node.__dict__.update(node_state)
+            for attr in ('lnode', 'rnode', 'pnode'):
+                idx = node_state[attr]
+                setattr(node, attr, nodes[idx] if idx is not None else None)
+        self.binary = state['binary']
+        self.doc = state['doc']
+        self.tree = nodes[0]
+
     @staticmethod
     def from_file(fdis, fmerge):
         """ Build BINARY RST tree
         """
+        return RstTree.from_dis(fdis, Doc.from_file(open(fmerge)))
+
+    @staticmethod
+    def from_dis(fdis, doc):
+        """ Build BINARY RST tree of a *.dis file over an already loaded document
+        """
         with open(fdis) as fin:
             text = fin.read()
-        tree = RstTree.binarize_tree(RstTree.build_tree(text))
-        doc = Doc.from_file(open(fmerge))
-        return RstTree(tree, doc)
+        return RstTree(RstTree.build_tree(text, binarize=True), doc)
 
     @staticmethod
-    def read_rst_trees(data_dir):
-        files = [os.path.join(data_dir, fname) for fname in os.listdir(data_dir) if fname.endswith('.dis')]
-        rst_trees = []
-        for fdis in files:
-            fmerge = fdis.replace('.dis', '.merge')
-            if not os.path.isfile(fmerge):
-                raise FileNotFoundError('Corresponding .fmerge file does not exist. You should do preprocessing first.')
-            rst_trees.append(RstTree.from_file(fdis, fmerge))
-        return rst_trees
+    def rst_files(data_dir):
+        """ Pairs of *.dis and *.merge files in data_dir
+        """
+        files = []
+        for fname in os.listdir(data_dir):
+            if fname.endswith('.dis'):
+                fdis = os.path.join(data_dir, fname)
+                fmerge = fdis.replace('.dis', '.merge')
+                if not os.path.isfile(fmerge):
+                    raise FileNotFoundError('Corresponding .fmerge file does not exist. '
+                                            'You should do preprocessing first.')
+                files.append((fdis, fmerge))
+        return files
+
+    @staticmethod
+    def from_cache(fdis, fmerge, cache=None):
+        """ Same as from_file, the tree is taken from the TreeCache if its
+            files did not change and stored there otherwise
+        """
+        rst_tree = cache.get((fdis, fmerge)) if cache is not None else None
+        if rst_tree is None:
+            rst_tree = RstTree.from_file(fdis, fmerge)
+            if cache is not None:
+                cache.put((fdis, fmerge), rst_tree)
+        return rst_tree
+
+    @staticmethod
+    def iter_rst_trees(files, cache=None):
+        """ Read the trees of (dis, merge) file pairs one at a time
+        """
+        for fdis, fmerge in files:
+            yield RstTree.from_cache(fdis, fmerge, cache)
+
+    @staticmethod
+    def read_rst_trees(data_dir, workers=1, cache=None):
+        """ Read all trees of data_dir
+
+        :type workers: int
+        :param workers: number of processes building the trees which are
+                        not in the cache
+
+        :type cache: TreeCache
+        :param cache: cache of the parsed trees
+        """
+        files = RstTree.rst_files(data_dir)
+        rst_trees = [cache.get(pair) if cache is not None else None for pair in files]
+        missing = [pair for pair, rst_tree in zip(files, rst_trees) if rst_tree is None]
+        if workers > 1 and len(missing) > 1:
+            with Pool(min(workers, len(missing))) as pool:
+                built = pool.starmap(RstTree.from_cache, [(fdis, fmerge, cache) for fdis, fmerge in missing],
+                                     chunksize=max(1, len(missing) // (4 * workers)))
+        else:
+            built = [RstTree.from_cache(fdis, fmerge, cache) for fdis, fmerge in missing]
+        built = iter(built)
+        return [rst_tree if rst_tree is not None else next(built) for rst_tree in rst_trees]
 
     def convert_node_to_str(self, node, sep=' '):
         text = node.text
-        words = [self.doc.token_dict[tidx].word for tidx in text]
+        words = self.doc.word[text.start:text.stop].tolist()
         return sep.join(words)
 
     def get_edu_node(self):
@@ -53,92 +139,88 @@ class RstTree:
         return edulist
 
     @staticmethod
-    def build_tree(text):
+    def tokenize(text):
+        """ Split a *.dis file into brackets and words in a single pass
+
+        Brackets within the _!...!_ text of an EDU are replaced by -LB- and
+        -RB-. Line breaks and //TT_ERR marks are dropped, so words broken by
+        them are joined.
+
+        :type text: string
+        :param text: RST tree read from a *.dis file
+        """
+        within_text = False
+        for match in DIS_TOKEN.finditer(text):
+            token = match.group()
+            if token == '(' or token == ')':
+                if within_text:
+                    token = '-LB-' if token == '(' else '-RB-'
+                yield token
+                continue
+            if '\n' in token or '//TT_ERR' in token:
+                token = token.replace('//TT_ERR', '').replace('\n', '')
+                if not token:
+                    continue
+            if '_!' in token and token.count('_!') % 2:
+                within_text = not within_text
+            yield token
+
+    @staticmethod
+    def build_tree(text, binarize=False):
         """ Build tree from *.dis file
 
+        Each node is created when its closing bracket is read, so the time
+        is linear in the size of the file.
+
         :type text: string
         :param text: RST tree read from a *.dis file
+
+        :type binarize: bool
+        :param binarize: binarize each node when it is created, which gives
+                         the same tree as binarize_tree
         """
-        tokens = text.strip().replace('//TT_ERR', '').replace('\n', '').replace('(', ' ( ').replace(')', ' ) ').split()
-        queue = RstTree.process_text(tokens)
         stack = []
-        while queue:
-            token = queue.pop(0)
-            if token == ')':
-                # If ')', start processing
-                content = []  # Content in the stack
-                while stack:
-                    cont = stack.pop()
-                    if cont == '(':
-                        break
-                    else:
-                        content.append(cont)
-                content.reverse()  # Reverse to the original order
+        # positions of the open brackets on the stack
+        opened = []
+        for token in RstTree.tokenize(text):
+            if token == '(':
+                opened.append(len(stack))
+                stack.append(token)
+            elif token == ')':
+                # Content in the stack since the matching '('
+                begin = opened.pop() if opened else 0
+                content = stack[begin + 1:] if begin < len(stack) and stack[begin] == '(' else stack[begin:]
+                del stack[begin:]
                 # Parse according to the first content word
                 if len(content) < 2:
                     raise ValueError("content = {}".format(content))
-                label = content.pop(0)
-                if label == 'Root':
+                label = content[0]
+                if label in ('Root', 'Nucleus', 'Satellite'):
                     node = SpanNode(prop=label)
-                    node.create_node(content)
-                    stack.append(node)
-                elif label == 'Nucleus':
-                    node = SpanNode(prop=label)
-                    node.create_node(content)
-                    stack.append(node)
-                elif label == 'Satellite':
-                    node = SpanNode(prop=label)
-                    node.create_node(content)
+                    node.create_node(content[1:])
+                    if binarize:
+                        RstTree.binarize_node(node)
                     stack.append(node)
                 elif label == 'span':
-                    # Merge
-                    beginindex = int(content.pop(0))
-                    endindex = int(content.pop(0))
-                    stack.append(('span', beginindex, endindex))
+                    stack.append(('span', int(content[1]), int(content[2])))
                 elif label == 'leaf':
-                    # Merge
-                    eduindex = int(content.pop(0))
-                    RstTree.check_content(label, content)
+                    eduindex = int(content[1])
+                    RstTree.check_content(label, content[2:])
                     stack.append(('leaf', eduindex, eduindex))
                 elif label == 'rel2par':
-                    # Merge
-                    relation = content.pop(0)
-                    RstTree.check_content(label, content)
-                    stack.append(('relation', relation))
+                    RstTree.check_content(label, content[2:])
+                    stack.append(('relation', content[1]))
                 elif label == 'text':
-                    # Merge
-                    txt = RstTree.create_text(content)
-                    stack.append(('text', txt))
+                    stack.append(('text', RstTree.create_text(content[1:])))
                 else:
                     raise ValueError(
-                        "Unrecognized parsing label: {} \n\twith content = {}\n\tstack={}\n\tqueue={}".format(label,
-                                                                                                              content,
-                                                                                                              stack,
-                                                                                                              queue))
+                        "Unrecognized parsing label: {} \n\twith content = {}\n\tstack={}".format(label, content,
+                                                                                                stack))
             else:
                 # else, keep push into the stack
                 stack.append(token)
         return stack[-1]
 
-    @staticmethod
-    def process_text(tokens):
-        """ Preprocessing token list for filtering '(' and ')' in text
-        :type tokens: list
-        :param tokens: list of tokens
-        """
-        identifier = '_!'
-        within_text = False
-        for (idx, tok) in enumerate(tokens):
-            if identifier in tok:
-                for _ in range(tok.count(identifier)):
-                    within_text = not within_text
-            if ('(' in tok) and within_text:
-                tok = tok.replace('(', '-LB-')
-            if (')' in tok) and within_text:
-                tok = tok.replace(')', '-RB-')
-            tokens[idx] = tok
-        return tokens
-
     @staticmethod
     def create_text(lst):
         """ Create text from a list of tokens
@@ -167,6 +249,27 @@ class RstTree:
         if len(c) > 0:
             raise ValueError("{} with content={}".format(label, c))
 
+    @staticmethod
+    def binarize_node(node):
+        """ Turn the children of a node into a right-branching chain of
+            binary nodes, new nodes take the property of their first child
+        """
+        children = node.nodelist
+        # Clear nodelist for the current node
+        node.nodelist = []
+        if len(children) < 2:
+            return
+        parent = node
+        for idx in range(len(children) - 2):
+            newnode = SpanNode(children[idx + 1].prop)
+            parent.lnode, parent.rnode = children[idx], newnode
+            children[idx].pnode = parent
+            newnode.pnode = parent
+            parent = newnode
+        parent.lnode, parent.rnode = children[-2], children[-1]
+        parent.lnode.pnode = parent
+        parent.rnode.pnode = parent
+
     @staticmethod
     def binarize_tree(tree):
         """ Convert a general RST tree to a binary RST tree
@@ -174,33 +277,11 @@ class RstTree:
         :type tree: instance of SpanNode
         :param tree: a general RST tree
         """
-        queue = [tree]
-        while queue:
-            node = queue.pop(0)
-            queue += node.nodelist
-            # Construct binary tree
-            if len(node.nodelist) == 2:
-                node.lnode = node.nodelist[0]
-                node.rnode = node.nodelist[1]
-                # Parent node
-                node.lnode.pnode = node
-                node.rnode.pnode = node
-            elif len(node.nodelist) > 2:
-                # Remove one node from the nodelist
-                node.lnode = node.nodelist.pop(0)
-                newnode = SpanNode(node.nodelist[0].prop)
-                newnode.nodelist += node.nodelist
-                # Right-branching
-                node.rnode = newnode
-                # Parent node
-                node.lnode.pnode = node
-                node.rnode.pnode = node
-                # Add to the head of the queue
-                # So the code will keep branching
-                # until the nodelist size is 2
-                queue.insert(0, newnode)
-            # Clear nodelist for the current node
-            node.nodelist = []
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            stack += node.nodelist
+            RstTree.binarize_node(node)
         return tree
 
     @staticmethod
@@ -217,7 +298,7 @@ class RstTree:
             if (node.lnode is not None) and (node.rnode is not None):
                 # Non-leaf node
                 node.edu_span = RstTree.__getspaninfo(node.lnode, node.rnode)
-                node.text = RstTree.__gettextinfo(doc.edu_dict, node.edu_span)
+                node.tok_span = RstTree.__gettokenspan(doc.edu_spans, node.edu_span)
                 if node.relation is None:
                     # If it is a new node created by binarization
                     if node.prop == 'Root':
@@ -231,9 +312,10 @@ class RstTree:
                     node.child_relation = node.rnode.relation
                 else:
                     node.child_relation = node.lnode.relation
-                if doc.token_dict[node.lnode.text[0]].sidx == doc.token_dict[node.rnode.text[-1]].sidx:
+                first, last = node.lnode.tok_span[0], node.rnode.tok_span[1]
+                if doc.sidx[first] == doc.sidx[last]:
                     node.level = 0
-                elif doc.token_dict[node.lnode.text[0]].pidx == doc.token_dict[node.rnode.text[-1]].pidx:
+                elif doc.pidx[first] == doc.pidx[last]:
                     node.level = 1
                 else:
                     node.level = 2
@@ -243,7 +325,7 @@ class RstTree:
                 raise ValueError("Unexpected right node")
             else:
                 # Leaf node
-                node.text = RstTree.__gettextinfo(doc.edu_dict, node.edu_span)
+                node.tok_span = RstTree.__gettokenspan(doc.edu_spans, node.edu_span)
                 node.height = 0
                 node.max_depth = node.depth
                 node.level = 0
@@ -257,9 +339,8 @@ class RstTree:
         :return: root node
         """
         tree_nodes = RstTree.BFTbin(tree)
-        root_node = tree_nodes.pop(0)
-        root_node.depth = 0
-        for node in tree_nodes:
+        tree_nodes[0].depth = 0
+        for node in islice(tree_nodes, 1, None):
             assert node.pnode.depth >= 0
             node.depth = node.pnode.depth + 1
 
@@ -270,15 +351,14 @@ class RstTree:
         :type tree: SpanNode instance
         :param tree: an binary RST tree
         """
-        queue = [tree]
-        bft_nodelist = []
-        while queue:
-            node = queue.pop(0)
-            bft_nodelist.append(node)
+        # the node list itself is the queue, nodes are appended behind the
+        # current position
+        bft_nodelist = [tree]
+        for node in bft_nodelist:
             if node.lnode is not None:
-                queue.append(node.lnode)
+                bft_nodelist.append(node.lnode)
             if node.rnode is not None:
-                queue.append(node.rnode)
+                bft_nodelist.append(node.rnode)
         return bft_nodelist
 
     def postorder(self):
@@ -358,21 +438,17 @@ class RstTree:
         return relation
 
     @staticmethod
-    def __gettextinfo(edu_dict, edu_span):
-        """ Get text span for parent node
+    def __gettokenspan(edu_spans, edu_span):
+        """ Get token span for parent node
 
-        :type edu_dict: dict of list
-        :param edu_dict: EDU from this document
+        :type edu_spans: dict of tuple
+        :param edu_spans: first and last token of each EDU from this document
 
         :type edu_span: tuple with two elements
         :param edu_span: start/end of EDU IN this span
         """
-        # text = lnode.text + " " + rnode.text
-        text = []
-        for idx in range(edu_span[0], edu_span[1] + 1):
-            text += edu_dict[idx]
-        # Return: A list of token indices
-        return text
+        # Return: Index of the first and the last token
+        return edu_spans[edu_span[0]][0], edu_spans[edu_span[1]][1]
 
     def get_parse(self):
         """ Get parse tree in dis format.
@@ -394,6 +470,21 @@ class RstTree:
 
         return _helper(self.tree, 'Root')
 
+    def get_dict(self):
+        """ Get parse tree as nested dicts, e.g. for JSON output
+        """
+
+        def _helper(node):
+            item = {'span': list(node.edu_span), 'prop': node.prop, 'relation': node.relation}
+            if node.is_leaf():
+                item['text'] = self.convert_node_to_str(node)
+            else:
+                item['form'] = node.form
+                item['children'] = [_helper(node.lnode), _helper(node.rnode)]
+            return item
+
+        return _helper(self.tree)
+
     def bracketing(self):
         """ Generate brackets according a Binary RST tree
         """
@@ -1,26 +1,150 @@
 import sys
+from collections import namedtuple
 from typing import List
 
-import stanza
-from conllu import TokenList
+from conllu import TokenList, parse as parse_conll
 from conllu.models import Token, Metadata
 
+# Settings of the stanza pipeline
+PIPELINE_CONFIG = {'lang': 'en', 'processors': 'tokenize,pos,lemma,depparse,constituency', 'tokenize_no_ssplit': True}
 
-def load_parser():
+# Annotated word with character offsets within its sentence
+AnnotatedWord = namedtuple('AnnotatedWord', 'text lemma upos xpos head deprel start_char end_char')
+# Annotated sentence, constituency is the bracketed parse tree
+AnnotatedSentence = namedtuple('AnnotatedSentence', 'text words constituency')
+
+
+def download_models():
+    import stanza
+    tmp_stdout = sys.stdout
+    sys.stdout = sys.stderr
+    stanza.download(lang=PIPELINE_CONFIG['lang'])
+    sys.stdout = tmp_stdout
+
+
+def load_parser(download=True):
+    """ Load the stanza pipeline, without download the models have to be
+        fetched with download_models before
+    """
+    import stanza
+    if download:
+        download_models()
     tmp_stdout = sys.stdout
     sys.stdout = sys.stderr
-    stanza.download(lang='en')
-    parser = stanza.Pipeline(lang='en', processors='tokenize,pos,lemma,depparse,constituency', tokenize_no_ssplit=True)
+    if download:
+        parser = stanza.Pipeline(**PIPELINE_CONFIG)
+    else:
+        parser = stanza.Pipeline(**PIPELINE_CONFIG, download_method=None)
     sys.stdout = tmp_stdout
     return parser
 
 
+def annotator_config():
+    """ Configuration of the annotation pipeline, used as part of the
+        annotation cache keys
+    """
+    import stanza
+    return dict(PIPELINE_CONFIG, stanza=stanza.__version__)
+
+
+def sentence_from_stanza(sent):
+    """ Copy a stanza sentence, the character offsets are made relative to
+        the sentence
+    """
+    offset = sent.words[0].start_char if sent.words else 0
+    words = [AnnotatedWord(word.text, word.lemma, word.upos, word.xpos, word.head, word.deprel,
+                           word.start_char - offset, word.end_char - offset) for word in sent.words]
+    return AnnotatedSentence(sent.text, words, str(sent.constituency))
+
+
+def sentence_to_conll(sent):
+    tokens = [Token(id=idx + 1, form=word.text, lemma=word.lemma, upos=word.upos, xpos=word.xpos, feats='_',
+                    head=word.head, deprel=word.deprel, deps='_',
+                    misc={'start_char': word.start_char, 'end_char': word.end_char})
+              for idx, word in enumerate(sent.words)]
+    return TokenList(tokens, metadata=Metadata(text=sent.text, parse=sent.constituency)).serialize()
+
+
+def sentence_from_conll(conll):
+    tokens = parse_conll(conll)[0]
+    words = [AnnotatedWord(tok['form'], tok['lemma'], tok['upos'], tok['xpos'] or '_', tok['head'], tok['deprel'],
+                           int(tok['misc']['start_char']), int(tok['misc']['end_char'])) for tok in tokens]
+    return AnnotatedSentence(tokens.metadata['text'], words, tokens.metadata['parse'])
+
+
+def split_sentences(edus: List[str]):
+    """ Group EDUs into sentences, a sentence ends with the first EDU
+        ending with a punctuation mark
+    """
+    sentences = []
+    edus_tmp = []
+    for edu in edus:
+        edu = edu.replace('<P>', '')
+        edus_tmp.append(edu)
+        if edu and edu[-1] in ".!?":
+            sentences.append(' '.join(edus_tmp))
+            edus_tmp = []
+    if edus_tmp:
+        sentences.append(' '.join(edus_tmp))
+    return sentences
+
+
+def annotate_sentence(parser, sentence):
+    """ Annotate a single sentence, returns the stanza sentence
+    """
+    parses = parser(sentence.replace('\n', ' ')).sentences
+    if len(parses) != 1:
+        raise ValueError(f'The pipeline found {len(parses)} sentences in {sentence!r}')
+    return parses[0]
+
+
+def annotate_documents(parser, documents: List[List[str]], batch_size: int = 0, cache=None):
+    """ Annotate the EDUs of many documents with few pipeline calls
+
+    The sentences of all documents are separated by blank lines, which the
+    pipeline keeps as sentence boundaries, and are split up again afterwards.
+    If the pipeline does not return one sentence per input sentence, the
+    sentences of that call are annotated one by one. Sentences found in the
+    cache and repeated sentences are annotated only once, empty sentences
+    are left out.
+
+    :param parser: stanza pipeline from load_parser
+    :param documents: list of EDU lists
+    :param batch_size: maximum number of sentences per pipeline call,
+                       0 for a single call
+    :param cache: AnnotationCache or None
+    :return: list of CoNLL-U sentences per document
+    """
+    doc_sentences = [[sent for sent in split_sentences(edus) if sent.strip()] for edus in documents]
+    annotations = dict.fromkeys(sent for doc in doc_sentences for sent in doc)
+    if cache is not None:
+        for sent, conll in zip(list(annotations), cache.get_many(list(annotations))):
+            if conll is not None:
+                annotations[sent] = sentence_from_conll(conll)
+    sentences = [sent for sent, annotation in annotations.items() if annotation is None]
+    batch_size = batch_size or len(sentences)
+    for batch_start in range(0, len(sentences), batch_size):
+        batch = sentences[batch_start:batch_start + batch_size]
+        # line breaks within a sentence must not look like sentence boundaries
+        parses = parser('\n\n'.join(sent.replace('\n', ' ') for sent in batch)).sentences
+        if len(parses) != len(batch):
+            parses = [annotate_sentence(parser, sent) for sent in batch]
+        parses = [sentence_from_stanza(parse) for parse in parses]
+        annotations.update(zip(batch, parses))
+        if cache is not None:
+            cache.put_many([(sent, sentence_to_conll(parse)) for sent, parse in zip(batch, parses)])
+    return [merge_edus_into_parses(edus, [annotations[sent] for sent in doc])
+            for edus, doc in zip(documents, doc_sentences)]
+
+
 def merge_edus_into_parses(edus: List[str], parses):
     result = []
     edu_i = 0
     edu = edus[edu_i].replace('<P>', '')
-    edu_offset = 0
+    edu_offset = None
     edu_length = len(edu)
+    # shift of the character offsets of sentences parsed separately
+    char_shift, last_end = 0, None
     par_i = 1
     doc_id = str(hash(' '.join(edus)))
     meta = {
@@ -29,17 +153,22 @@ def merge_edus_into_parses(edus: List[str], parses):
     for sent_i, sent in enumerate(parses):
         tokens = []
         for tok_i, tok in enumerate(sent.words):
+            if last_end is not None and tok.start_char + char_shift < last_end:
+                char_shift = last_end + 1 - tok.start_char
+            start_char, end_char = tok.start_char + char_shift, tok.end_char + char_shift
+            last_end = end_char
             misc = {}
             if sent_i == 0 and tok_i == 0:
                 misc['BeginSeg'] = 'YES'
-            if tok.end_char - edu_offset > edu_length:
+                edu_offset = start_char
+            if end_char - edu_offset > edu_length:
                 misc['BeginSeg'] = 'YES'
                 edu_i += 1
                 edu = edus[edu_i].replace('<P>', '')
                 if edus[edu_i - 1].endswith('<P>'):
                     meta['newpar id'] = f'{doc_id}-p{par_i}'
                     par_i += 1
-                edu_offset = tok.start_char
+                edu_offset = start_char
                 edu_length = len(edu)
             tokens.append(Token(
                 id=tok_i + 1,
@@ -59,5 +188,18 @@ def merge_edus_into_parses(edus: List[str], parses):
     return result
 
 
-def merge_as_text(tokens):
-    return '\n'.join('\t'.join(map(str, tok)) for tok in tokens) + '\n'
+def merge_as_text(sentences):
+    """ Convert the CoNLL-U sentences of merge_edus_into_parses into the
+        lines of a *.merge file read by Doc.from_file
+    """
+    lines = []
+    edu_i, par_i = 0, 1
+    for sent_i, sent in enumerate(sentences):
+        if 'newpar id' in sent.metadata:
+            par_i += 1
+        for tok in sent:
+            if (tok['misc'] or {}).get('BeginSeg') == 'YES':
+                edu_i += 1
+            lines.append('\t'.join(map(str, [sent_i, tok['id'], tok['form'], tok['lemma'], tok['upos'], tok['xpos'],
+                                             tok['deprel'], tok['head'], '_', '_', edu_i, par_i])))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,89 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Queue item that stops the batching thread
+_STOP = object()
+
+
+class MicroBatcher:
+    """ Collect items submitted from many threads into batches
+
+    A background thread takes the first waiting item and keeps collecting
+    until either max_batch_size items are there or max_wait seconds have
+    passed. The batch function is called once per batch and returns one
+    result per item, an Exception instance as result fails only its item.
+    """
+
+    def __init__(self, func, max_batch_size=16, max_wait=0.01):
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # Number of processed batches and items
+        self.n_batches, self.n_items = 0, 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """ Add an item to the next batch, returns a Future of its result
+        """
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item, timeout=None):
+        return self.submit(item).result(timeout)
+
+    def close(self):
+        """ Process the waiting items and stop the batching thread
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            entry = self._queue.get()
+            if entry is _STOP:
+                break
+            batch = [entry]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stop = True
+                    break
+                batch.append(entry)
+            self._process(batch)
+
+    def _process(self, batch):
+        items = [item for item, _ in batch]
+        futures = [future for _, future in batch]
+        start = time.time()
+        try:
+            results = list(self.func(items))
+            if len(results) != len(items):
+                raise ValueError('The batch function returned {} results for {} items'.format(
+                    len(results), len(items)))
+        except Exception as e:
+            logging.exception('Batch of {} items failed'.format(len(items)))
+            for future in futures:
+                future.set_exception(e)
+            return
+        self.n_batches += 1
+        self.n_items += len(items)
+        logging.debug('Processed batch of {} items in {:.1f}ms'.format(len(items), (time.time() - start) * 1000))
+        for future, result in zip(futures, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,132 @@
+import gzip
+import json
+import os
+import pickle
+
+import numpy
+
+
+class BrownClusters:
+    """ Brown cluster vocabulary backed by numpy arrays
+
+    The words are kept as a sorted table of utf-8 strings together with the
+    cluster id of every word, the bit strings of the clusters are stored only
+    once. A saved store is opened with mmap, so the arrays are shared between
+    all processes reading the same directory. Lookups by word work like the
+    former {word: bit string} dict.
+    """
+
+    def __init__(self, words, clusters, paths, path=None):
+        # sorted utf-8 encoded words
+        self.words = words
+        # cluster id of each word
+        self.clusters = clusters
+        # bit string of each cluster
+        self.paths = paths
+        # directory the store has been loaded from
+        self.path = path
+        self._path_strings = [p.decode('utf-8') for p in paths]
+        self._prefixes = {}
+
+    @staticmethod
+    def from_dict(bcvocab):
+        """ Build the store from a {word: bit string} dict
+        """
+        paths = sorted(set(bcvocab.values()))
+        path_ids = {path: idx for idx, path in enumerate(paths)}
+        words = sorted(word.encode('utf-8') for word in bcvocab)
+        clusters = numpy.array([path_ids[bcvocab[word.decode('utf-8')]] for word in words], dtype=numpy.int32)
+        return BrownClusters(numpy.array(words, dtype=bytes), clusters,
+                             numpy.array([path.encode('utf-8') for path in paths], dtype=bytes))
+
+    @staticmethod
+    def from_pickle(fname):
+        """ Convert a gzipped pickle of a {word: bit string} dict
+        """
+        with gzip.open(fname) as fin:
+            return BrownClusters.from_dict(pickle.load(fin))
+
+    @staticmethod
+    def from_text(fname):
+        """ Convert the tab separated output of the Brown clustering,
+            each line holds the bit string, the word and its frequency
+        """
+        bcvocab = {}
+        with open(fname, encoding='utf-8') as fin:
+            for line in fin:
+                items = line.strip().split('\t')
+                bcvocab[items[1]] = items[0]
+        return BrownClusters.from_dict(bcvocab)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        numpy.save(os.path.join(path, 'words.npy'), self.words)
+        numpy.save(os.path.join(path, 'clusters.npy'), self.clusters)
+        numpy.save(os.path.join(path, 'paths.npy'), self.paths)
+        with open(os.path.join(path, 'brown.json'), 'w') as fout:
+            json.dump({'words': len(self.words), 'clusters': len(self.paths)}, fout)
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        return BrownClusters(numpy.load(os.path.join(path, 'words.npy'), mmap_mode=mmap_mode),
+                             numpy.load(os.path.join(path, 'clusters.npy'), mmap_mode=mmap_mode),
+                             numpy.load(os.path.join(path, 'paths.npy')),
+                             path=path)
+
+    def __reduce__(self):
+        # Processes reopen the mapped files instead of copying the arrays
+        if self.path is not None:
+            return BrownClusters.load, (self.path,)
+        return BrownClusters, (self.words, self.clusters, self.paths)
+
+    def __len__(self):
+        return len(self.words)
+
+    def lookup(self, words):
+        """ Cluster ids of a list of words, -1 for unknown words
+        """
+        if len(words) == 0 or len(self.words) == 0:
+            return numpy.full(len(words), -1, dtype=numpy.int32)
+        keys = numpy.array([word.encode('utf-8') for word in words], dtype=bytes)
+        pos = numpy.minimum(numpy.searchsorted(self.words, keys), len(self.words) - 1)
+        return numpy.where(self.words[pos] == keys, self.clusters[pos], -1)
+
+    def prefixes(self, nprefix):
+        """ Bit string prefixes of all clusters, computed once per length
+        """
+        try:
+            return self._prefixes[nprefix]
+        except KeyError:
+            prefixes = self._prefixes[nprefix] = [path[:nprefix] for path in self._path_strings]
+            return prefixes
+
+    def lookup_prefixes(self, words, nprefix):
+        """ Cluster prefixes of the known words in a list of words
+        """
+        prefixes = self.prefixes(nprefix)
+        return [prefixes[cluster] for cluster in self.lookup(words).tolist() if cluster >= 0]
+
+    def __getitem__(self, word):
+        cluster = self.lookup([word])[0]
+        if cluster < 0:
+            raise KeyError(word)
+        return self._path_strings[cluster]
+
+    def __contains__(self, word):
+        return self.lookup([word])[0] >= 0
+
+    def get(self, word, default=None):
+        try:
+            return self[word]
+        except KeyError:
+            return default
+
+
+def load_brown_clusters(path):
+    """ Load Brown clusters either from a store directory or from the
+        gzipped pickle of a {word: bit string} dict
+    """
+    if os.path.isdir(path):
+        return BrownClusters.load(path)
+    with gzip.open(path) as fin:
+        return pickle.load(fin)
@@ -0,0 +1,172 @@
+import gc
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+
+from stagedp.utils.other import default_mode
+
+# Seconds after which a cache hit refreshes the last use of its entry
+TOUCH_INTERVAL = 600
+
+
+class AnnotationCache:
+    """ Persistent cache of sentence annotations
+
+    Entries are addressed by a hash of the sentence text and the annotator
+    configuration and hold the annotation in CoNLL-U format. The cache is a
+    SQLite database, so it can be shared by several processes. When the
+    stored annotations exceed max_size bytes, the least recently used
+    entries are removed. The total size is kept up to date by triggers, and
+    the last use of an entry is only written when it is older than
+    TOUCH_INTERVAL, so most reads do not need the write lock.
+    """
+
+    def __init__(self, path, config, max_size=1 << 30):
+        self.path = path
+        self.config = config
+        self.max_size = max_size
+        self._config_key = json.dumps(config, sort_keys=True)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute('BEGIN IMMEDIATE')
+        self._db.execute('CREATE TABLE IF NOT EXISTS annotations '
+                         '(key TEXT PRIMARY KEY, conll TEXT, size INTEGER, last_used REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS annotations_last_used ON annotations (last_used)')
+        # total size of the annotations in a single row
+        self._db.execute('CREATE TABLE IF NOT EXISTS total_size (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)')
+        self._db.execute('CREATE TRIGGER IF NOT EXISTS annotations_insert AFTER INSERT ON annotations '
+                         'BEGIN UPDATE total_size SET size = size + NEW.size; END')
+        self._db.execute('CREATE TRIGGER IF NOT EXISTS annotations_update AFTER UPDATE OF size ON annotations '
+                         'BEGIN UPDATE total_size SET size = size + NEW.size - OLD.size; END')
+        self._db.execute('CREATE TRIGGER IF NOT EXISTS annotations_delete AFTER DELETE ON annotations '
+                         'BEGIN UPDATE total_size SET size = size - OLD.size; END')
+        # caches of earlier versions are summed up once
+        self._db.execute('INSERT OR IGNORE INTO total_size SELECT 0, COALESCE(SUM(size), 0) FROM annotations '
+                         'WHERE NOT EXISTS (SELECT 1 FROM total_size)')
+        self._db.commit()
+        # Number of cache hits and misses
+        self.hits, self.misses = 0, 0
+
+    def __reduce__(self):
+        # Processes open their own connection to the same database
+        return AnnotationCache, (self.path, self.config, self.max_size)
+
+    def key(self, text):
+        return hashlib.sha256(f'{self._config_key}\n{text}'.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        """ Cached CoNLL-U annotations of texts, None for missing entries
+        """
+        keys = [self.key(text) for text in texts]
+        found, stale = {}, []
+        now = time.time()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self._db.execute('SELECT key, conll, last_used FROM annotations WHERE key IN ({})'.format(
+                ','.join('?' * len(chunk))), chunk)
+            for key, conll, last_used in rows:
+                found[key] = conll
+                if last_used < now - TOUCH_INTERVAL:
+                    stale.append((now, key))
+        if stale:
+            self._db.executemany('UPDATE annotations SET last_used = ? WHERE key = ?', stale)
+            self._db.commit()
+        results = [found.get(key) for key in keys]
+        n_hits = sum(result is not None for result in results)
+        self.hits += n_hits
+        self.misses += len(results) - n_hits
+        return results
+
+    def put_many(self, items):
+        """ Store (text, CoNLL-U annotation) pairs and evict the least
+            recently used entries beyond the size limit
+        """
+        now = time.time()
+        # an upsert, the delete of INSERT OR REPLACE does not fire the delete trigger
+        self._db.executemany('INSERT INTO annotations VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET '
+                             'conll = excluded.conll, size = excluded.size, last_used = excluded.last_used',
+                             [(self.key(text), conll, len(conll), now) for text, conll in items])
+        self._db.commit()
+        self.evict()
+
+    def total_size(self):
+        return self._db.execute('SELECT size FROM total_size').fetchone()[0]
+
+    def evict(self):
+        total = self.total_size()
+        if total <= self.max_size:
+            return
+        excess, keys = total - self.max_size, []
+        for key, size in self._db.execute('SELECT key, size FROM annotations ORDER BY last_used'):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._db.executemany('DELETE FROM annotations WHERE key = ?', keys)
+        self._db.commit()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM annotations').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+class TreeCache:
+    """ On-disk cache of objects built from source files, e.g. the parsed
+        RST trees of *.dis and *.merge files
+
+    Each entry is a pickle file named by the hash of the source paths. It
+    starts with a header holding the version of the cached objects and the
+    size and modification time of each source file, an entry is only used
+    while the header still matches.
+    """
+
+    def __init__(self, path, version=1):
+        self.path = path
+        self.version = version
+        os.makedirs(path, exist_ok=True)
+
+    def entry(self, files):
+        key = hashlib.sha1('\0'.join(os.path.abspath(fname) for fname in files).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, f'{key}.pickle')
+
+    def header(self, files):
+        stats = [os.stat(fname) for fname in files]
+        return {'version': self.version, 'files': [[stat.st_size, stat.st_mtime_ns] for stat in stats]}
+
+    def get(self, files):
+        """ Cached object of files, None if missing or outdated
+        """
+        # unpickling creates many objects at once, which would trigger the
+        # garbage collector over and over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(self.entry(files), 'rb') as fin:
+                if pickle.load(fin) != self.header(files):
+                    return None
+                return pickle.load(fin)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def put(self, files, value):
+        header = self.header(files)
+        fd, tmp_name = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                pickle.dump(header, fout, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(value, fout, protocol=pickle.HIGHEST_PROTOCOL)
+            os.chmod(tmp_name, default_mode())
+            os.replace(tmp_name, self.entry(files))
+        except BaseException:
+            os.remove(tmp_name)
+            raise
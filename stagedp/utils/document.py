@@ -1,56 +1,158 @@
-from collections import defaultdict
+import sys
+
+import numpy
 
 from stagedp.utils.token import Token
 
 
 class Doc:
     """ Build one doc instance from *.merge file
+
+    Token attributes are kept column-wise in arrays indexed by the
+    document-level token index. The borders of the sentence and paragraph
+    around every token are computed once when the document is loaded.
     """
 
     def __init__(self):
-        self.token_dict = None
+        # Paragraph index, Sentence index, token index (within sent)
+        self.pidx, self.sidx, self.tidx = None, None, None
+        # Head index (within sent), EDU index
+        self.hidx, self.eduidx = None, None
+        # Word, Lemma, POS tag, Dependency label
+        self.word, self.lemma, self.pos, self.dep_label = None, None, None, None
+        # Lower-cased lemma and POS tag
+        self.lemma_lower, self.pos_lower = None, None
+        # First and last token of the sentence around each token
+        self.sent_start, self.sent_end = None, None
+        # First and last token of the paragraph around each token
+        self.para_start, self.para_end = None, None
+        # Document-level index of the syntactic head of each token, -1 for the root,
+        # kept as a list since it is scanned token by token
+        self.head_gidx = None
+        # EDU index -> token range / first and last token
         self.edu_dict = None
+        self.edu_spans = None
+        self._token_dict = None
 
     @staticmethod
     def from_file(fmerge):
         """ Read information from the merge file, and create an Doc instance
         """
-        doc = Doc()
-        doc.token_dict = {}
+        columns = []
         for line in fmerge:
             line = line.strip()
             if len(line) == 0:
                 continue
-            tok = doc._parse_fmerge_line(line)
-            doc.token_dict[len(doc.token_dict)] = tok
-        # Get EDUs from tokendict
-        doc.edu_dict = doc._recover_edus(doc.token_dict)
+            columns.append(Doc._parse_fmerge_line(line))
+        doc = Doc()
+        doc._init_columns(columns)
         return doc
 
     def init_from_tokens(self, token_list):
-        self.token_dict = {idx: token for idx, token in enumerate(token_list)}
-        self.edu_dict = self._recover_edus(self.token_dict)
+        self._init_columns([(tok.pidx, tok.sidx, tok.tidx, tok.hidx, tok.eduidx,
+                             tok.word, tok.lemma, tok.pos, tok.dep_label) for tok in token_list])
+
+    def __len__(self):
+        return len(self.sidx)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_token_dict'] = None
+        return state
+
+    @property
+    def token_dict(self):
+        """ Token instances indexed by the document-level index, kept for
+            compatibility. Feature extraction reads the arrays directly.
+        """
+        if self._token_dict is None:
+            self._token_dict = {}
+            for gidx in range(len(self)):
+                tok = Token()
+                tok.pidx, tok.sidx, tok.tidx = int(self.pidx[gidx]), int(self.sidx[gidx]), int(self.tidx[gidx])
+                tok.word, tok.lemma = self.word[gidx], self.lemma[gidx]
+                tok.pos = self.pos[gidx]
+                tok.dep_label = self.dep_label[gidx]
+                tok.hidx = int(self.hidx[gidx])
+                tok.eduidx = int(self.eduidx[gidx])
+                self._token_dict[gidx] = tok
+        return self._token_dict
 
     @staticmethod
     def _parse_fmerge_line(line):
-        """ Parse one line from *.merge file
+        """ Parse one line from *.merge file, either with the 12 columns of
+            merge_as_text or the 11 columns of the original StageDP files,
+            which have a single POS column followed by the dependency label,
+            the head, the named entity and the partial parse tree
         """
-        sent_i, tok_i, text, lemma, upos, xpos, deprel, head, _, _, edu_i, par_i = line.split("\t")
-        tok = Token()
-        tok.pidx, tok.sidx, tok.tidx = int(par_i), int(sent_i), int(tok_i)
-        tok.word, tok.lemma = text, lemma
-        tok.pos = xpos
-        tok.dep_label = deprel
-        tok.hidx = int(head)
+        items = line.split("\t")
+        if len(items) == 11:
+            sent_i, tok_i, text, lemma, xpos, deprel, head, _, _, edu_i, par_i = items
+        else:
+            sent_i, tok_i, text, lemma, upos, xpos, deprel, head, _, _, edu_i, par_i = items
         # tok.ner, tok.partial_parse = items[7], items[8]
-        tok.eduidx = int(edu_i)
-        return tok
+        return (int(par_i), int(sent_i), int(tok_i), int(head), int(edu_i),
+                text, sys.intern(lemma), sys.intern(xpos), sys.intern(deprel))
+
+    def _init_columns(self, columns):
+        """ Build the token arrays and the border indexes from one
+            (pidx, sidx, tidx, hidx, eduidx, word, lemma, pos, dep_label)
+            tuple per token
+        """
+        pidx, sidx, tidx, hidx, eduidx, word, lemma, pos, dep_label = zip(*columns) if columns else [()] * 9
+        self.pidx, self.sidx, self.tidx = (numpy.array(col, dtype=numpy.int64) for col in (pidx, sidx, tidx))
+        self.hidx, self.eduidx = (numpy.array(col, dtype=numpy.int64) for col in (hidx, eduidx))
+        self.word, self.lemma, self.pos, self.dep_label = (Doc._string_array(col)
+                                                           for col in (word, lemma, pos, dep_label))
+        self.lemma_lower = Doc._string_array(lem.lower() for lem in lemma)
+        self.pos_lower = Doc._string_array(tag.lower() for tag in pos)
+        self.sent_start, self.sent_end = Doc._run_borders(self.sidx)
+        self.para_start, self.para_end = Doc._run_borders(self.pidx)
+        self.head_gidx = Doc._resolve_heads(self.sidx, self.tidx, self.hidx).tolist()
+        # Get EDUs from the token arrays
+        self.edu_spans = Doc._recover_edu_spans(self.eduidx)
+        self.edu_dict = {eduidx: range(first, last + 1) for eduidx, (first, last) in self.edu_spans.items()}
+        self._token_dict = None
+
+    @staticmethod
+    def _string_array(strings):
+        strings = [sys.intern(string) for string in strings]
+        array = numpy.empty(len(strings), dtype=object)
+        array[:] = strings
+        return array
+
+    @staticmethod
+    def _run_borders(values):
+        """ First and last position of the run of equal values around
+            each position
+        """
+        n = len(values)
+        if n == 0:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        change = numpy.flatnonzero(values[1:] != values[:-1]) + 1
+        starts = numpy.concatenate(([0], change))
+        ends = numpy.concatenate((change - 1, [n - 1]))
+        return numpy.repeat(starts, ends - starts + 1), numpy.repeat(ends, ends - starts + 1)
+
+    @staticmethod
+    def _resolve_heads(sidx, tidx, hidx):
+        """ Map the sentence-level head index of each token to the
+            document-level index of the head token
+        """
+        if len(sidx) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        width = max(tidx.max(), hidx.max()) + 1
+        keys = sidx * width + tidx
+        order = numpy.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        head_keys = sidx * width + hidx
+        pos = numpy.minimum(numpy.searchsorted(sorted_keys, head_keys), len(keys) - 1)
+        found = (sorted_keys[pos] == head_keys) & (hidx > 0)
+        return numpy.where(found, order[pos], -1)
 
     @staticmethod
-    def _recover_edus(token_dict):
-        """ Recover EDUs from token_dict
+    def _recover_edu_spans(eduidx):
+        """ First and last token of each EDU, EDUs are contiguous
         """
-        edu_dict = defaultdict(list)
-        for gidx, token in token_dict.items():
-            edu_dict[token.eduidx].append(gidx)
-        return dict(edu_dict)
+        starts, ends = Doc._run_borders(eduidx)
+        return {int(eduidx[first]): (int(first), int(ends[first])) for first in numpy.unique(starts)}
@@ -1,3 +1,7 @@
+import os
+from functools import lru_cache
+
+
 class ParseError(Exception):
     pass
 
@@ -16,6 +20,23 @@ def reverse_dict(dct):
     return newmap
 
 
+@lru_cache(maxsize=None)
+def umask():
+    """ The umask of the process, it can only be read by setting it, so it
+        is read once
+    """
+    mask = os.umask(0o022)
+    os.umask(mask)
+    return mask
+
+
+def default_mode(mode=0o666):
+    """ Permissions of a file or directory (mode 0o777) created by open or
+        os.mkdir, tempfile creates them readable by the owner only
+    """
+    return mode & ~umask()
+
+
 class2rel = {
     'Attribution': ['attribution', 'attribution-e', 'attribution-n', 'attribution-negative'],
     'Background': ['background', 'background-e', 'circumstance', 'circumstance-e'],
@@ -13,8 +13,10 @@ class SpanNode(object):
         :type prop: string or None
         :param prop: property of this span
         """
-        # Text of this span / Discourse relation
-        self.text, self.relation = None, None
+        # Document-level index of the first and last token of this span / Discourse relation
+        self.tok_span, self.relation = None, None
+        # Text of this span as given in the *.dis file
+        self.raw_text = None
         # EDU span / Nucleus span (begin, end) index
         self.edu_span, self.nuc_span = None, None
         # Nucleus single EDU
@@ -41,6 +43,18 @@ class SpanNode(object):
         self.height = 0
         # level of this node, 0 for inner-sentence, 1 for inter-sentence but inner paragraph, 2 for inter-paragraph
         self.level = 0
+        # Features of this span alone, computed once by the feature generators
+        self.feature_cache = {}
+
+    @property
+    def text(self):
+        """ Document-level indices of the tokens of this span. Spans are
+            contiguous, so this is a range view on the token span instead
+            of a list of its own.
+        """
+        if self.tok_span is None:
+            return None
+        return range(self.tok_span[0], self.tok_span[1] + 1)
 
     def is_leaf(self):
         return self.lnode is None and self.rnode is None and len(self.nodelist) == 0
@@ -65,7 +79,7 @@ class SpanNode(object):
                 self.nuc_span = (c[1], c[1])
                 self.nuc_edu = c[1]
             elif c[0] == 'text':
-                self.text = c[1]
+                self.raw_text = c[1]
             else:
                 raise ValueError("Unrecognized property: {}".format(c[0]))
 
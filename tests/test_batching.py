@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+from stagedp.utils.batching import MicroBatcher
+
+
+class Recorder:
+    """ Batch function that records the batches and doubles the items,
+        fails the items equal to fail
+    """
+
+    def __init__(self, delay=0.0, fail=None):
+        self.batches = []
+        self.delay = delay
+        self.fail = fail
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        time.sleep(self.delay)
+        return [ValueError(f'bad item {item}') if item == self.fail else 2 * item for item in items]
+
+
+def test_batches_respect_max_batch_size():
+    func = Recorder()
+    batcher = MicroBatcher(func, max_batch_size=4, max_wait=1.0)
+    futures = [batcher.submit(item) for item in range(10)]
+    assert [future.result(timeout=5) for future in futures] == [2 * item for item in range(10)]
+    batcher.close()
+    assert max(len(batch) for batch in func.batches) == 4
+    assert sum(func.batches, []) == list(range(10))
+
+
+def test_incomplete_batch_is_processed_after_max_wait():
+    func = Recorder()
+    batcher = MicroBatcher(func, max_batch_size=100, max_wait=0.05)
+    start = time.monotonic()
+    assert batcher(3, timeout=5) == 6
+    elapsed = time.monotonic() - start
+    batcher.close()
+    assert func.batches == [[3]]
+    assert 0.04 <= elapsed < 2
+
+
+def test_exception_result_fails_only_its_item():
+    batcher = MicroBatcher(Recorder(fail=2), max_batch_size=8, max_wait=0.05)
+    futures = [batcher.submit(item) for item in range(4)]
+    with pytest.raises(ValueError, match='bad item 2'):
+        futures[2].result(timeout=5)
+    assert [futures[idx].result(timeout=5) for idx in (0, 1, 3)] == [0, 2, 6]
+    batcher.close()
+
+
+def test_wrong_number_of_results_fails_the_batch():
+    batcher = MicroBatcher(lambda items: items[:-1], max_batch_size=8, max_wait=0.05)
+    futures = [batcher.submit(item) for item in range(3)]
+    for future in futures:
+        with pytest.raises(ValueError, match='2 results for 3 items'):
+            future.result(timeout=5)
+    batcher.close()
+
+
+def test_close_processes_waiting_items():
+    func = Recorder(delay=0.02)
+    batcher = MicroBatcher(func, max_batch_size=2, max_wait=1.0)
+    futures = [batcher.submit(item) for item in range(7)]
+    batcher.close()
+    assert all(future.done() for future in futures)
+    assert [future.result() for future in futures] == [2 * item for item in range(7)]
+    assert not batcher._thread.is_alive()
+
+
+def test_items_from_many_threads():
+    func = Recorder()
+    batcher = MicroBatcher(func, max_batch_size=8, max_wait=0.01)
+    results = {}
+
+    def client(item):
+        results[item] = batcher(item, timeout=5)
+
+    threads = [threading.Thread(target=client, args=(item,)) for item in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.close()
+    assert results == {item: 2 * item for item in range(20)}
+    assert batcher.n_items == 20 and batcher.n_batches == len(func.batches)
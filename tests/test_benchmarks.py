@@ -0,0 +1,18 @@
+import json
+
+from click.testing import CliRunner
+
+from benchmarks import run
+
+
+def test_run_default_options(tmp_path):
+    output = tmp_path / 'results.json'
+    result = CliRunner().invoke(run.main, ['-o', str(output), '--filter', 'bracketing', '--repeat', '1'])
+    assert result.exit_code == 0, result.output
+    names = [bench['name'] for bench in json.loads(output.read_text())['results']]
+    assert names == ['file1x1/RstTree.bracketing', 'file1x8/RstTree.bracketing']
+
+
+def test_parse_sizes():
+    assert run.parse_sizes('') == []
+    assert run.parse_sizes('1, 8,') == [1, 8]
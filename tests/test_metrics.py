@@ -0,0 +1,67 @@
+import io
+import sys
+
+import pytest
+
+from benchmarks.synthetic import generate_document
+from stagedp.eval.metrics import Metrics
+from stagedp.models.tree import RstTree
+from stagedp.utils.document import Doc
+
+
+@pytest.fixture(scope='module')
+def tree_pairs():
+    """ Gold and predicted trees of synthetic documents, the predictions are
+        random trees over the same EDUs
+    """
+    sys.setrecursionlimit(10000)
+    pairs = []
+    for seed in range(6):
+        merge_text, gold_dis = generate_document(30, seed=seed)
+        _, pred_dis = generate_document(30, seed=seed + 100)
+        doc = Doc.from_file(io.StringIO(merge_text))
+        pairs.append((RstTree(RstTree.build_tree(gold_dis, binarize=True), doc),
+                      RstTree(RstTree.build_tree(pred_dis, binarize=True), doc)))
+    return pairs
+
+
+def evaluate(pairs):
+    met = Metrics()
+    for gold_rst, pred_rst in pairs:
+        met.eval(gold_rst, pred_rst)
+    return met
+
+
+def counts(met):
+    """ The counts of to_dict, with the per-relation counts keyed by relation
+        and the sums of the per-document precision and recall left out
+    """
+    data = met.to_dict()
+    for name in Metrics.COUNTS:
+        if name.endswith('_relation'):
+            data[name] = dict(zip(data['relations'], data[name]))
+    for name in Metrics.PARTS:
+        data[name] = {'hit_num': data[name]['hit_num'], 'hit_num_each_level': data[name]['hit_num_each_level']}
+    del data['relations']
+    return data
+
+
+def test_reduce_of_shards_equals_single_pass(tree_pairs, tmp_path):
+    whole = evaluate(tree_pairs)
+    fnames = []
+    for idx, shard in enumerate([tree_pairs[:2], tree_pairs[2:3], tree_pairs[3:]]):
+        fnames.append(tmp_path / f'shard{idx}.json')
+        evaluate(shard).save(fnames[-1])
+    merged = Metrics.reduce(Metrics.load(fname) for fname in fnames)
+    assert counts(merged) == counts(whole)
+    assert merged.relations == whole.relations
+    for name in Metrics.PARTS:
+        assert getattr(merged, name).percision == pytest.approx(getattr(whole, name).percision)
+        assert getattr(merged, name).recall == pytest.approx(getattr(whole, name).recall)
+
+
+def test_merge_maps_relations_of_the_other_shard(tree_pairs):
+    whole = evaluate(tree_pairs)
+    # the second shard is merged into the first, whose relation ids differ
+    merged = evaluate(tree_pairs[3:]).merge(evaluate(tree_pairs[:3]))
+    assert counts(merged) == counts(whole)